@@ -6,4 +6,12 @@ export BQ_DATASET_NAME="covid19"
 export BQ_TABLE_NAME="ISMIR"
 export TEST_CASE="case14" # lowercase any case from 1 to 49 (e.g case1, case32 ...)
 export RESULT_TOPIC="topic_of_choice"
-export DEST_BUCKET="name_bucket" #trigger bucket must be different than data bucket
\ No newline at end of file
+export DEST_BUCKET="name_bucket" #trigger bucket must be different than data bucket
+export OCR_CACHE_URI="" # optional: local dir or gs://bucket/prefix for the OCR cache
+export STORAGE_URI="" # optional: file:///path/to/root to read stage outputs from local disk instead of GCS
+export TEXT_COMPRESSION="" # optional: gzip or zstd to compress stored text and Pub/Sub payloads
+export DLP_AES_KEY="" # base64-encoded AES-256 key used by redacting.py
+export BOILERPLATE_URI="" # optional: local dir or gs://bucket/prefix for the learned boilerplate
+export NER_CACHE_URI="" # optional: local dir or gs://bucket/prefix for the NER result cache
+export LEDGER_URI="" # optional: datastore://kind, local dir or gs://bucket/prefix for the Cloud Functions ledger
+export PROFILE_URI="" # optional: local dir or gs://bucket/prefix for the Cloud Functions step profiles
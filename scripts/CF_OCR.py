@@ -3,14 +3,23 @@ import json
 import os
 import time
 import base64
+import io
 
 from google.cloud import pubsub_v1
 from google.cloud import vision, storage
-from google.protobuf import json_format
 import google.cloud.dlp
 
+from utils.cache_fcn import OCRCache, getCacheBackend, cachedDocumentOCR
+from utils.boilerplate_fcn import loadBoilerplate
+from utils.compression_fcn import compress, textCompression
+from utils.ledger_fcn import EventLedger, getLedgerBackend
+from utils.ocr_fcn import OCRPlanner
+from utils.preprocessing_fcn import iterJsonPageTexts
+from utils.profiling_fcn import StageProfiler
+from utils.storage_fcn import BlobStream
 
-def documentOCR(vision_client, gcs_source_uri, gcs_destination_uri, batch_size=20):
+
+def documentOCR(vision_client, gcs_source_uri, gcs_destination_uri, batch_size=20, timeout=180):
     """
 
     Args:
@@ -18,6 +27,7 @@ def documentOCR(vision_client, gcs_source_uri, gcs_destination_uri, batch_size=2
         gcs_source_uri:
         gcs_destination_uri:
         batch_size:
+        timeout: int - seconds to wait for the operation
 
     Returns:
 
@@ -47,7 +57,7 @@ def documentOCR(vision_client, gcs_source_uri, gcs_destination_uri, batch_size=2
         requests=[async_request])
 
     # print('Waiting for the operation to finish.')
-    operation.result(timeout=180)
+    operation.result(timeout=timeout)
     logging.info('Text extraction from document {} is completed.'.format(doc_title))
 
 
@@ -70,16 +80,11 @@ def readJsonResult(storage_client, bucket_name, doc_title):
     all_text = ''
     for blob in blob_list:
 
-        json_string = blob.download_as_string()
-        response = json_format.Parse(
-            json_string, vision.types.AnnotateFileResponse())
-
-        # The actual response for the first page of the input file.
-        for response in response.responses:
-            # first_page_response = response.responses[0]
-            text_response = response.full_text_annotation.text
-            all_text += text_response
-            all_text += ' '
+        # Stream the json by chunks, only the text of the pages is kept in memory
+        with io.BufferedReader(BlobStream(blob)) as json_stream:
+            for _, text_response in iterJsonPageTexts(json_stream):
+                all_text += text_response
+                all_text += ' '
 
     logging.info("Parsing of {} json doc was successful.".format(doc_title))
     return all_text
@@ -149,7 +154,7 @@ def deterministicDeidentifyWithFpe(dlp_client, parent, text, info_types, surroga
     return response.item.value
 
 
-def uploadBlob(storage_client, bucket_name, txt_content, destination_blob_name):
+def uploadBlob(storage_client, bucket_name, txt_content, destination_blob_name, compression=None):
     """
     Uploads a file to the bucket.
     Args:
@@ -157,6 +162,7 @@ def uploadBlob(storage_client, bucket_name, txt_content, destination_blob_name):
         bucket_name:
         txt_content: str - text
         destination_blob_name: str - prefix
+        compression: str - Optional, 'gzip' or 'zstd', stored as the Content-Encoding of the blob
 
     Returns:
 
@@ -165,12 +171,16 @@ def uploadBlob(storage_client, bucket_name, txt_content, destination_blob_name):
     bucket_client = storage_client.bucket(bucket_name)
     blob = bucket_client.blob(destination_blob_name)
 
-    blob.upload_from_string(txt_content)
+    if compression:
+        blob.content_encoding = compression
+        blob.upload_from_string(compress(txt_content, compression), content_type='text/plain; charset=utf-8')
+    else:
+        blob.upload_from_string(txt_content)
 
     logging.info("Text uploaded to {}".format(destination_blob_name))
 
 
-def publishMsg(publisher_client, project_id, text, doc_title, topic_name):
+def publishMsg(publisher_client, project_id, text, doc_title, topic_name, compression=None, generation=None):
     """
     Publish message with text and filename.
     Args:
@@ -179,6 +189,8 @@ def publishMsg(publisher_client, project_id, text, doc_title, topic_name):
         text: str - Text contained in the document
         doc_title: str -
         topic_name: str -
+        compression: str - Optional, 'gzip' or 'zstd', sent in the content_encoding attribute
+        generation: str - Optional, generation of the pdf object, lets the subscriber de-duplicate the messages
     Returns:
 
     """
@@ -188,6 +200,8 @@ def publishMsg(publisher_client, project_id, text, doc_title, topic_name):
         'text': text,
         'doc_title': doc_title,
     }
+    if generation:
+        message['generation'] = generation
 
     # Publish message to PubSub
     # Note: the message_data needs to be in bytestring
@@ -197,7 +211,11 @@ def publishMsg(publisher_client, project_id, text, doc_title, topic_name):
     topic_path = publisher_client.topic_path(project_id, topic_name)
 
     # Publish method returns a future instance
-    future = publisher_client.publish(topic_path, data=message_data)
+    if compression:
+        future = publisher_client.publish(topic_path, data=compress(message_data, compression),
+                                          content_encoding=compression)
+    else:
+        future = publisher_client.publish(topic_path, data=message_data)
 
     # We need to call result method to extract the message ID
     # Refer to the documentation:
@@ -230,26 +248,65 @@ def processPDFFile(file, context):
     RESULT_TOPIC = os.environ["RESULT_TOPIC"]  # e.g pdf2text
 
     src_bucket = file.get('bucket')
-    dest_bucket = 'aketari-covid19-data'
+    dest_bucket = os.environ.get('DEST_BUCKET', 'aketari-covid19-data')
 
     prefix_and_doc_title = file.get('name')
     doc_title = prefix_and_doc_title.split('/')[-1].split('.')[0]
     print('name is: {}'.format(prefix_and_doc_title))
 
+    # Deliveries of the same object generation are processed once, a retry resumes from its last finished step
+    event_id = getattr(context, 'event_id', None)
+    generation = file.get('generation') or event_id
+    ledger_uri = os.environ.get('LEDGER_URI')  # e.g datastore://ledger or gs://aketari-covid19-data/ledger
+    ledger = EventLedger(getLedgerBackend(storage_client, ledger_uri) if ledger_uri else None,
+                         'ocr/{}/{}'.format(doc_title, generation), event_id)
+    if not ledger.claim():
+        return
+
+    # Optional: local directory (e.g /tmp/profile) or gs://bucket/prefix receiving a profile of each step
+    profiler = StageProfiler(os.environ.get('PROFILE_URI'), 'ocr/{}'.format(doc_title), storage_client=storage_client)
+
     # Step 1: Call OCR helper function
     gcs_source_path = 'gs://' + src_bucket + '/' + prefix_and_doc_title
     print('source gcs path: {}'.format(gcs_source_path))
     print('=============================')
-    json_gcs_dest_path = 'gs://' + dest_bucket + '/json/' + doc_title + '-'
-    print('destination json path: {}'.format(json_gcs_dest_path))
-    print('=============================')
-    documentOCR(vision_client, gcs_source_path, json_gcs_dest_path)
-    print("completed OCR step!")
-    print('=============================')
-    # Step 2: Parse json file
-    text = readJsonResult(storage_client, dest_bucket, doc_title)
-    print("Completed json parsing step!")
-    print('=============================')
+
+    # Large pdfs are split into page ranges OCR'd in parallel, the timeouts scale with the page count
+    ocr_planner = OCRPlanner(storage_client, ocr_fcn=documentOCR)
+
+    def ocrStep():
+        ocr_cache_uri = os.environ.get('OCR_CACHE_URI')  # e.g gs://aketari-covid19-data/ocr_cache
+        if ocr_cache_uri:
+            # Step 1 & 2: OCR through the content-addressed cache, duplicates never reach Vision
+            ocr_cache = OCRCache(getCacheBackend(storage_client, ocr_cache_uri))
+            text = cachedDocumentOCR(vision_client, storage_client, ocr_cache, ocr_planner,
+                                     gcs_source_path, dest_bucket, doc_title)
+            ocr_cache.logStats()
+            print("completed cached OCR step!")
+            print('=============================')
+        else:
+            json_gcs_dest_path = 'gs://' + dest_bucket + '/json/' + doc_title + '-'
+            print('destination json path: {}'.format(json_gcs_dest_path))
+            print('=============================')
+            ocr_planner(vision_client, gcs_source_path, json_gcs_dest_path)
+            print("completed OCR step!")
+            print('=============================')
+            # Step 2: Parse json file
+            text = readJsonResult(storage_client, dest_bucket, doc_title)
+            print("Completed json parsing step!")
+            print('=============================')
+        return text
+
+    with profiler.stage('ocr'):
+        text = ledger.step('ocr', ocrStep)
+
+    boilerplate_uri = os.environ.get('BOILERPLATE_URI')  # e.g gs://aketari-covid19-data/boilerplate
+    if boilerplate_uri:
+        # Strip the boilerplate learned on the corpus, it would otherwise be redacted and translated again
+        with profiler.stage('boilerplate'):
+            boilerplate_detector = loadBoilerplate(storage_client, boilerplate_uri)
+            text = boilerplate_detector.strip(text)
+            boilerplate_detector.logStats()
 
     # Step 3: Redact text
     parent = "{}/{}".format(project_id,location)
@@ -260,27 +317,33 @@ def processPDFFile(file, context):
     bucket_client = storage_client.get_bucket(dest_bucket)
     AES_bytes = bucket_client.blob(gcs_prefix_secret).download_as_string().encode('utf-8')
     base64_AES_bytes = base64.b64encode(AES_bytes)
-    redacted_text = deterministicDeidentifyWithFpe(dlp_client=dlp_client, parent=parent,
-                                                                 text=text, info_types=INFO_TYPES,
-                                                                 surrogate_type="REDACTED",
-                                                                 b64encoded_bytes=base64_AES_bytes)
+    with profiler.stage('redaction'):
+        redacted_text = ledger.step('redaction', deterministicDeidentifyWithFpe, dlp_client=dlp_client,
+                                    parent=parent, text=text, info_types=INFO_TYPES, surrogate_type="REDACTED",
+                                    b64encoded_bytes=base64_AES_bytes)
 
     print("Completed redaction step!")
     print('=============================')
 
     # Step 4: Publish on pubsub
     topic_name = RESULT_TOPIC
-    publishMsg(publisher_client, project_id, text, doc_title, topic_name)
-    publishMsg(redacted_text, doc_title, topic_name)
+
+    # Only the raw text is published: CF_translate redacts its own output, the redacted text is uploaded below
+    with profiler.stage('publish'):
+        ledger.step('publish', publishMsg, publisher_client, project_id, text, doc_title, topic_name,
+                    compression=textCompression(), generation=generation)
     print("Completed pubsub messaging step!")
     print('=============================')
 
     # Step 4: Save on GCS
-    upload_dest_prefix_for_text = 'raw_txt/{}.txt'.format(doc_title)
-    uploadBlob(storage_client, dest_bucket, text, upload_dest_prefix_for_text)
-
-    upload_dest_prefix_for_redacted_text = 'redacted_raw_txt/{}.txt'.format(doc_title)
-    uploadBlob(storage_client, dest_bucket, redacted_text, upload_dest_prefix_for_redacted_text)
+    with profiler.stage('upload'):
+        upload_dest_prefix_for_text = 'raw_txt/{}.txt'.format(doc_title)
+        ledger.step('upload_raw_txt', uploadBlob, storage_client, dest_bucket, text, upload_dest_prefix_for_text)
+
+        upload_dest_prefix_for_redacted_text = 'redacted_raw_txt/{}.txt'.format(doc_title)
+        ledger.step('upload_redacted_raw_txt', uploadBlob, storage_client, dest_bucket, redacted_text,
+                    upload_dest_prefix_for_redacted_text, compression=textCompression())
+    ledger.complete()
     print("Completed upload step!")
     print('=============================')
     print('File {} processed.'.format(doc_title))
@@ -8,6 +8,11 @@ import logging
 from google.cloud import pubsub_v1, translate, storage
 import google.cloud.dlp
 
+from utils.lang_fcn import splitLanguageSpans, documentLanguage, translateSpans
+from utils.compression_fcn import compress, decompress, textCompression
+from utils.ledger_fcn import EventLedger, getLedgerBackend
+from utils.profiling_fcn import StageProfiler
+
 def doTranslation(translate_client, project_id, text, src_lang="it", target_lang="en-US"):
     """
 
@@ -36,13 +41,14 @@ def doTranslation(translate_client, project_id, text, src_lang="it", target_lang
     return translated_txt
 
 
-def publishMsg(publisher_client, project_id, text, doc_title, topic_name):
+def publishMsg(publisher_client, project_id, text, doc_title, topic_name, compression=None):
     """
     Publish message with text and doc_title.
     Args:
         text: str - Text contained in the document
         doc_title: str -
         topic_name: str -
+        compression: str - Optional, 'gzip' or 'zstd', sent in the content_encoding attribute
 
     Returns:
 
@@ -61,7 +67,11 @@ def publishMsg(publisher_client, project_id, text, doc_title, topic_name):
     topic_path = publisher_client.topic_path(project_id, topic_name)
 
     # Publish method returns a future instance
-    future = publisher_client.publish(topic_path, data=message_data)
+    if compression:
+        future = publisher_client.publish(topic_path, data=compress(message_data, compression),
+                                          content_encoding=compression)
+    else:
+        future = publisher_client.publish(topic_path, data=message_data)
 
     # We need to call result method to extract the message ID
     # Refer to the documentation:
@@ -71,7 +81,7 @@ def publishMsg(publisher_client, project_id, text, doc_title, topic_name):
     logging.info("Message id: {} was published in topic: {}".format(message_id, topic_name))
 
 
-def uploadBlob(storage_client, bucket_name, txt_content, destination_blob_name):
+def uploadBlob(storage_client, bucket_name, txt_content, destination_blob_name, compression=None):
     """
     Uploads a file to the bucket.
     Args:
@@ -79,6 +89,7 @@ def uploadBlob(storage_client, bucket_name, txt_content, destination_blob_name):
         bucket_name:
         txt_content: str - text
         destination_blob_name: str - prefix
+        compression: str - Optional, 'gzip' or 'zstd', stored as the Content-Encoding of the blob
 
     Returns:
 
@@ -87,7 +98,11 @@ def uploadBlob(storage_client, bucket_name, txt_content, destination_blob_name):
     bucket_client = storage_client.bucket(bucket_name)
     blob = bucket_client.blob(destination_blob_name)
 
-    blob.upload_from_string(txt_content)
+    if compression:
+        blob.content_encoding = compression
+        blob.upload_from_string(compress(txt_content, compression), content_type='text/plain; charset=utf-8')
+    else:
+        blob.upload_from_string(txt_content)
 
     logging.info("Text uploaded to {}".format(destination_blob_name))
 
@@ -212,22 +227,46 @@ def translateAndRefine(event, context):
 
     start_time = time.time()
     if event.get('data'):
-        message_data = base64.b64decode(event['data']).decode('utf-8')
+        # Compressed payloads carry their encoding in the message attributes
+        content_encoding = (event.get('attributes') or {}).get('content_encoding')
+        message_data = decompress(base64.b64decode(event['data']), content_encoding).decode('utf-8')
         message = json.loads(message_data)
     else:
         raise ValueError('Data sector is missing in the Pub/Sub message.')
 
     it_text = message.get('text')
     doc_title = message.get('doc_title')
-    dest_bucket = 'aketari-covid19-data'
-
-    # Step 1: Call Translate API
-    raw_eng_text = doTranslation(translate_client,project_id, it_text)
+    dest_bucket = os.environ.get('DEST_BUCKET', 'aketari-covid19-data')
+
+    # Messages of the same pdf generation are processed once, a retry resumes from its last finished step
+    event_id = getattr(context, 'event_id', None)
+    ledger_uri = os.environ.get('LEDGER_URI')  # e.g datastore://ledger or gs://aketari-covid19-data/ledger
+    ledger = EventLedger(getLedgerBackend(storage_client, ledger_uri) if ledger_uri else None,
+                         'translate/{}/{}'.format(doc_title, message.get('generation') or event_id), event_id)
+    if not ledger.claim():
+        return
+
+    # Optional: local directory (e.g /tmp/profile) or gs://bucket/prefix receiving a profile of each step
+    profiler = StageProfiler(os.environ.get('PROFILE_URI'), 'translate/{}'.format(doc_title),
+                             storage_client=storage_client)
+
+    # Step 1: Call Translate API on the italian parts only, english parts are kept as is
+    def translationStep():
+        spans = splitLanguageSpans(it_text)
+        if documentLanguage(spans) == 'en':
+            return it_text
+        elif documentLanguage(spans) == 'it':
+            return doTranslation(translate_client, project_id, it_text)
+        return translateSpans(translate_client, project_id, spans)
+
+    with profiler.stage('translation'):
+        raw_eng_text = ledger.step('translation', translationStep)
     print("Completed translation step!")
     print('=============================')
 
     # Step 2: Clean eng text
-    curated_eng_text = cleanEngText(raw_eng_text)
+    with profiler.stage('curation'):
+        curated_eng_text = cleanEngText(raw_eng_text)
     print("Completed english curation step!")
     print('=============================')
 
@@ -240,23 +279,28 @@ def translateAndRefine(event, context):
     bucket_client = storage_client.get_bucket(dest_bucket)
     AES_bytes = bucket_client.blob(gcs_prefix_secret).download_as_string().encode('utf-8')
     base64_AES_bytes = base64.b64encode(AES_bytes)
-    redacted_text = deterministicDeidentifyWithFpe(dlp_client=dlp_client, parent=parent,
-                                                   text=text, info_types=INFO_TYPES,
-                                                   surrogate_type="REDACTED",
-                                                   b64encoded_bytes=base64_AES_bytes)
+    with profiler.stage('redaction'):
+        redacted_text = ledger.step('redaction', deterministicDeidentifyWithFpe, dlp_client=dlp_client,
+                                    parent=parent, text=text, info_types=INFO_TYPES, surrogate_type="REDACTED",
+                                    b64encoded_bytes=base64_AES_bytes)
 
     print("Completed redaction step!")
     print('=============================')
 
     # Step 4: Upload translated text
-    prefix_raw_eng_txt = 'eng_txt/{}.txt'.format(doc_title)
-    uploadBlob(storage_client, dest_bucket, raw_eng_text, prefix_raw_eng_txt)
-
-    prefix_curated_eng_txt = 'curated_eng_txt/{}.txt'.format(doc_title)
-    uploadBlob(storage_client, dest_bucket, curated_eng_text, prefix_curated_eng_txt)
-
-    prefix_redacted_eng_txt = 'redacted_raw_eng_txt/{}.txt'.format(doc_title)
-    uploadBlob(storage_client, dest_bucket, redacted_text, prefix_redacted_eng_txt)
+    with profiler.stage('upload'):
+        prefix_raw_eng_txt = 'eng_txt/{}.txt'.format(doc_title)
+        ledger.step('upload_eng_txt', uploadBlob, storage_client, dest_bucket, raw_eng_text, prefix_raw_eng_txt,
+                    compression=textCompression())
+
+        prefix_curated_eng_txt = 'curated_eng_txt/{}.txt'.format(doc_title)
+        ledger.step('upload_curated_eng_txt', uploadBlob, storage_client, dest_bucket, curated_eng_text,
+                    prefix_curated_eng_txt, compression=textCompression())
+
+        prefix_redacted_eng_txt = 'redacted_raw_eng_txt/{}.txt'.format(doc_title)
+        ledger.step('upload_redacted_raw_eng_txt', uploadBlob, storage_client, dest_bucket, redacted_text,
+                    prefix_redacted_eng_txt, compression=textCompression())
+    ledger.complete()
     print("Completed upload step!")
     print('=============================')
 
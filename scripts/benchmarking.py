@@ -0,0 +1,86 @@
+from google.cloud import storage
+from google.oauth2 import service_account
+from utils.preprocessing_fcn import compareJsonParsing
+from utils.ner_fcn import NER_PROFILES, benchmarkProfiles
+from utils.corpus_fcn import iterCorpus
+from utils.compression_fcn import downloadText
+import logging
+import argparse
+import os
+
+logging.getLogger().setLevel(logging.INFO)
+
+# Create the parser
+parser = argparse.ArgumentParser(description='Benchmark the stages of the pipeline on documents already processed.')
+subparsers = parser.add_subparsers(dest='benchmark')
+
+ocr_parser = subparsers.add_parser('ocr_parsing',
+                                   help='Compare the parsing of the Vision json outputs, time and peak memory.')
+ocr_parser.add_argument('--n_docs',
+                        type=int,
+                        default=20,
+                        help='Number of documents to parse.')
+ocr_parser.add_argument('--parser',
+                        choices=['protobuf', 'streaming'],
+                        default=None,
+                        help='Run a single parser, for an exact peak memory of the process. Both by default.')
+
+ner_parser = subparsers.add_parser('ner',
+                                   help='Compare the NER speed profiles, throughput and agreement with the full '
+                                        'profile.')
+ner_parser.add_argument('model_name',
+                        choices=['en_core_sci_sm', 'en_core_sci_lg', 'en_ner_bc5cdr_md'],
+                        help='Model options: en_core_sci_sm, en_core_sci_lg, en_ner_bc5cdr_md')
+ner_parser.add_argument('--profiles',
+                        nargs='+',
+                        choices=list(NER_PROFILES),
+                        default=list(NER_PROFILES),
+                        help='Speed profiles to compare with the full profile.')
+ner_parser.add_argument('--n_docs',
+                        type=int,
+                        default=20,
+                        help='Size of the sample, the first documents in alphabetical order.')
+ner_parser.add_argument('--corpus_path',
+                        type=str,
+                        default=None,
+                        help='Read the sample from a local corpus built by consolidating.py instead of GCS.')
+
+args = parser.parse_args()
+
+project_id = os.getenv('PROJECT_ID')
+bucket_name = os.getenv('BUCKET_NAME')
+key_path = os.getenv('SA_KEY_PATH')
+
+credentials = service_account.Credentials.from_service_account_file(key_path)
+
+storage_client = storage.Client(credentials=credentials)
+
+if args.benchmark == 'ocr_parsing':
+    lst_json_blobs = storage_client.list_blobs(bucket_or_name=bucket_name, prefix='json')
+    doc_titles = sorted({blob.name.split('/')[-1].split('-')[0] for blob in lst_json_blobs})[:args.n_docs]
+
+    parsers = [args.parser] if args.parser else ['protobuf', 'streaming']
+    results = compareJsonParsing(storage_client, bucket_name, doc_titles, parsers=parsers)
+    for name, result in results.items():
+        print('{:<10} {:>8} s {:>8} MB python peak {:>8} MB rss growth {:>8} docs/s'.format(
+            name, result['seconds'], result['python_peak_mb'], result['rss_growth_mb'], result['docs_per_second']))
+elif args.benchmark == 'ner':
+    # Fixed sample of curated english text, the same for every profile
+    if args.corpus_path:
+        docs = [(row['case'], row['eng_txt']) for row in iterCorpus(args.corpus_path, columns=['case', 'eng_txt'])]
+    else:
+        lst_curated_blobs = storage_client.list_blobs(bucket_or_name=bucket_name, prefix='curated_eng_txt')
+        docs = [(blob.name.split('/')[-1].split('.')[0], blob) for blob in lst_curated_blobs
+                if blob.name.endswith('.txt')]
+    docs = sorted(docs, key=lambda doc: doc[0])[:args.n_docs]
+    docs = [(doc_title, text if isinstance(text, str) else downloadText(text)) for doc_title, text in docs]
+
+    results = benchmarkProfiles(args.model_name, docs, profiles=args.profiles)
+    print('{:<12} {:>8} {:>10} {:>9} {:>8} {:>8}'.format('profile', 'docs/s', 'entities', 'span_f1', 'cui_f1',
+                                                         'speedup'))
+    for profile, result in results.items():
+        print('{:<12} {:>8} {:>10} {:>9} {:>8} {:>8}'.format(
+            profile, result['docs_per_second'], result['n_entities'], result['span_f1'], result['cui_f1'],
+            round(result['docs_per_second'] / results['full']['docs_per_second'], 2)))
+else:
+    parser.print_help()
@@ -0,0 +1,39 @@
+from google.cloud import storage
+from google.oauth2 import service_account
+from utils.corpus_fcn import buildCorpus, exportCorpusParquet
+import logging
+import argparse
+import os
+
+logging.getLogger().setLevel(logging.INFO)
+
+# Create the parser
+parser = argparse.ArgumentParser(description='Consolidate the outputs of all stages into a local columnar corpus.')
+
+parser.add_argument('corpus_path',
+                    metavar='path',
+                    type=str,
+                    help='Local Arrow file to create or update, e.g ./content/corpus.arrow')
+parser.add_argument('--parquet_path',
+                    type=str,
+                    default=None,
+                    help='Also export the corpus to this Parquet file.')
+parser.add_argument('--workers',
+                    type=int,
+                    default=16,
+                    help='Number of concurrent downloads.')
+
+args = parser.parse_args()
+
+project_id = os.getenv('PROJECT_ID')
+bucket_name = os.getenv('BUCKET_NAME')
+key_path = os.getenv('SA_KEY_PATH')
+
+credentials = service_account.Credentials.from_service_account_file(key_path)
+
+storage_client = storage.Client(credentials=credentials)
+
+buildCorpus(storage_client, bucket_name, args.corpus_path, max_workers=args.workers)
+
+if args.parquet_path:
+    exportCorpusParquet(args.corpus_path, args.parquet_path)
@@ -1,18 +1,40 @@
 from google.cloud import storage, vision
 from google.oauth2 import service_account
-from utils.preprocessing_fcn import asyncDetectDocument, readJsonResult, uploadBlob
+from utils.preprocessing_fcn import readJsonResultStreaming, uploadBlob
+from utils.cache_fcn import OCRCache, getCacheBackend, cachedDocumentOCR
+from utils.boilerplate_fcn import loadBoilerplate, saveBoilerplate
+from utils.cpu_fcn import mapTexts
+from utils.ocr_fcn import OCRPlanner
+from utils.profiling_fcn import StageProfiler
 
 import logging
 
 logging.getLogger().setLevel(logging.INFO)
 
+import argparse
 import time
 import os
 
+# Create the parser
+parser = argparse.ArgumentParser(description='Extract the raw text of the pdf documents.')
+parser.add_argument('--ocr_range_pages',
+                    type=int,
+                    default=100,
+                    help='Pdfs above this number of pages are OCR\'d as page ranges of at most that size, in parallel.')
+parser.add_argument('--profile',
+                    type=str,
+                    default=None,
+                    help='Local directory or gs://bucket/prefix receiving a cProfile and memory report per stage.')
+args = parser.parse_args()
+
 project_id = os.getenv('PROJECT_ID')
 bucket_name = os.getenv('BUCKET_NAME')
 location = os.getenv('LOCATION')
 key_path = os.getenv('SA_KEY_PATH')
+# Optional: local directory or gs://bucket/prefix holding the content-addressed OCR cache
+ocr_cache_uri = os.getenv('OCR_CACHE_URI')
+# Optional: local directory or gs://bucket/prefix holding the boilerplate learned from the corpus
+boilerplate_uri = os.getenv('BOILERPLATE_URI')
 
 credentials = service_account.Credentials.from_service_account_file(key_path)
 
@@ -20,43 +42,90 @@ storage_client = storage.Client(credentials=credentials)
 
 vision_client = vision.ImageAnnotatorClient(credentials=credentials)
 
+profiler = StageProfiler(args.profile, 'extraction', storage_client=storage_client)
+
+# Output shards and timeouts sized from the page count of each pdf
+ocr_planner = OCRPlanner(storage_client, max_range_pages=args.ocr_range_pages)
+
 lst_pdf_blobs = storage_client.list_blobs(bucket_or_name=bucket_name,
                                           prefix='pdf')
 
-lst_json_blobs = storage_client.list_blobs(bucket_or_name=bucket_name,
-                                           prefix='json')
+# key: doc_title and value: raw text, uploaded once the boilerplate of the corpus is known
+raw_texts = {}
 
-start_time = time.time()
-for blob in lst_pdf_blobs:
-    doc_title = blob.name.split('/')[-1].split('.pdf')[0]
+if ocr_cache_uri:
+    ocr_cache = OCRCache(getCacheBackend(storage_client, ocr_cache_uri))
 
-    # Generate all paths
-    gcs_source_path = 'gs://' + bucket_name + '/' + blob.name
-    json_gcs_dest_path = 'gs://' + bucket_name + '/json/' + doc_title + '-'
+    # OCR and parsing happen in one pass: cached documents and pages never reach Vision
+    with profiler.stage('ocr'):
+        start_time = time.time()
+        for blob in lst_pdf_blobs:
+            doc_title = blob.name.split('/')[-1].split('.pdf')[0]
 
-    # OCR pdf documents
-    asyncDetectDocument(vision_client,
-                        gcs_source_path,
-                        json_gcs_dest_path)
-total_time = time.time() - start_time
-logging.info("Vision API successfully completed OCR of all documents on {} minutes".format(round(total_time / 60, 1)))
+            gcs_source_path = 'gs://' + bucket_name + '/' + blob.name
 
-# Extracting the text now
-start_time = time.time()
-for blob in lst_json_blobs:
-    doc_title = blob.name.split('/')[-1].split('-')[0]
+            raw_texts[doc_title] = cachedDocumentOCR(vision_client=vision_client, storage_client=storage_client,
+                                         ocr_cache=ocr_cache, ocr_fcn=ocr_planner,
+                                         gcs_source_uri=gcs_source_path, bucket_name=bucket_name,
+                                         doc_title=doc_title)
+        total_time = time.time() - start_time
+        logging.info("OCR and parsing of all documents completed on {} minutes".format(round(total_time / 60, 1)))
+        ocr_cache.logStats()
 
-    # Define GCS paths
-    # json_gcs_dest_path = 'gs://' + bucket_name + '/{}'.format(blob.name)
-    txt_gcs_dest_path = 'gs://' + bucket_name + '/raw_txt/' + doc_title + '.txt'
+else:
+    lst_json_blobs = storage_client.list_blobs(bucket_or_name=bucket_name,
+                                               prefix='json')
 
-    # Parse json
-    all_text = readJsonResult(storage_client=storage_client, bucket_name=bucket_name, doc_title=doc_title)
+    with profiler.stage('ocr'):
+        start_time = time.time()
+        for blob in lst_pdf_blobs:
+            doc_title = blob.name.split('/')[-1].split('.pdf')[0]
 
-    # Upload raw text to GCS
-    uploadBlob(storage_client=storage_client, bucket_name=bucket_name,
-               txt_content=all_text, destination_blob_name=txt_gcs_dest_path)
+            # Generate all paths
+            gcs_source_path = 'gs://' + bucket_name + '/' + blob.name
+            json_gcs_dest_path = 'gs://' + bucket_name + '/json/' + doc_title + '-'
 
-total_time = time.time() - start_time
-logging.info(
-    'Successful parsing of all documents resulting from Vision API on {} minutes'.format(round(total_time / 60, 1)))
+            # OCR pdf documents
+            ocr_planner(vision_client,
+                        gcs_source_path,
+                        json_gcs_dest_path)
+        total_time = time.time() - start_time
+        logging.info("Vision API successfully completed OCR of all documents on {} minutes".format(
+            round(total_time / 60, 1)))
+
+    # Extracting the text now
+    with profiler.stage('json_parsing'):
+        start_time = time.time()
+        for blob in lst_json_blobs:
+            doc_title = blob.name.split('/')[-1].split('-')[0]
+            # All the json shards of a document are parsed at once
+            if doc_title in raw_texts:
+                continue
+
+            # Parse json
+            raw_texts[doc_title] = readJsonResultStreaming(storage_client=storage_client, bucket_name=bucket_name,
+                                                           doc_title=doc_title)
+
+        total_time = time.time() - start_time
+        logging.info('Successful parsing of all documents resulting from Vision API on {} minutes'.format(
+            round(total_time / 60, 1)))
+
+if boilerplate_uri:
+    # Strip headers, footers and text repeated across documents before they reach Translate, DLP and NER
+    with profiler.stage('boilerplate'):
+        boilerplate_detector = loadBoilerplate(storage_client, boilerplate_uri)
+        boilerplate_detector.fit(list(raw_texts.values()))
+        saveBoilerplate(storage_client, boilerplate_uri, boilerplate_detector)
+        # Stripping runs on all cores, the statistics are gathered here as the workers only hold copies of the detector
+        stripped_texts = mapTexts(boilerplate_detector.strip, list(raw_texts.values()))
+        boilerplate_detector.chars_in = sum(len(all_text) for all_text in raw_texts.values())
+        boilerplate_detector.chars_removed = boilerplate_detector.chars_in - sum(len(text) for text in stripped_texts)
+        raw_texts = dict(zip(raw_texts, stripped_texts))
+        boilerplate_detector.logStats()
+
+with profiler.stage('upload'):
+    for doc_title, all_text in raw_texts.items():
+        # Upload raw text to GCS
+        txt_gcs_dest_path = 'gs://' + bucket_name + '/raw_txt/' + doc_title + '.txt'
+        uploadBlob(storage_client=storage_client, bucket_name=bucket_name,
+                   txt_content=all_text, destination_blob_name=txt_gcs_dest_path)
@@ -0,0 +1,155 @@
+from google.cloud import storage, vision, translate, bigquery, datastore
+from google.oauth2 import service_account
+from utils.preprocessing_fcn import readJsonResultStreaming, uploadBlob, batch_translate_text, \
+    cleanEngText, customize_stop_words
+from utils.bq_fcn import bqCreateDataset, bqCreateTable, mergeRows2BQ
+from utils.ner_fcn import importModel, loadModel, annotateCorpus, compactEntities, addTask
+from utils.pipeline_fcn import Stage, runPipeline
+from utils.lang_fcn import splitLanguageSpans, documentLanguage, translateSpans
+from utils.compression_fcn import downloadText, textCompression
+from utils.boilerplate_fcn import loadBoilerplate
+from utils.ocr_fcn import OCRPlanner
+import pandas as pd
+import logging
+import argparse
+import os
+
+logging.getLogger().setLevel(logging.INFO)
+
+# Create the parser
+parser = argparse.ArgumentParser(description='Run OCR, parsing, translation, curation, storage and NER as a '
+                                             'pipeline: each document moves on as soon as its previous stage is done.')
+
+model_choices = ['en_core_sci_sm', 'en_core_sci_lg', 'en_ner_bc5cdr_md']
+parser.add_argument('model_name',
+                    metavar='name',
+                    type=str,
+                    choices=model_choices,
+                    help='Model options: en_core_sci_sm, en_core_sci_lg, en_ner_bc5cdr_md')
+parser.add_argument('--ocr_workers', type=int, default=4,
+                    help='Number of documents OCR\'d concurrently.')
+parser.add_argument('--translate_workers', type=int, default=4,
+                    help='Number of documents translated concurrently.')
+parser.add_argument('--io_workers', type=int, default=4,
+                    help='Number of workers for the parsing, curation and storage stages.')
+parser.add_argument('--ner_profile', choices=['full', 'fast', 'linker-lite'], default='full',
+                    help='Speed profile of the NER, see benchmarking.py ner to compare them.')
+parser.add_argument('--queue_size', type=int, default=8,
+                    help='Maximum number of documents waiting in front of each stage.')
+
+args = parser.parse_args()
+
+project_id = os.getenv('PROJECT_ID')
+bucket_name = os.getenv('BUCKET_NAME')
+location = os.getenv('LOCATION')
+key_path = os.getenv('SA_KEY_PATH')
+dataset_name = os.getenv('BQ_DATASET_NAME')
+table_name = os.getenv('BQ_TABLE_NAME')
+# raw_txt stays uncompressed, it is read by the batch translation
+text_compression = textCompression()
+
+credentials = service_account.Credentials.from_service_account_file(key_path)
+
+storage_client = storage.Client(credentials=credentials)
+vision_client = vision.ImageAnnotatorClient(credentials=credentials)
+translate_client = translate.TranslationServiceClient(credentials=credentials)
+bq_client = bigquery.Client(credentials=credentials)
+datastore_client = datastore.Client(credentials=credentials)
+
+# Large pdfs are split into page ranges OCR'd in parallel, the timeouts scale with the page count
+ocr_planner = OCRPlanner(storage_client)
+
+dataset_id = bqCreateDataset(bq_client, dataset_name)
+table_id = bqCreateTable(bq_client, dataset_id, table_name)
+
+# Optional: boilerplate learned by extraction.py, stripped before translation
+boilerplate_uri = os.getenv('BOILERPLATE_URI')
+boilerplate_detector = loadBoilerplate(storage_client, boilerplate_uri) if boilerplate_uri else None
+
+nlp, linker = loadModel(model=importModel(args.model_name), profile=args.ner_profile)
+df_reference_TUIs = pd.read_csv('./scripts/utils/UMLS_tuis.csv')
+tui_categories = dict(zip(df_reference_TUIs['TUIs'], df_reference_TUIs['Categories']))
+
+
+def ocrStage(doc):
+    json_gcs_dest_path = 'gs://' + bucket_name + '/json/' + doc['doc_title'] + '-'
+    ocr_planner(vision_client, doc['gcs_source_path'], json_gcs_dest_path)
+    return doc
+
+
+def parseStage(doc):
+    doc['it_raw_txt'] = readJsonResultStreaming(storage_client=storage_client, bucket_name=bucket_name,
+                                                doc_title=doc['doc_title'])
+    if boilerplate_detector is not None:
+        doc['it_raw_txt'] = boilerplate_detector.strip(doc['it_raw_txt'])
+    txt_gcs_dest_path = 'gs://' + bucket_name + '/raw_txt/' + doc['doc_title'] + '.txt'
+    uploadBlob(storage_client=storage_client, bucket_name=bucket_name,
+               txt_content=doc['it_raw_txt'], destination_blob_name=txt_gcs_dest_path)
+    return doc
+
+
+def translateStage(doc):
+    doc_title = doc['doc_title']
+    blob_prefix = 'eng_txt/{}/{}_raw_txt_{}_en_translations.txt'.format(doc_title, bucket_name, doc_title)
+    spans = splitLanguageSpans(doc['it_raw_txt'])
+    if documentLanguage(spans) != 'it':
+        # English or mixed documents: only italian paragraphs go to the API. The english text is written where the
+        # batch translation writes it, for populateBQ and the later rebuilds
+        doc['eng_raw_txt'] = translateSpans(translate_client, project_id, spans)
+        uploadBlob(storage_client=storage_client, bucket_name=bucket_name, txt_content=doc['eng_raw_txt'],
+                   destination_blob_name=blob_prefix, compression=text_compression)
+        return doc
+
+    batch_translate_text(translate_client=translate_client,
+                         project_id=project_id,
+                         input_uri='gs://' + bucket_name + '/raw_txt/' + doc_title + '.txt',
+                         output_uri='gs://' + bucket_name + '/eng_txt/{}/'.format(doc_title))
+    eng_blob = storage_client.bucket(bucket_name).get_blob(blob_prefix)
+    doc['eng_raw_txt'] = downloadText(eng_blob)
+    return doc
+
+
+def cleanStage(doc):
+    doc['eng_txt'] = cleanEngText(doc['eng_raw_txt'], customize_stop_words)
+    processed_eng_gcs_dest_path = 'gs://' + bucket_name + '/curated_eng_txt/' + doc['doc_title'] + '.txt'
+    uploadBlob(storage_client=storage_client, bucket_name=bucket_name, txt_content=doc['eng_txt'],
+               destination_blob_name=processed_eng_gcs_dest_path, compression=text_compression)
+    return doc
+
+
+def storeStage(doc):
+    mergeRows2BQ(bq_client, dataset_id, table_id, [{'case': doc['doc_title'],
+                                                    'it_raw_txt': doc['it_raw_txt'],
+                                                    'eng_raw_txt': doc['eng_raw_txt'],
+                                                    'eng_txt': doc['eng_txt']}])
+    return doc
+
+
+def nerStage(doc):
+    # Long documents are sharded to stay under nlp.max_length, an empty text has no shard and no entity
+    results = dict(annotateCorpus(nlp, linker, [(doc['doc_title'], doc['eng_txt'])]))
+    entities_dict, unindexed = compactEntities(results.get(doc['doc_title'], []), tui_categories)
+    addTask(datastore_client, doc['doc_title'], entities_dict, exclude_from_indexes=unindexed)
+    return doc
+
+
+# OCR -> parse -> translate -> clean -> {store, ner}
+stages = [Stage('ocr', ocrStage, n_workers=args.ocr_workers, queue_size=args.queue_size, next_stages=['parse']),
+          Stage('parse', parseStage, n_workers=args.io_workers, queue_size=args.queue_size,
+                next_stages=['translate']),
+          Stage('translate', translateStage, n_workers=args.translate_workers, queue_size=args.queue_size,
+                next_stages=['clean']),
+          Stage('clean', cleanStage, n_workers=args.io_workers, queue_size=args.queue_size,
+                next_stages=['store', 'ner']),
+          # MERGE statements on the same table are serialized by BigQuery anyway
+          Stage('store', storeStage, n_workers=1, queue_size=args.queue_size),
+          # The model is not thread safe, a single worker owns it
+          Stage('ner', nerStage, n_workers=1, queue_size=args.queue_size)]
+
+docs = ({'doc_title': blob.name.split('/')[-1].split('.pdf')[0],
+         'gcs_source_path': 'gs://' + bucket_name + '/' + blob.name}
+        for blob in storage_client.list_blobs(bucket_or_name=bucket_name, prefix='pdf'))
+
+runPipeline(stages, docs)
+if boilerplate_detector is not None:
+    boilerplate_detector.logStats()
@@ -1,17 +1,45 @@
 from google.cloud import storage, translate
 from google.oauth2 import service_account
-from utils.preprocessing_fcn import batch_translate_text, upload_blob
+from utils.preprocessing_fcn import batch_translate_text, bulk_batch_translate_text, uploadBlob, cleanEngText, \
+    customize_stop_words
+from utils.lang_fcn import splitLanguageSpans, documentLanguage, translateSpans
+from utils.compression_fcn import downloadText, textCompression
+from utils.cpu_fcn import mapTexts
+from utils.profiling_fcn import StageProfiler
 import logging
 logging.getLogger().setLevel(logging.INFO)
 
-import re
+import argparse
 import time
 import os
 
+# Create the parser
+parser = argparse.ArgumentParser(description='Translate and curate the raw text of all documents.')
+parser.add_argument('--bulk',
+                    action='store_true',
+                    help='Translate all pending documents in as few batch operations as possible.')
+parser.add_argument('--curate_only',
+                    action='store_true',
+                    help='Skip the translation, only curate again the english text, e.g after changing the stop words.')
+parser.add_argument('--workers',
+                    type=int,
+                    default=None,
+                    help='Number of processes curating the text, default to the number of cores.')
+parser.add_argument('--chunk_size',
+                    type=int,
+                    default=16,
+                    help='Number of documents handed to a curation process at once.')
+parser.add_argument('--profile',
+                    type=str,
+                    default=None,
+                    help='Local directory or gs://bucket/prefix receiving a cProfile and memory report per stage.')
+args = parser.parse_args()
+
 project_id = os.getenv('PROJECT_ID')
 bucket_name = os.getenv('BUCKET_NAME')
 location = os.getenv('LOCATION')
 key_path = os.getenv('SA_KEY_PATH')
+text_compression = textCompression()
 
 credentials = service_account.Credentials.from_service_account_file(key_path)
 
@@ -19,72 +47,94 @@ storage_client = storage.Client(credentials=credentials)
 
 translate_client = translate.TranslationServiceClient(credentials=credentials)
 
-lst_raw_txt_blobs = storage_client.list_blobs(bucket_or_name=bucket_name,
-                                           prefix='raw_txt')
-
-customize_stop_words = [
-    'uoc', 'diagnostic', 'interventional', 'radiology', 'madonna', 'delle', 'grazie', 'hospital',
-    'Borgheresi', 'Agostini', 'Ottaviani', 'Floridi', 'Giovagnoni', 'di', 'specialization',
-    'Polytechnic', 'University', 'marche', 'ANCONA', 'Italy', 'Azienda', 'Ospedali',
-    'Riuniti', 'Yorrette', 'Matera', 'Michele', 'Nardella', 'Gerardo', 'Costanzo',
-    'Claudia', 'Lopez', 'st', 'a.', 'a', 'of', 's', 'cien', 'ze', 'diolog', 'ic', 'he',
-    'â', '€', 's', 'b', 'case', 'Cuoladi', 'l', 'c', 'ra', 'bergamo', 'patelli', 'est', 'asst',
-    'dr', 'Dianluigi', 'Svizzero', 'i', 'riccardo', 'Alessandro', 'Spinazzola', 'angelo',
-    'maggiore', 'p', 'r', 't', 'm', 'en', 't', 'o', 'd', 'e', 'n', 'd', 'o', 'g', 'h', 'u',
-    'man', 'female', 'D'
-]
+profiler = StageProfiler(args.profile, 'preprocessing', storage_client=storage_client)
+
+lst_raw_txt_blobs = list(storage_client.list_blobs(bucket_or_name=bucket_name,
+                                                prefix='raw_txt'))
 
 start_time = time.time()
-for blob in lst_raw_txt_blobs:
-    doc_title = blob.name.split('/')[-1].split('.')[0]
-
-    txt_gcs_dest_path = 'gs://' + bucket_name + '/raw_txt/' + doc_title + '.txt'
-    eng_txt_gcs_dest_path = 'gs://' + bucket_name + '/eng_txt/{}/'.format(doc_title)
-    processed_eng_gcs_dest_path = 'gs://' + bucket_name + '/curated_eng_txt/' + doc_title + '.txt'
-
-    # Translateba raw text to english
-    try:
-        batch_translate_text(translate_client=translate_client,
-                             project_id=project_id,
-                             input_uri=txt_gcs_dest_path,
-                             output_uri=eng_txt_gcs_dest_path)
-        logging.info("Translation of {} document was successful.".format(doc_title))
-    except Exception as e:
-        logging.error("Error", e)
-
-    # Curate eng raw text
-    blob_prefix = 'eng_txt/{}/{}_raw_txt_{}_en_translations.txt'.format(doc_title,
-                                                                        bucket_name,
-                                                                        doc_title)
-
-    eng_blob = storage_client.get_bucket(bucket_name).get_blob(blob_prefix)
-    eng_raw_string = eng_blob.download_as_string().decode('utf-8')
-
-    # Remove dates
-    # 1 or 2 digit number followed by back slash followed by 1 or 2 digit number ...
-    pattern_dates = '(\d{1,2})/(\d{1,2})/(\d{4})'
-    pattern_fig = 'Figure (\d{1,2})'
-    pattern_image = '^Image .$'
-    replace = ''
-
-    eng_raw_string = re.sub(pattern_dates, replace, eng_raw_string)
-    eng_raw_string = re.sub(pattern_fig, replace, eng_raw_string)
-    eng_raw_string = re.sub(pattern_image, replace, eng_raw_string)
-
-    # remove punctuation and special characters
-    eng_raw_string = re.sub('[^A-Za-z0-9]+', ' ', eng_raw_string)
-
-    # Remove custom stop words
-    tokens = [token for token in eng_raw_string.split() if token not in customize_stop_words]
-
-    refined_doc = ''
-    for word in tokens:
-        refined_doc += ' {}'.format(word)
-
-    # Upload raw text to GCS
-    upload_blob(storage_client=storage_client, bucket_name=bucket_name, txt_content=refined_doc,
-                destination_blob_name=processed_eng_gcs_dest_path)
-    logging.info("The curation of {} text completed successfully.".format(doc_title))
+
+if not args.curate_only:
+    with profiler.stage('translation'):
+        # Route each document by language: english text is kept as is, mixed documents only have their italian
+        # paragraphs translated and fully italian documents go through batch translation
+        bucket_client = storage_client.bucket(bucket_name)
+        italian_doc_titles = []
+        for blob in lst_raw_txt_blobs:
+            doc_title = blob.name.split('/')[-1].split('.')[0]
+            eng_blob_name = 'eng_txt/{}/{}_raw_txt_{}_en_translations.txt'.format(doc_title,
+                                                                                  bucket_name,
+                                                                                  doc_title)
+            # In bulk mode, only the documents without an english version are pending
+            if args.bulk and bucket_client.get_blob(eng_blob_name) is not None:
+                continue
+
+            spans = splitLanguageSpans(downloadText(blob))
+            doc_lang = documentLanguage(spans)
+            if doc_lang == 'it':
+                italian_doc_titles.append(doc_title)
+                continue
+            elif doc_lang == 'en':
+                eng_raw_string = ''.join(span for _, span in spans)
+            else:
+                eng_raw_string = translateSpans(translate_client, project_id, spans)
+            uploadBlob(storage_client=storage_client, bucket_name=bucket_name, txt_content=eng_raw_string,
+                       destination_blob_name=eng_blob_name, compression=text_compression)
+            logging.info("Language of {} is {}, its italian parts were translated.".format(doc_title, doc_lang))
+
+        if args.bulk:
+            # Translate every italian document without an english version in one go
+            translated_docs = bulk_batch_translate_text(translate_client=translate_client,
+                                                        storage_client=storage_client,
+                                                        project_id=project_id,
+                                                        bucket_name=bucket_name,
+                                                        doc_titles=italian_doc_titles)
+            logging.info("Bulk translation of {}/{} pending documents was successful.".format(len(translated_docs),
+                                                                                              len(italian_doc_titles)))
+        else:
+            for doc_title in italian_doc_titles:
+                txt_gcs_dest_path = 'gs://' + bucket_name + '/raw_txt/' + doc_title + '.txt'
+                eng_txt_gcs_dest_path = 'gs://' + bucket_name + '/eng_txt/{}/'.format(doc_title)
+
+                # Translateba raw text to english
+                try:
+                    batch_translate_text(translate_client=translate_client,
+                                         project_id=project_id,
+                                         input_uri=txt_gcs_dest_path,
+                                         output_uri=eng_txt_gcs_dest_path)
+                    logging.info("Translation of {} document was successful.".format(doc_title))
+                except Exception as e:
+                    logging.error("Error", e)
+
+# Download the english text of all documents, the curation then runs on all cores
+with profiler.stage('download'):
+    eng_docs = []
+    for blob in lst_raw_txt_blobs:
+        doc_title = blob.name.split('/')[-1].split('.')[0]
+
+        # Curate eng raw text
+        blob_prefix = 'eng_txt/{}/{}_raw_txt_{}_en_translations.txt'.format(doc_title,
+                                                                            bucket_name,
+                                                                            doc_title)
+
+        eng_blob = storage_client.get_bucket(bucket_name).get_blob(blob_prefix)
+        if eng_blob is None:
+            logging.error("No english translation found for {}, skipping curation.".format(doc_title))
+            continue
+        eng_docs.append((doc_title, downloadText(eng_blob)))
+
+with profiler.stage('curation'):
+    refined_docs = mapTexts(cleanEngText, [eng_raw_string for _, eng_raw_string in eng_docs], n_workers=args.workers,
+                            chunk_size=args.chunk_size, customize_stop_words=customize_stop_words)
+
+with profiler.stage('upload'):
+    for (doc_title, _), refined_doc in zip(eng_docs, refined_docs):
+        processed_eng_gcs_dest_path = 'gs://' + bucket_name + '/curated_eng_txt/' + doc_title + '.txt'
+
+        # Upload raw text to GCS
+        uploadBlob(storage_client=storage_client, bucket_name=bucket_name, txt_content=refined_doc,
+                   destination_blob_name=processed_eng_gcs_dest_path, compression=text_compression)
+        logging.info("The curation of {} text completed successfully.".format(doc_title))
 
 total_time = time.time() - start_time
 logging.info('The translation and curation of all documents was successfully completed in {} minutes.'.format(
@@ -0,0 +1,108 @@
+import google.cloud.dlp
+from google.oauth2 import service_account
+from utils.DLP_fcn import batchDeidentifyWithFpe
+from utils.compression_fcn import textCompression
+from utils.storage_fcn import getStorage
+import logging
+import argparse
+import os
+import time
+
+logging.getLogger().setLevel(logging.INFO)
+
+# Stage outputs to redact: GCS prefix of the text and prefix of its redacted version
+REDACTED_PREFIXES = {'raw_txt': 'redacted_raw_txt',
+                     'eng_txt': 'redacted_raw_eng_txt',
+                     'curated_eng_txt': 'redacted_curated_eng_txt'}
+
+INFO_TYPES = ["FIRST_NAME", "LAST_NAME", "FEMALE_NAME", "MALE_NAME",
+              "PERSON_NAME", "STREET_ADDRESS", "ITALY_FISCAL_CODE"]
+
+# Create the parser
+parser = argparse.ArgumentParser(description='Redact the text outputs in bulk, many documents per DLP request.')
+
+parser.add_argument('--prefixes',
+                    nargs='+',
+                    choices=list(REDACTED_PREFIXES),
+                    default=list(REDACTED_PREFIXES),
+                    help='Stage outputs to redact.')
+parser.add_argument('--max_bytes',
+                    type=int,
+                    default=450000,
+                    help='Maximum size of the text sent per DLP request.')
+parser.add_argument('--overwrite',
+                    action='store_true',
+                    help='Redact again the documents already redacted.')
+
+args = parser.parse_args()
+
+project_id = os.getenv('PROJECT_ID')
+bucket_name = os.getenv('BUCKET_NAME')
+key_path = os.getenv('SA_KEY_PATH')
+# Base64-encoded AES-256 key used by the Format Preserving Encryption
+aes_key = os.getenv('DLP_AES_KEY')
+
+credentials = service_account.Credentials.from_service_account_file(key_path)
+
+storage_client = getStorage(os.getenv('STORAGE_URI'), credentials=credentials)
+dlp_client = google.cloud.dlp_v2.DlpServiceClient(credentials=credentials)
+parent = "projects/{}".format(project_id)
+text_compression = textCompression()
+
+
+def redactGroup(group):
+    """
+    Redact a group of documents and upload them, so that a failed DLP call only loses its own group.
+    Args:
+        group: list - (dest_name, text) tuples
+
+    Returns:
+        n_failed: int - number of documents left unredacted
+    """
+    try:
+        redacted_texts = batchDeidentifyWithFpe(dlp_client=dlp_client, parent=parent,
+                                                texts=[text for _, text in group], info_types=INFO_TYPES,
+                                                surrogate_type="REDACTED", wrapped_key=aes_key,
+                                                max_bytes=args.max_bytes)
+    except Exception as e:
+        logging.error('Redaction of {} failed, they are redacted by the next run: {}'.format(
+            ', '.join(dest_name for dest_name, _ in group), e))
+        return len(group)
+
+    for (dest_name, _), redacted_text in zip(group, redacted_texts):
+        storage_client.writeBytes(bucket_name, dest_name, redacted_text, content_type='text/plain; charset=utf-8',
+                                  content_encoding=text_compression)
+    return 0
+
+
+start_time = time.time()
+src_names = []
+for prefix in args.prefixes:
+    redacted_names = set(storage_client.listNames(bucket_name, prefix=REDACTED_PREFIXES[prefix] + '/'))
+    for blob_name in storage_client.listNames(bucket_name, prefix=prefix + '/'):
+        # Skip the temporary outputs of the bulk translation
+        if not blob_name.endswith('.txt') or any(part.startswith('_') for part in blob_name.split('/')):
+            continue
+        dest_name = REDACTED_PREFIXES[prefix] + blob_name[len(prefix):]
+        if args.overwrite or dest_name not in redacted_names:
+            src_names.append((blob_name, dest_name))
+
+# Documents are read and redacted by groups of about max_bytes, only one group is held in memory
+n_failed = 0
+group = []
+group_bytes = 0
+for blob_name, dest_name in src_names:
+    text = storage_client.readText(bucket_name, blob_name)
+    text_bytes = len(text.encode('utf-8'))
+    if group and group_bytes + text_bytes > args.max_bytes:
+        n_failed += redactGroup(group)
+        group = []
+        group_bytes = 0
+    group.append((dest_name, text))
+    group_bytes += text_bytes
+if group:
+    n_failed += redactGroup(group)
+
+total_time = time.time() - start_time
+logging.info('Redaction of {} documents took {} seconds, {} failed.'.format(len(src_names), round(total_time, 1),
+                                                                          n_failed))
@@ -1,6 +1,6 @@
 from google.cloud import storage, bigquery, datastore
 from google.oauth2 import service_account
-from utils.bq_fcn import returnQueryResults, constructQuery
+from utils.bq_fcn import returnQueryResults, constructQuery, queryCases, QueryResultCache
 from utils.ner_fcn import getCases
 import os
 import logging
@@ -33,6 +33,20 @@ try:
 except Exception as e:
     logging.error("Error", e)
 
+try:
+    # Many cases are fetched with a single parameterized query, repeated lookups are served from the cache
+    query_cache = QueryResultCache()
+    for _ in range(2):
+        results_lst = list(queryCases(bq_client, case_ids=['case23', case_id], column_lst=['case', 'eng_txt'],
+                                      cache=query_cache))
+    logging.info("Here is the result of the batched BigQuery test case ({} cache hits): \n".format(query_cache.hits))
+    logging.info("======================================START======================================")
+    logging.info(results_lst)
+    logging.info("======================================FINISH======================================")
+
+except Exception as e:
+    logging.error("Error", e)
+
 try:
     filter_dict = {'Disease or Syndrome': ['heart failure']}
     results = getCases(datastore_client, filter_dict, limit=10)
@@ -43,5 +57,13 @@ try:
 except Exception as e:
     logging.error("Error", e)
 
-
-
+try:
+    # Multi-criteria lookups are planned as concurrent keys-only queries intersected client-side
+    filter_dict = {'Disease or Syndrome': ['heart failure', 'pneumonia']}
+    results = getCases(datastore_client, filter_dict, limit=10)
+    logging.info("Here is the result of the multi-criteria Datastore test case: \n")
+    logging.info("======================================START======================================")
+    logging.info(results)
+    logging.info("======================================FINISH======================================")
+except Exception as e:
+    logging.error("Error", e)
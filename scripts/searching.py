@@ -0,0 +1,112 @@
+from google.cloud import storage, datastore
+from google.oauth2 import service_account
+from utils.search_fcn import SearchIndex, buildSearchIndex
+from utils.similarity_fcn import CaseSimilarityIndex, buildSimilarityIndex
+import logging
+import argparse
+import os
+import time
+
+logging.getLogger().setLevel(logging.INFO)
+
+# Create the parser
+parser = argparse.ArgumentParser(description='Full-text search over the curated english text of the cases.')
+subparsers = parser.add_subparsers(dest='command')
+
+build_parser = subparsers.add_parser('build', help='Create or update the search index.')
+build_parser.add_argument('--corpus_path',
+                          type=str,
+                          default=None,
+                          help='Read the text from a local corpus built by consolidating.py instead of GCS.')
+
+query_parser = subparsers.add_parser('query', help='Search the index, quoted parts are phrases.')
+query_parser.add_argument('query',
+                          type=str,
+                          help='e.g \'ground glass "bilateral pneumonia"\'')
+query_parser.add_argument('-k',
+                          type=int,
+                          default=10,
+                          help='Number of results.')
+
+build_similar_parser = subparsers.add_parser('build_similar',
+                                             help='Create or update the similar-case index, text and UMLS entities.')
+build_similar_parser.add_argument('--corpus_path',
+                                  type=str,
+                                  default=None,
+                                  help='Read the text from a local corpus built by consolidating.py instead of GCS.')
+build_similar_parser.add_argument('--entity_prefix',
+                                  type=str,
+                                  default='',
+                                  help='Read the entities of one model, e.g en_core_sci_sm: for a multi-model run.')
+build_similar_parser.add_argument('--refit',
+                                  action='store_true',
+                                  help='Recompute the vocabulary and weights on all cases.')
+
+similar_parser = subparsers.add_parser('similar', help='Find the cases most similar to indexed cases.')
+similar_parser.add_argument('cases',
+                            nargs='+',
+                            help='e.g case23')
+similar_parser.add_argument('-k',
+                            type=int,
+                            default=10,
+                            help='Number of similar cases per case.')
+
+parser.add_argument('--index_path',
+                    type=str,
+                    default='./content/search_index.pkl',
+                    help='Local path of the search index.')
+parser.add_argument('--similarity_index_path',
+                    type=str,
+                    default='./content/similarity_index.pkl',
+                    help='Local path of the similar-case index.')
+
+args = parser.parse_args()
+
+if args.command == 'build':
+    bucket_name = os.getenv('BUCKET_NAME')
+    key_path = os.getenv('SA_KEY_PATH')
+
+    credentials = service_account.Credentials.from_service_account_file(key_path)
+
+    storage_client = storage.Client(credentials=credentials)
+
+    buildSearchIndex(storage_client, bucket_name, args.index_path, corpus_path=args.corpus_path)
+
+elif args.command == 'query':
+    index = SearchIndex.load(args.index_path)
+
+    start_time = time.time()
+    results = index.search(args.query, k=args.k)
+    total_time = time.time() - start_time
+
+    for case, score in results:
+        print('{:<10} {:>8}'.format(case, score))
+    logging.info('{} results out of {} cases in {} ms.'.format(len(results), len(index),
+                                                              round(total_time * 1000, 1)))
+elif args.command == 'build_similar':
+    bucket_name = os.getenv('BUCKET_NAME')
+    key_path = os.getenv('SA_KEY_PATH')
+
+    credentials = service_account.Credentials.from_service_account_file(key_path)
+
+    storage_client = storage.Client(credentials=credentials)
+    datastore_client = datastore.Client(credentials=credentials)
+
+    buildSimilarityIndex(storage_client, datastore_client, bucket_name, args.similarity_index_path,
+                         corpus_path=args.corpus_path, entity_prefix=args.entity_prefix, refit=args.refit)
+
+elif args.command == 'similar':
+    index = CaseSimilarityIndex.load(args.similarity_index_path)
+
+    start_time = time.time()
+    results = index.similarBatch(args.cases, k=args.k)
+    total_time = time.time() - start_time
+
+    for case, similar_cases in results.items():
+        print(case)
+        for similar_case, score in similar_cases:
+            print('    {:<10} {:>8}'.format(similar_case, score))
+    logging.info('Similar cases of {} cases out of {} in {} ms.'.format(len(results), len(index),
+                                                                       round(total_time * 1000, 1)))
+else:
+    parser.print_help()
@@ -1,7 +1,10 @@
-from google.cloud import storage, bigquery, datastore
+from google.cloud import bigquery, datastore
 from google.oauth2 import service_account
-from utils.bq_fcn import populateBQ
-from utils.ner_fcn import populateDatastore
+from utils.bq_fcn import populateBQ, bqCreateDataset, EntityExporter
+from utils.ner_fcn import populateDatastore, populateDatastoreMulti, normalizeStoredEntities
+from utils.profiling_fcn import StageProfiler
+from utils.storage_fcn import getStorage
+import pandas as pd
 import logging
 import argparse
 import os
@@ -28,17 +31,48 @@ model_choices = ['en_core_sci_sm', 'en_core_sci_lg', 'en_ner_bc5cdr_md']
 parser.add_argument('model_name',
                     metavar='name',
                     type=str,
-                    help='Model options: en_core_sci_sm, en_core_sci_lg, en_ner_bc5cdr_md')
+                    nargs='+',
+                    help='Model options: en_core_sci_sm, en_core_sci_lg, en_ner_bc5cdr_md. Several models are run in a '
+                         'single pass over the corpus.')
+
+parser.add_argument('--corpus_path',
+                    type=str,
+                    default=None,
+                    help='Read the text from a local corpus built by consolidating.py instead of GCS.')
+
+parser.add_argument('--ner_profile',
+                    choices=['full', 'fast', 'linker-lite'],
+                    default='full',
+                    help='Speed profile of the NER, see benchmarking.py ner to compare them.')
+
+parser.add_argument('--entities_bigquery',
+                    action='store_true',
+                    help='Also export the entities to the {BQ_TABLE_NAME}_entities table and build its aggregates.')
+
+parser.add_argument('--ner_cache_max_mb',
+                    type=int,
+                    default=None,
+                    help='Evict the least recently used NER cache entries above this size.')
+
+parser.add_argument('--normalize_entities',
+                    action='store_true',
+                    help='First rewrite the entity names of the cases stored before they were case-folded.')
+
+parser.add_argument('--profile',
+                    type=str,
+                    default=None,
+                    help='Local directory or gs://bucket/prefix receiving a cProfile and memory report per stage, '
+                         'the NER model loading being its own stage.')
 
 # Execute the parse_args() method
 args = parser.parse_args()
 if args.store_datastore == 'True' and not args.model_name:
     parser.error('--storing in datastore can only be done when --model_name is set to a specific model.')
-elif args.store_datastore == 'True' and args.model_name not in model_choices:
+elif args.store_datastore == 'True' and not set(args.model_name) <= set(model_choices):
     parser.error('--storing in datastore can only be done when --model_name is among the supported models: {}.'.format(model_choices))
 
 
-model_name = args['model_name']
+model_names = args.model_name
 project_id = os.getenv('PROJECT_ID')
 bucket_name = os.getenv('BUCKET_NAME')
 location = os.getenv('LOCATION')
@@ -48,17 +82,30 @@ table_name = os.getenv('BQ_TABLE_NAME')
 
 credentials = service_account.Credentials.from_service_account_file(key_path)
 
-storage_client = storage.Client(credentials=credentials)
+# Optional: file:///path/to/root to read the stage outputs from a local copy of the buckets
+storage_uri = os.getenv('STORAGE_URI')
+storage_client = getStorage(storage_uri, credentials=credentials)
+# Optional: local directory or gs://bucket/prefix caching the entities extracted from each text
+ner_cache_uri = os.getenv('NER_CACHE_URI')
+if ner_cache_uri and ner_cache_uri.startswith('gs://') and storage_uri and storage_uri.startswith('file://'):
+    parser.error('NER_CACHE_URI must be a local directory when STORAGE_URI is a local copy of the buckets.')
 
 datastore_client = datastore.Client(credentials=credentials)
 
 bq_client = bigquery.Client(credentials=credentials)
 
+profiler = StageProfiler(args.profile, 'storing', storage_client=storage_client)
+
+if args.normalize_entities:
+    df_reference_TUIs = pd.read_csv('./scripts/utils/UMLS_tuis.csv')
+    normalizeStoredEntities(datastore_client, set(df_reference_TUIs['Categories']))
+
 if args.store_bigquery == 'True':
     start_time = time.time()
-    populateBQ(bq_client=bq_client,storage_client=storage_client,
-               bucket_name=bucket_name, dataset_name=dataset_name,
-               table_name=table_name)
+    with profiler.stage('bigquery'):
+        populateBQ(bq_client=bq_client,storage_client=storage_client,
+                   bucket_name=bucket_name, dataset_name=dataset_name,
+                   table_name=table_name, corpus_path=args.corpus_path)
     total_time = time.time() - start_time
     logging.info(
         'The export to BigQuery was completed successfully and took {} seconds.'.format(round(total_time, 1)))
@@ -67,8 +114,24 @@ else:
 
 if args.store_datastore == 'True':
     start_time = time.time()
-    populateDatastore(datastore_client=datastore_client, storage_client=storage_client,
-                      bucket_name=bucket_name, model_name=model_name)
+    ner_cache_max_bytes = args.ner_cache_max_mb * 1024 * 1024 if args.ner_cache_max_mb else None
+    entity_exporter = None
+    if args.entities_bigquery:
+        entity_exporter = EntityExporter(bq_client, bqCreateDataset(bq_client, dataset_name),
+                                         '{}_entities'.format(table_name))
+    if len(model_names) == 1:
+        populateDatastore(datastore_client=datastore_client, storage_client=storage_client,
+                          model_name=model_names[0], corpus_path=args.corpus_path, ner_cache_uri=ner_cache_uri,
+                          ner_cache_max_bytes=ner_cache_max_bytes, profile=args.ner_profile,
+                          entity_exporter=entity_exporter, profiler=profiler)
+    else:
+        # One corpus read, one UMLS linker and one Datastore write per case for all the models
+        populateDatastoreMulti(datastore_client=datastore_client, storage_client=storage_client,
+                               model_names=model_names, corpus_path=args.corpus_path, ner_cache_uri=ner_cache_uri,
+                               ner_cache_max_bytes=ner_cache_max_bytes, profile=args.ner_profile,
+                               entity_exporter=entity_exporter, profiler=profiler)
+    if entity_exporter is not None:
+        entity_exporter.close()
     total_time = time.time() - start_time
     logging.info(
         "The export to Datastore was completed successfully and took {} seconds.".format(round(total_time, 1)))
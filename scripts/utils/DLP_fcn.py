@@ -1,6 +1,8 @@
 import base64
 import logging
 
+from .lang_fcn import splitOnBoundaries
+
 def getKeyNamePath(kms_client, project_id, location, key_ring, key_name):
     """
 
@@ -51,23 +53,17 @@ def decryptData(kms_client, data, key_path_name):
     response = kms_client.decrypt(key_path_name, data.encode('utf-8'))
     return response
 
-def deterministicDeidentifyWithFpe(dlp_client, parent, text, info_types, surrogate_type, wrapped_key=None):
-    """Uses the Data Loss Prevention API to deidentify sensitive data in a
-    string using Format Preserving Encryption (FPE).
+def fpeConfigs(info_types, surrogate_type, wrapped_key):
+    """
+    Build the inspect and deidentify configurations of the Format Preserving Encryption.
     Args:
-        dlp_client: DLP Client instantiation
-        parent: str - The parent resource name, for example projects/my-project-id.
-        text: str - text to deidentify
-        info_types: list type of sensitive data, such as a name, email address, telephone number, identification number,
-        or credit card number.  https://cloud.google.com/dlp/docs/infotypes-reference
-        surrogate_type: The name of the surrogate custom info type to use. Only
-            necessary if you want to reverse the deidentification process. Can
-            be essentially any arbitrary string, as long as it doesn't appear
-            in your dataset otherwise.
-        wrapped_key: The encrypted ('wrapped') AES-256 key to use. This key
-            should be encrypted using the Cloud KMS key specified by key_name.
+        info_types: list - type of sensitive data, https://cloud.google.com/dlp/docs/infotypes-reference
+        surrogate_type: str - name of the surrogate custom info type
+        wrapped_key: str - base64-encoded AES-256 key
+
     Returns:
-        None; the response from the API is printed to the terminal.
+        inspect_config: dict -
+        deidentify_config: dict -
     """
     # The wrapped key is base64-encoded, but the library expects a binary
     # string, so decode it here.
@@ -99,6 +95,28 @@ def deterministicDeidentifyWithFpe(dlp_client, parent, text, info_types, surroga
         }
     }
 
+    return inspect_config, deidentify_config
+
+def deterministicDeidentifyWithFpe(dlp_client, parent, text, info_types, surrogate_type, wrapped_key=None):
+    """Uses the Data Loss Prevention API to deidentify sensitive data in a
+    string using Format Preserving Encryption (FPE).
+    Args:
+        dlp_client: DLP Client instantiation
+        parent: str - The parent resource name, for example projects/my-project-id.
+        text: str - text to deidentify
+        info_types: list type of sensitive data, such as a name, email address, telephone number, identification number,
+        or credit card number.  https://cloud.google.com/dlp/docs/infotypes-reference
+        surrogate_type: The name of the surrogate custom info type to use. Only
+            necessary if you want to reverse the deidentification process. Can
+            be essentially any arbitrary string, as long as it doesn't appear
+            in your dataset otherwise.
+        wrapped_key: The encrypted ('wrapped') AES-256 key to use. This key
+            should be encrypted using the Cloud KMS key specified by key_name.
+    Returns:
+        None; the response from the API is printed to the terminal.
+    """
+    inspect_config, deidentify_config = fpeConfigs(info_types, surrogate_type, wrapped_key)
+
     # Convert string to item
     item = {"value": text}
 
@@ -114,4 +132,72 @@ def deterministicDeidentifyWithFpe(dlp_client, parent, text, info_types, surroga
     logging.info('Successful Redaction.')
     return response.item.value
 
+def packTableItems(texts, max_bytes=450000, max_rows=10000):
+    """
+    Group texts into batches fitting in a single DLP request (0.5MB of content and 50,000 table values).
+    Args:
+        texts: list - str to deidentify
+        max_bytes: int - maximum size of the utf-8 content of a batch
+        max_rows: int - maximum number of rows in a batch
+
+    Returns:
+        batches: list - lists of (index in texts, part of the text) rows. Texts larger than max_bytes are split on
+        line boundaries into several rows, in order, joining the parts of a text gives it back.
+    """
+    batches = []
+    batch_bytes = 0
+    for idx, text in enumerate(texts):
+        for part in splitOnBoundaries(text, max_bytes, size_fcn=lambda part: len(part.encode('utf-8'))):
+            n_bytes = len(part.encode('utf-8'))
+            if not batches or batch_bytes + n_bytes > max_bytes or len(batches[-1]) >= max_rows:
+                batches.append([])
+                batch_bytes = 0
+            batches[-1].append((idx, part))
+            batch_bytes += n_bytes
+    return batches
+
+
+def batchDeidentifyWithFpe(dlp_client, parent, texts, info_types, surrogate_type, wrapped_key=None,
+                           max_bytes=450000):
+    """Same as deterministicDeidentifyWithFpe for many texts: the texts are packed into DLP table items, one row
+    per text or part of a text, so that a single deidentify_content call redacts a whole batch.
+    Args:
+        dlp_client: DLP Client instantiation
+        parent: str - The parent resource name, for example projects/my-project-id.
+        texts: list - str to deidentify, e.g short case notes or several text variants of a case
+        info_types: list - type of sensitive data, https://cloud.google.com/dlp/docs/infotypes-reference
+        surrogate_type: str - name of the surrogate custom info type
+        wrapped_key: str - base64-encoded AES-256 key
+        max_bytes: int - maximum size of the content of a request
 
+    Returns:
+        redacted_texts: list - deidentified texts, in the same order as texts
+    """
+    inspect_config, deidentify_config = fpeConfigs(info_types, surrogate_type, wrapped_key)
+
+    redacted_parts = [[] for _ in texts]
+    batches = packTableItems(texts, max_bytes=max_bytes)
+    n_calls = 0
+    for batch in batches:
+        # Empty texts have nothing to redact
+        batch = [(idx, part) for idx, part in batch if part]
+        if not batch:
+            continue
+        item = {
+            "table": {
+                "headers": [{"name": "text"}],
+                "rows": [{"values": [{"string_value": part}]} for _, part in batch]
+            }
+        }
+        response = dlp_client.deidentify_content(
+            parent=parent,
+            inspect_config=inspect_config,
+            deidentify_config=deidentify_config,
+            item=item,
+        )
+        n_calls += 1
+        for (idx, _), row in zip(batch, response.item.table.rows):
+            redacted_parts[idx].append(row.values[0].string_value)
+
+    logging.info('Successful Redaction of {} texts in {} DLP calls.'.format(len(texts), n_calls))
+    return [''.join(parts) for parts in redacted_parts]
@@ -0,0 +1,277 @@
+from collections import Counter
+import numpy as np
+import hashlib
+import json
+import logging
+import math
+import re
+import zlib
+
+from .cache_fcn import getCacheBackend
+
+MERSENNE_PRIME = (1 << 61) - 1
+
+pattern_digits = re.compile(r'\d+')
+pattern_non_words = re.compile(r'[^\w]+')
+
+
+def normalizeLine(line):
+    """
+    Normalize a line so that repeated headers and footers compare equal: lowercase, numbers (page numbers, dates)
+    collapsed to 0 and punctuation removed.
+    Args:
+        line: str -
+
+    Returns:
+        normalized_line: str
+    """
+    line = pattern_digits.sub('0', line.lower())
+    return ' '.join(pattern_non_words.sub(' ', line).split())
+
+
+def _hash(text):
+    return hashlib.blake2b(text.encode('utf-8'), digest_size=8).hexdigest()
+
+
+class MinHasher:
+    """
+    MinHash signatures of the character shingles of a line, their agreement estimates the Jaccard similarity of
+    two lines. Used to recognise boilerplate lines damaged differently by OCR in each document.
+    """
+
+    def __init__(self, num_perm=64, shingle_size=4, seed=1):
+        random_state = np.random.RandomState(seed)
+        self.a = random_state.randint(1, 1 << 31, size=num_perm).astype(np.uint64)
+        self.b = random_state.randint(0, 1 << 31, size=num_perm).astype(np.uint64)
+        self.shingle_size = shingle_size
+
+    def signature(self, text):
+        shingles = {text[idx:idx + self.shingle_size] for idx in range(max(1, len(text) - self.shingle_size + 1))}
+        hashes = np.fromiter((zlib.crc32(shingle.encode('utf-8')) for shingle in shingles),
+                             dtype=np.uint64, count=len(shingles))
+        # a < 2^31 and crc32 < 2^32, no overflow
+        return ((np.outer(self.a, hashes) + self.b[:, None]) % MERSENNE_PRIME).min(axis=1)
+
+
+class BoilerplateDetector:
+    """
+    Corpus-level detector of boilerplate: lines and word n-grams repeated across documents (hospital names, authors,
+    journal headers) and lines repeated on the pages of a document (headers, footers). The learned lines, n-grams
+    and MinHash signatures are persisted so that the detector can be applied to new documents one at a time.
+    """
+
+    def __init__(self, min_docs=3, min_doc_fraction=0.2, min_chars=15, max_chars=120, ngram_size=8, page_repeats=3,
+                 edge_lines=2, num_perm=64, bands=16, similarity=0.7):
+        self.min_docs = min_docs
+        self.min_doc_fraction = min_doc_fraction
+        self.min_chars = min_chars
+        # Headers and footers are short, longer lines are only stripped of their repeated n-grams
+        self.max_chars = max_chars
+        self.ngram_size = ngram_size
+        self.page_repeats = page_repeats
+        # Headers and footers are among the first and last lines of a page
+        self.edge_lines = edge_lines
+        self.bands = bands
+        self.similarity = similarity
+        self.minhasher = MinHasher(num_perm=num_perm)
+
+        self.line_hashes = set()
+        self.ngram_hashes = set()
+        self.signatures = []
+        self._buckets = {}
+
+        self.chars_in = 0
+        self.chars_removed = 0
+
+    def _bandKeys(self, signature):
+        rows = len(signature) // self.bands
+        return ['{}:{}'.format(band, _hash(signature[band * rows:(band + 1) * rows].tobytes().hex()))
+                for band in range(self.bands)]
+
+    def _addSignature(self, signature):
+        for key in self._bandKeys(signature):
+            self._buckets.setdefault(key, []).append(len(self.signatures))
+        self.signatures.append(signature)
+
+    def _candidates(self, signature, buckets):
+        return {idx for key in self._bandKeys(signature) for idx in buckets.get(key, [])}
+
+    def _lineNgrams(self, normalized_line):
+        words = normalized_line.split()
+        return [_hash(' '.join(words[idx:idx + self.ngram_size])) for idx in range(len(words) - self.ngram_size + 1)]
+
+    def fit(self, texts):
+        """
+        Learn the boilerplate of a corpus, on top of what was already learned.
+        Args:
+            texts: list - str of the documents, with their line breaks
+
+        Returns:
+            self
+        """
+        threshold = max(self.min_docs, math.ceil(self.min_doc_fraction * len(texts)))
+
+        line_docs = {}
+        ngram_docs = Counter()
+        for doc_idx, text in enumerate(texts):
+            doc_ngrams = set()
+            for line in text.splitlines():
+                normalized_line = normalizeLine(line)
+                if self.min_chars <= len(normalized_line) <= self.max_chars:
+                    line_docs.setdefault(normalized_line, set()).add(doc_idx)
+                doc_ngrams.update(self._lineNgrams(normalized_line))
+            ngram_docs.update(doc_ngrams)
+
+        # Group the near-duplicate lines: union-find over the lines sharing a MinHash band
+        lines = list(line_docs)
+        signatures = [self.minhasher.signature(line) for line in lines]
+        parents = list(range(len(lines)))
+
+        def find(idx):
+            while parents[idx] != idx:
+                parents[idx] = parents[parents[idx]]
+                idx = parents[idx]
+            return idx
+
+        buckets = {}
+        for idx, signature in enumerate(signatures):
+            for other_idx in self._candidates(signature, buckets):
+                if np.mean(signatures[other_idx] == signature) >= self.similarity:
+                    parents[find(idx)] = find(other_idx)
+            for key in self._bandKeys(signature):
+                buckets.setdefault(key, []).append(idx)
+
+        group_docs = {}
+        for idx, line in enumerate(lines):
+            group_docs.setdefault(find(idx), set()).update(line_docs[line])
+
+        n_lines = 0
+        for idx, line in enumerate(lines):
+            if len(group_docs[find(idx)]) >= threshold and _hash(line) not in self.line_hashes:
+                self.line_hashes.add(_hash(line))
+                self._addSignature(signatures[idx])
+                n_lines += 1
+
+        n_ngrams = len(self.ngram_hashes)
+        self.ngram_hashes.update(ngram for ngram, n_docs in ngram_docs.items() if n_docs >= threshold)
+        logging.info('Boilerplate: learned {} lines and {} {}-grams repeated in at least {} of {} documents.'.format(
+            n_lines, len(self.ngram_hashes) - n_ngrams, self.ngram_size, threshold, len(texts)))
+        return self
+
+    def isBoilerplateLine(self, normalized_line):
+        if _hash(normalized_line) in self.line_hashes:
+            return True
+        if not self.min_chars <= len(normalized_line) <= self.max_chars or not self.signatures:
+            return False
+        signature = self.minhasher.signature(normalized_line)
+        return any(np.mean(self.signatures[idx] == signature) >= self.similarity
+                   for idx in self._candidates(signature, self._buckets))
+
+    def _stripNgrams(self, line):
+        # n-grams are matched on the normalized tokens, the original words they come from are removed
+        words = line.split()
+        tokens = [(word_idx, token) for word_idx, word in enumerate(words) for token in normalizeLine(word).split()]
+        covered = set()
+        for idx in range(len(tokens) - self.ngram_size + 1):
+            ngram = ' '.join(token for _, token in tokens[idx:idx + self.ngram_size])
+            if _hash(ngram) in self.ngram_hashes:
+                covered.update(word_idx for word_idx, _ in tokens[idx:idx + self.ngram_size])
+        if not covered:
+            return line
+        line_end = line[len(line.rstrip('\r\n')):]
+        return ' '.join(word for word_idx, word in enumerate(words) if word_idx not in covered) + line_end
+
+    def _pageEdgeLines(self, lines, normalized_lines):
+        """
+        Indices of the lines at the start or end of a page. The OCR text holds the pages followed by a space and the
+        Vision text of a page ends with a line break, so a page starts with the line following a space.
+        """
+        page_starts = [0] + [idx for idx in range(1, len(lines))
+                             if lines[idx - 1].endswith('\n') and lines[idx].startswith(' ')]
+        edge_lines = set()
+        for page_start, page_end in zip(page_starts, page_starts[1:] + [len(lines)]):
+            page_lines = [idx for idx in range(page_start, page_end) if normalized_lines[idx]]
+            edge_lines.update(page_lines[:self.edge_lines])
+            edge_lines.update(page_lines[-self.edge_lines:])
+        return edge_lines
+
+    def strip(self, text):
+        """
+        Remove the boilerplate of a document.
+        Args:
+            text: str - with the page layout of readJsonResult
+
+        Returns:
+            stripped_text: str
+        """
+        lines = text.splitlines(keepends=True)
+        normalized_lines = [normalizeLine(line) for line in lines]
+
+        # Headers and footers repeated on the pages of this document, other repeated lines are content
+        edge_lines = self._pageEdgeLines(lines, normalized_lines)
+        line_counts = Counter(normalized_lines[idx] for idx in edge_lines
+                              if self.min_chars <= len(normalized_lines[idx]) <= self.max_chars)
+        repeated_lines = {line for line, count in line_counts.items() if count >= self.page_repeats}
+
+        stripped_lines = []
+        for idx, (line, normalized_line) in enumerate(zip(lines, normalized_lines)):
+            if (idx in edge_lines and normalized_line in repeated_lines) or self.isBoilerplateLine(normalized_line):
+                continue
+            stripped_lines.append(self._stripNgrams(line) if self.ngram_hashes else line)
+        stripped_text = ''.join(stripped_lines)
+
+        self.chars_in += len(text)
+        self.chars_removed += len(text) - len(stripped_text)
+        return stripped_text
+
+    def logStats(self):
+        ratio = self.chars_removed / self.chars_in if self.chars_in else 0.0
+        logging.info('Boilerplate: removed {} of {} characters ({}%) before translation, redaction and NER.'.format(
+            self.chars_removed, self.chars_in, round(100 * ratio, 1)))
+
+    def toDict(self):
+        return {'line_hashes': sorted(self.line_hashes),
+                'ngram_hashes': sorted(self.ngram_hashes),
+                'signatures': [signature.tolist() for signature in self.signatures]}
+
+    def fromDict(self, learned):
+        self.line_hashes = set(learned['line_hashes'])
+        self.ngram_hashes = set(learned['ngram_hashes'])
+        self.signatures = []
+        self._buckets = {}
+        for signature in learned['signatures']:
+            self._addSignature(np.array(signature, dtype=np.uint64))
+        return self
+
+
+def loadBoilerplate(storage_client, boilerplate_uri, **kwargs):
+    """
+    Args:
+        storage_client: Storage client instantiation -
+        boilerplate_uri: str - 'gs://bucket/prefix' or a local directory path
+        **kwargs: settings of the BoilerplateDetector
+
+    Returns:
+        detector: BoilerplateDetector - with the boilerplate learned by previous runs, if any
+    """
+    detector = BoilerplateDetector(**kwargs)
+    learned = getCacheBackend(storage_client, boilerplate_uri).get('boilerplate.json')
+    if learned is not None:
+        detector.fromDict(json.loads(learned))
+        logging.info('Loaded {} boilerplate lines and {} n-grams from {}.'.format(len(detector.line_hashes),
+                                                                                 len(detector.ngram_hashes),
+                                                                                 boilerplate_uri))
+    return detector
+
+
+def saveBoilerplate(storage_client, boilerplate_uri, detector):
+    """
+    Args:
+        storage_client: Storage client instantiation -
+        boilerplate_uri: str - 'gs://bucket/prefix' or a local directory path
+        detector: BoilerplateDetector -
+
+    Returns:
+
+    """
+    getCacheBackend(storage_client, boilerplate_uri).put('boilerplate.json', json.dumps(detector.toDict()))
@@ -1,6 +1,35 @@
 from google.cloud import bigquery
+from collections import OrderedDict
+import datetime
 import os
 import logging
+import threading
+import uuid
+
+from .corpus_fcn import iterCorpus
+from .compression_fcn import downloadText
+from .storage_fcn import asStorage
+
+PUBLIC_TABLE = 'aketari-covid19-public.covid19.ISMIR'
+
+STAGING_EXPIRATION = datetime.timedelta(days=1)
+
+TEXT_SCHEMA = [
+    bigquery.SchemaField('case', 'STRING', mode='REQUIRED'),
+    bigquery.SchemaField('it_raw_txt', 'STRING', mode='REQUIRED'),
+    bigquery.SchemaField('eng_raw_txt', 'STRING', mode='REQUIRED'),
+    bigquery.SchemaField('eng_txt', 'STRING', mode='REQUIRED',
+                         description='Output of preprocessing pipeline.')]
+
+ENTITY_SCHEMA = [
+    bigquery.SchemaField('case', 'STRING', mode='REQUIRED'),
+    bigquery.SchemaField('model', 'STRING', mode='REQUIRED', description='NER model which extracted the entities.'),
+    bigquery.SchemaField('entities', 'RECORD', mode='REPEATED', fields=[
+        bigquery.SchemaField('category', 'STRING'),
+        bigquery.SchemaField('entity', 'STRING'),
+        bigquery.SchemaField('tui', 'STRING'),
+        bigquery.SchemaField('cui', 'STRING'),
+        bigquery.SchemaField('count', 'INTEGER', description='Number of mentions in the case.')])]
 
 
 def bqCreateDataset(bq_client, dataset_name):
@@ -41,21 +70,203 @@ def bqCreateTable(bq_client, dataset_id, table_name):
     # Prepares a reference to the table
     table_ref = dataset_ref.table(table_name)
 
+    try:
+        table = bq_client.get_table(table_ref)
+        if table.clustering_fields != ['case']:
+            # Partitioning and clustering can only be set at creation time
+            logging.warning('Table {} is not clustered on case, lookups will scan the whole table. '
+                            'Recreate it to benefit from clustering.'.format(table.table_id))
+        return table.table_id
+    except:
+        table = bigquery.Table(table_ref, schema=TEXT_SCHEMA)
+        # Partitioned on ingestion time and clustered on case, so that lookups by case only scan one cluster
+        table.time_partitioning = bigquery.TimePartitioning(type_=bigquery.TimePartitioningType.DAY)
+        table.clustering_fields = ['case']
+        table = bq_client.create_table(table)
+        logging.info('table {} has been created.'.format(table.table_id))
+        return table.table_id
+
+
+def bqCreateEntityTable(bq_client, dataset_id, table_name):
+    """
+    Create the table with the entities of each case, one row per case and model.
+    Args:
+        bq_client: BigQuery client instantiation -
+        dataset_id: str - Reference id for the dataset to use
+        table_name: str - Name of the table to create, e.g ISMIR_entities
+
+    Returns:
+        table_id: str - Reference id for the table just created
+    """
+    table_ref = bq_client.dataset(dataset_id).table(table_name)
+
     try:
         return bq_client.get_table(table_ref).table_id
     except:
-        schema = [
-            bigquery.SchemaField('case', 'STRING', mode='REQUIRED'),
-            bigquery.SchemaField('it_raw_txt', 'STRING', mode='REQUIRED'),
-            bigquery.SchemaField('eng_raw_txt', 'STRING', mode='REQUIRED'),
-            bigquery.SchemaField('eng_txt', 'STRING', mode='REQUIRED',
-                                 description='Output of preprocessing pipeline.')]
-        table = bigquery.Table(table_ref, schema=schema)
+        table = bigquery.Table(table_ref, schema=ENTITY_SCHEMA)
+        # Same layout as the text table, so that both are joined on case cheaply
+        table.time_partitioning = bigquery.TimePartitioning(type_=bigquery.TimePartitioningType.DAY)
+        table.clustering_fields = ['case', 'model']
         table = bq_client.create_table(table)
         logging.info('table {} has been created.'.format(table.table_id))
         return table.table_id
 
 
+def _dedupeRows(rows, key_fields):
+    """
+    Keep the last row of each key: MERGE fails when a target row matches several source rows.
+    """
+    return list({tuple(row[field] for field in key_fields): row for row in rows}.values())
+
+
+def _mergeThroughStaging(bq_client, dataset_id, table_id, rows, schema, merge_query):
+    """
+    Load rows into a new staging table, run merge_query from it into table_id, then drop it.
+    Args:
+        bq_client: BigQuery client instance -
+        dataset_id: str -
+        table_id: str -
+        rows: list - dicts matching schema, unique on the merge keys
+        schema: list - SchemaField of the staging table
+        merge_query: str - MERGE statement with the {project}, {dataset}, {table} and {staging} placeholders
+
+    Returns:
+
+    """
+    staging_ref = bq_client.dataset(dataset_id).table('{}_staging_{}'.format(table_id, uuid.uuid4().hex))
+    staging_table = bigquery.Table(staging_ref, schema=schema)
+    # Staging tables left behind by a run that died expire on their own
+    staging_table.expires = datetime.datetime.now(datetime.timezone.utc) + STAGING_EXPIRATION
+
+    try:
+        bq_client.create_table(staging_table)  # API request
+        job_config = bigquery.LoadJobConfig(schema=schema, write_disposition=bigquery.WriteDisposition.WRITE_APPEND)
+        bq_client.load_table_from_json(rows, staging_ref, job_config=job_config).result()  # API request
+        bq_client.query(merge_query.format(project=bq_client.project, dataset=dataset_id, table=table_id,
+                                           staging=staging_ref.table_id)).result()  # API request
+    finally:
+        bq_client.delete_table(staging_ref, not_found_ok=True)
+
+
+def mergeEntityRows2BQ(bq_client, dataset_id, table_id, rows_to_merge):
+    """
+    Upsert entity rows into BigQuery, through a staging table merged on case and model.
+    Args:
+        bq_client: BigQuery client instance -
+        dataset_id: str -
+        table_id: str -
+        rows_to_merge: list - dicts with the case, model and entities keys
+
+    Returns:
+        Logging completion
+    """
+    rows_to_merge = _dedupeRows(rows_to_merge, ['case', 'model'])
+    merge_query = ('MERGE `{project}.{dataset}.{table}` T '
+                   'USING `{project}.{dataset}.{staging}` S '
+                   'ON T.`case` = S.`case` AND T.model = S.model '
+                   'WHEN MATCHED THEN UPDATE SET entities = S.entities '
+                   'WHEN NOT MATCHED THEN INSERT (`case`, model, entities) '
+                   'VALUES (S.`case`, S.model, S.entities)')
+    _mergeThroughStaging(bq_client, dataset_id, table_id, rows_to_merge, ENTITY_SCHEMA, merge_query)
+
+    return logging.info('Entities of {} cases were merged in {} dataset, specifically in {} table.'.format(
+        len(rows_to_merge), dataset_id, table_id))
+
+
+def bqBuildEntityAggregates(bq_client, dataset_id, table_id):
+    """
+    Precompute the aggregates of the entity table: counts per category and per entity within each category.
+    Args:
+        bq_client: BigQuery client instance -
+        dataset_id: str -
+        table_id: str - entity table
+
+    Returns:
+        aggregate_table_ids: list - '{table_id}_category_counts' and '{table_id}_entity_counts'
+    """
+    table_path = '{}.{}.{}'.format(bq_client.project, dataset_id, table_id)
+    queries = {
+        '{}_category_counts'.format(table_id): (
+            'SELECT model, e.category, COUNT(DISTINCT `case`) AS n_cases, COUNT(DISTINCT e.cui) AS n_entities, '
+            'SUM(e.count) AS n_mentions '
+            'FROM `{}`, UNNEST(entities) AS e '
+            'GROUP BY model, e.category'),
+        '{}_entity_counts'.format(table_id): (
+            'SELECT model, e.category, e.cui, ANY_VALUE(e.tui) AS tui, ANY_VALUE(e.entity) AS entity, '
+            'COUNT(DISTINCT `case`) AS n_cases, SUM(e.count) AS n_mentions '
+            'FROM `{}`, UNNEST(entities) AS e '
+            'GROUP BY model, e.category, e.cui')}
+
+    for aggregate_table_id, query in queries.items():
+        create_query = 'CREATE OR REPLACE TABLE `{}.{}.{}` AS {}'.format(bq_client.project, dataset_id,
+                                                                          aggregate_table_id, query.format(table_path))
+        bq_client.query(create_query).result()  # API request
+        logging.info('Aggregate table {} has been built.'.format(aggregate_table_id))
+    return list(queries)
+
+
+class EntityExporter:
+    """
+    Buffer the entities extracted case by case and merge them into the entity table by batches. The aggregate
+    tables are rebuilt when the exporter is closed.
+    """
+
+    def __init__(self, bq_client, dataset_id, table_name, merge_batch_size=500):
+        self.bq_client = bq_client
+        self.dataset_id = dataset_id
+        self.table_id = bqCreateEntityTable(bq_client, dataset_id, table_name)
+        self.merge_batch_size = merge_batch_size
+        self._rows = []
+
+    def add(self, case, model_name, entity_rows):
+        """
+        Args:
+            case: str -
+            model_name: str -
+            entity_rows: list - dicts with the category, entity, tui, cui and count keys
+        """
+        self._rows.append({'case': case, 'model': model_name, 'entities': entity_rows})
+        if len(self._rows) >= self.merge_batch_size:
+            self.flush()
+
+    def flush(self):
+        if self._rows:
+            mergeEntityRows2BQ(self.bq_client, self.dataset_id, self.table_id, self._rows)
+            self._rows = []
+
+    def close(self):
+        self.flush()
+        bqBuildEntityAggregates(self.bq_client, self.dataset_id, self.table_id)
+
+
+def mergeRows2BQ(bq_client, dataset_id, table_id, rows_to_merge):
+    """
+    Upsert text data into BigQuery: rows are loaded into a staging table then merged on case, so that
+    re-running the export updates existing cases instead of duplicating them.
+    Args:
+        bq_client: BigQuery client instance -
+        dataset_id: str -
+        table_id: str -
+        rows_to_merge: list - dicts with the case, it_raw_txt, eng_raw_txt and eng_txt keys
+
+    Returns:
+        Logging completion
+    """
+    rows_to_merge = _dedupeRows(rows_to_merge, ['case'])
+    merge_query = ('MERGE `{project}.{dataset}.{table}` T '
+                   'USING `{project}.{dataset}.{staging}` S '
+                   'ON T.`case` = S.`case` '
+                   'WHEN MATCHED THEN UPDATE SET it_raw_txt = S.it_raw_txt, eng_raw_txt = S.eng_raw_txt, '
+                   'eng_txt = S.eng_txt '
+                   'WHEN NOT MATCHED THEN INSERT (`case`, it_raw_txt, eng_raw_txt, eng_txt) '
+                   'VALUES (S.`case`, S.it_raw_txt, S.eng_raw_txt, S.eng_txt)')
+    _mergeThroughStaging(bq_client, dataset_id, table_id, rows_to_merge, TEXT_SCHEMA, merge_query)
+
+    return logging.info('{} cases were merged in {} dataset, specifically in {} table.'.format(len(rows_to_merge),
+                                                                                               dataset_id,
+                                                                                               table_id))
+
+
 def exportItems2BQ(bq_client, dataset_id, table_id, case, it_raw_blob, eng_raw_blob, curated_eng_blob):
     """
     Export text data to BigQuery.
@@ -68,6 +279,30 @@ def exportItems2BQ(bq_client, dataset_id, table_id, case, it_raw_blob, eng_raw_b
         eng_raw_blob: gcs blob object -
         curated_eng_blob: gcs blob object -
 
+    Returns:
+        Logging completion
+    """
+    # Download text from GCS
+    it_raw_txt_string = downloadText(it_raw_blob)
+    eng_raw_txt_string = downloadText(eng_raw_blob)
+    curated_eng_string = downloadText(curated_eng_blob)
+
+    return exportText2BQ(bq_client, dataset_id, table_id, case,
+                         it_raw_txt_string, eng_raw_txt_string, curated_eng_string)
+
+
+def exportText2BQ(bq_client, dataset_id, table_id, case, it_raw_txt_string, eng_raw_txt_string, curated_eng_string):
+    """
+    Export text already held in memory to BigQuery.
+    Args:
+        bq_client: BigQuery client instance -
+        dataset_id: str -
+        table_id: str -
+        case: str -
+        it_raw_txt_string: str -
+        eng_raw_txt_string: str -
+        curated_eng_string: str -
+
     Returns:
         Logging completion
     """
@@ -77,11 +312,6 @@ def exportItems2BQ(bq_client, dataset_id, table_id, case, it_raw_blob, eng_raw_b
     table_ref = dataset_ref.table(table_id)
     table = bq_client.get_table(table_ref)  # API call
 
-    # Download text from GCS
-    it_raw_txt_string = it_raw_blob.download_as_string().decode('utf-8')
-    eng_raw_txt_string = eng_raw_blob.download_as_string().decode('utf-8')
-    curated_eng_string = curated_eng_blob.download_as_string().decode('utf-8')
-
     rows_to_insert = [{'case': case,
                        'it_raw_txt': it_raw_txt_string,
                        'eng_raw_txt': eng_raw_txt_string,
@@ -138,15 +368,114 @@ def returnQueryResults(bq_client, query):
         return logging.error("Error", e)
 
 
-def populateBQ(bq_client, storage_client, bucket_name, dataset_name, table_name):
+class QueryResultCache:
+    """
+    In-memory LRU cache of query results, bounded by the size of the cached rows.
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return self._entries[key][0]
+
+    def put(self, key, rows):
+        # Size of the values as text, close to the memory of the strings which make most of the rows
+        size = sum(len(str(value).encode('utf-8')) for row in rows for value in row.values())
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self.current_bytes -= self._entries.pop(key)[1]
+            self._entries[key] = (rows, size)
+            self.current_bytes += size
+            # Evict the least recently used results
+            while self.current_bytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.current_bytes -= evicted_size
+
+
+def constructCasesQuery(column_lst, table_path=PUBLIC_TABLE):
     """
-    Populate BigQuery dataset.
+    Construct a parameterized query returning many cases at once.
+    Args:
+        column_lst: list - ["*"] or ["column_name1", "column_name2" ...]
+        table_path: str - 'project.dataset.table', default to the public dataset
+
+    Returns:
+        query: str - query expecting an ARRAY<STRING> parameter named cases
+    """
+    columns_str = ", ".join(column_lst)
+    return ('SELECT {} FROM `{}` '
+            'WHERE `case` IN UNNEST(@cases) '.format(columns_str, table_path))
+
+
+def queryCases(bq_client, case_ids, column_lst=None, table_path=PUBLIC_TABLE, cache=None, page_size=500):
+    """
+    Get the rows of many cases with a single query job. Results are cached on the query, its parameters and
+    the last modification time of the table, so repeated lookups cost nothing until the table changes.
+    Args:
+        bq_client: BigQuery client instantiation -
+        case_ids: list - e.g ["case1", "case23"]
+        column_lst: list - ["column_name1", "column_name2" ...], default to all columns
+        table_path: str - 'project.dataset.table'
+        cache: QueryResultCache - Optional
+        page_size: int - rows fetched per page
+
+    Returns:
+        generator of rows
+    """
+    query = constructCasesQuery(column_lst or ["*"], table_path)
+    case_ids = sorted(set(case_ids))
+
+    cache_key = None
+    if cache is not None:
+        # Metadata call, not billed
+        modified = bq_client.get_table(table_path).modified
+        cache_key = (query, tuple(case_ids), modified)
+        rows = cache.get(cache_key)
+        if rows is not None:
+            yield from rows
+            return
+
+    job_config = bigquery.QueryJobConfig(
+        query_parameters=[bigquery.ArrayQueryParameter('cases', 'STRING', case_ids)])
+    query_job = bq_client.query(query, job_config=job_config)
+
+    rows = []
+    for page in query_job.result(page_size=page_size).pages:
+        for row in page:
+            if cache is not None:
+                rows.append(row)
+            yield row
+
+    if cache is not None:
+        cache.put(cache_key, rows)
+
+
+def populateBQ(bq_client, storage_client, bucket_name, dataset_name, table_name, merge_batch_size=500,
+               corpus_path=None):
+    """
+    Populate BigQuery dataset. Cases are upserted, so the export can be re-run without duplicating them.
     Args:
         bq_client: BigQuery client instantiation -
         storage_client:
         bucket_name:
         dataset_name:
         table_name:
+        merge_batch_size: int - number of cases merged per MERGE statement
+        corpus_path: str - Optional, local corpus written by buildCorpus to read instead of the GCS objects
 
     Returns:
         Populated BigQuery data warehouse
@@ -163,33 +492,53 @@ def populateBQ(bq_client, storage_client, bucket_name, dataset_name, table_name)
     except Exception as e:
         logging.error("An error occurred.", e)
 
+    if corpus_path:
+        # Sequential scan of the memory mapped corpus, no object fetch
+        lst_rows = iterCorpus(corpus_path, columns=['case', 'it_raw_txt', 'eng_raw_txt', 'eng_txt'])
+    else:
+        lst_rows = _readGCSRows(storage_client, bucket_name)
+
+    rows_to_merge = []
+    for row in lst_rows:
+        rows_to_merge.append(row)
+
+        # populate to BQ dataset
+        if len(rows_to_merge) == merge_batch_size:
+            mergeRows2BQ(bq_client, dataset_id, table_id, rows_to_merge)
+            rows_to_merge = []
+
+    if rows_to_merge:
+        mergeRows2BQ(bq_client, dataset_id, table_id, rows_to_merge)
+
+
+def _readGCSRows(storage_client, bucket_name):
+    """
+    Rows of the text table read from the outputs of each stage on GCS or local storage.
+    """
     src_bucket = os.environ['SRC_BUCKET']
     dest_bucket = os.environ['DEST_BUCKET']
     gcs_source_prefix = 'pdf'
-    lst_blobs = storage_client.list_blobs(bucket_or_name=src_bucket,
-                                          prefix=gcs_source_prefix)
+    storage_backend = asStorage(storage_client)
+    lst_blobs = storage_backend.listNames(src_bucket, prefix=gcs_source_prefix)
 
-    for blob in lst_blobs:
-        doc_title = blob.name.split('/')[-1].split('.txt')[0]
+    for blob_name in lst_blobs:
+        doc_title = blob_name.split('/')[-1].split('.txt')[0]
 
         # download as string
-        it_raw_blob = storage_client.get_bucket(dest_bucket).get_blob('raw_txt/{}.txt'.format(doc_title))
-
-        # set the GCS path
-        try:
-            # Path in case using batch translation
-            path_blob_eng_raw = 'eng_txt/{}/{}_raw_txt_{}_en_translations.txt'.format(doc_title, dest_bucket, doc_title)
-            eng_raw_blob = storage_client.get_bucket(dest_bucket).get_blob(path_blob_eng_raw)
-            # If the file is not present, decoding a None Type will result in an error
-            eng_raw_txt = eng_raw_blob.download_as_string().decode('utf-8')
-        except:
+        it_raw_txt = storage_backend.readText(dest_bucket, 'raw_txt/{}.txt'.format(doc_title))
+
+        # Path in case using batch translation
+        path_blob_eng_raw = 'eng_txt/{}/{}_raw_txt_{}_en_translations.txt'.format(doc_title, dest_bucket, doc_title)
+        eng_raw_txt = storage_backend.readText(dest_bucket, path_blob_eng_raw)
+        if eng_raw_txt is None:
             # New path used for pdf update
             path_blob_eng_raw = 'eng_txt/{}.txt'.format(doc_title)
-            eng_raw_blob = storage_client.get_bucket(dest_bucket).get_blob(path_blob_eng_raw)
+            eng_raw_txt = storage_backend.readText(dest_bucket, path_blob_eng_raw)
 
         # Upload blob of interest
-        curated_eng_blob = storage_client.get_bucket(bucket_name) \
-            .get_blob('curated_eng_txt/{}.txt'.format(doc_title))
+        curated_eng_txt = storage_backend.readText(bucket_name, 'curated_eng_txt/{}.txt'.format(doc_title))
 
-        # populate to BQ dataset
-        exportItems2BQ(bq_client, dataset_id, table_id, doc_title, it_raw_blob, eng_raw_blob, curated_eng_blob)
+        yield {'case': doc_title,
+               'it_raw_txt': it_raw_txt,
+               'eng_raw_txt': eng_raw_txt,
+               'eng_txt': curated_eng_txt}
@@ -0,0 +1,480 @@
+from PyPDF2 import PdfFileReader, PdfFileWriter
+import hashlib
+import io
+import json
+import logging
+import os
+import re
+import tempfile
+import time
+
+from .compression_fcn import downloadText
+from .preprocessing_fcn import iterJsonPageTexts
+from .storage_fcn import asStorage
+
+# Hits on GCS cache entries update their access time at most once per hour, one metadata update per entry
+GCS_ACCESS_RESOLUTION = 3600
+
+# DOCUMENT_TEXT_DETECTION list price, in $ per page (first 5M pages/month).
+VISION_PRICE_PER_PAGE = 1.5 / 1000
+
+
+class LocalCacheBackend:
+    """
+    Cache backend storing entries as files in a local directory.
+    """
+
+    def __init__(self, root_dir):
+        self.root_dir = root_dir
+        os.makedirs(root_dir, exist_ok=True)
+
+    def get(self, key):
+        path = os.path.join(self.root_dir, key)
+        if not os.path.exists(path):
+            return None
+        with open(path, 'r', encoding='utf-8') as f:
+            value = f.read()
+        # The modification time records the last access, for the eviction
+        os.utime(path)
+        return value
+
+    def put(self, key, value):
+        path = os.path.join(self.root_dir, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # Write to a temporary file first so that readers never see a partial entry
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(value)
+        os.replace(tmp_path, path)
+
+    def atomicUpdate(self, key, update_fcn, stale_lock_seconds=60):
+        """
+        Read-modify-write of an entry, exclusive among the processes sharing the directory.
+        Args:
+            key: str -
+            update_fcn: function - takes the current value (None if missing), returns the new value or None to keep it
+            stale_lock_seconds: int - lock left by a process that died, broken after that many seconds
+
+        Returns:
+            updated: bool - False if update_fcn kept the value or another process holds the entry
+        """
+        path = os.path.join(self.root_dir, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        lock_path = path + '.lock'
+        try:
+            lock_fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            try:
+                if time.time() - os.path.getmtime(lock_path) < stale_lock_seconds:
+                    return False
+                os.remove(lock_path)
+                lock_fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except (FileNotFoundError, FileExistsError):
+                # Another process broke the stale lock first
+                return False
+
+        try:
+            current_value = None
+            if os.path.exists(path):
+                with open(path, 'r', encoding='utf-8') as f:
+                    current_value = f.read()
+            new_value = update_fcn(current_value)
+            if new_value is None:
+                return False
+            self.put(key, new_value)
+            return True
+        finally:
+            os.close(lock_fd)
+            os.remove(lock_path)
+
+    def entries(self, prefix=''):
+        """
+        Returns:
+            entries: list - (key, size in bytes, last access timestamp) tuples
+        """
+        entries = []
+        for dir_path, _, file_names in os.walk(os.path.join(self.root_dir, prefix)):
+            for file_name in file_names:
+                path = os.path.join(dir_path, file_name)
+                key = os.path.relpath(path, self.root_dir).replace(os.sep, '/')
+                entries.append((key, os.path.getsize(path), os.path.getmtime(path)))
+        return entries
+
+    def delete(self, key):
+        os.remove(os.path.join(self.root_dir, key))
+
+
+class GCSCacheBackend:
+    """
+    Cache backend storing entries as blobs under a GCS prefix.
+    """
+
+    def __init__(self, storage_client, bucket_name, prefix='ocr_cache'):
+        self.bucket_client = storage_client.bucket(bucket_name)
+        self.prefix = prefix.strip('/')
+
+    def get(self, key):
+        blob = self.bucket_client.get_blob('{}/{}'.format(self.prefix, key))
+        if blob is None:
+            return None
+        value = downloadText(blob)
+        # GCS has no access time, hits record it in the metadata of the blob, at most once per resolution
+        if time.time() - self._lastAccess(blob) > GCS_ACCESS_RESOLUTION:
+            blob.metadata = dict(blob.metadata or {}, accessed=str(time.time()))
+            try:
+                blob.patch()
+            except Exception as e:
+                logging.warning('Cannot record the access to {}: {}'.format(blob.name, e))
+        return value
+
+    @staticmethod
+    def _lastAccess(blob):
+        return max(float((blob.metadata or {}).get('accessed', 0)), blob.updated.timestamp())
+
+    def put(self, key, value):
+        blob = self.bucket_client.blob('{}/{}'.format(self.prefix, key))
+        blob.upload_from_string(value)
+
+    def atomicUpdate(self, key, update_fcn):
+        """
+        Read-modify-write of an entry, the write only succeeds if the blob generation is still the one read, see
+        LocalCacheBackend.atomicUpdate.
+        """
+        from google.api_core.exceptions import PreconditionFailed
+
+        blob = self.bucket_client.get_blob('{}/{}'.format(self.prefix, key))
+        new_value = update_fcn(downloadText(blob) if blob is not None else None)
+        if new_value is None:
+            return False
+        try:
+            # Generation 0 means the blob must not exist yet
+            self.bucket_client.blob('{}/{}'.format(self.prefix, key)).upload_from_string(
+                new_value, if_generation_match=blob.generation if blob is not None else 0)
+        except PreconditionFailed:
+            return False
+        return True
+
+    def entries(self, prefix=''):
+        """
+        Returns:
+            entries: list - (key, size in bytes, last access timestamp, to GCS_ACCESS_RESOLUTION) tuples
+        """
+        blob_prefix = '{}/{}'.format(self.prefix, prefix)
+        return [(blob.name[len(self.prefix) + 1:], blob.size, self._lastAccess(blob))
+                for blob in self.bucket_client.list_blobs(prefix=blob_prefix)]
+
+    def delete(self, key):
+        self.bucket_client.delete_blob('{}/{}'.format(self.prefix, key))
+
+
+def getCacheBackend(storage_client, cache_uri):
+    """
+    Build the cache backend matching an URI.
+    Args:
+        storage_client: Storage client instantiation -
+        cache_uri: str - 'gs://bucket/prefix' or a local directory path
+
+    Returns:
+        backend: LocalCacheBackend or GCSCacheBackend
+    """
+    if cache_uri.startswith('gs://'):
+        if not hasattr(storage_client, 'bucket'):
+            raise ValueError('{} is on GCS but the storage is a local directory (STORAGE_URI), use a local directory '
+                             'for this cache too.'.format(cache_uri))
+        bucket_name, _, prefix = cache_uri[len('gs://'):].partition('/')
+        return GCSCacheBackend(storage_client, bucket_name, prefix or 'ocr_cache')
+    return LocalCacheBackend(cache_uri)
+
+
+class OCRCache:
+    """
+    Content-addressed cache of OCR results. Documents are keyed by the sha256 of the pdf bytes and pages
+    by a hash of their content, so renamed copies and repeated pages (e.g cover sheets) are only OCR'd once.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.document_hits = 0
+        self.document_misses = 0
+        self.page_hits = 0
+        self.page_misses = 0
+        self.ocr_seconds = 0.0
+
+    def getDocument(self, doc_hash):
+        entry = self.backend.get('documents/{}.json'.format(doc_hash))
+        if entry is None:
+            self.document_misses += 1
+            return None
+        self.document_hits += 1
+        entry = json.loads(entry)
+        self.page_hits += entry['n_pages']
+        return entry['text']
+
+    def putDocument(self, doc_hash, text, n_pages):
+        self.backend.put('documents/{}.json'.format(doc_hash), json.dumps({'text': text, 'n_pages': n_pages}))
+
+    def getPage(self, page_hash):
+        return self.backend.get('pages/{}.txt'.format(page_hash))
+
+    def putPage(self, page_hash, text):
+        self.backend.put('pages/{}.txt'.format(page_hash), text)
+
+    def stats(self):
+        """
+        Summarise how much OCR the cache avoided.
+        Returns:
+            stats: dict - hit/miss counters, estimated Vision dollars and seconds saved
+        """
+        seconds_per_page = self.ocr_seconds / self.page_misses if self.page_misses else 0.0
+        return {'document_hits': self.document_hits,
+                'document_misses': self.document_misses,
+                'page_hits': self.page_hits,
+                'page_misses': self.page_misses,
+                'vision_dollars_saved': round(self.page_hits * VISION_PRICE_PER_PAGE, 4),
+                'seconds_saved': round(self.page_hits * seconds_per_page, 1)}
+
+    def logStats(self):
+        stats = self.stats()
+        logging.info('OCR cache: {} document hits, {} document misses, {} page hits, {} page misses. '
+                     'Saved ~${} of Vision API calls and ~{} seconds.'.format(stats['document_hits'],
+                                                                             stats['document_misses'],
+                                                                             stats['page_hits'],
+                                                                             stats['page_misses'],
+                                                                             stats['vision_dollars_saved'],
+                                                                             stats['seconds_saved']))
+
+
+class NERCache:
+    """
+    Cache of NER results. Entries are keyed by the sha256 of the text and namespaced by the model name, model
+    version and linker settings, so that changing any of them never returns stale entities.
+    """
+
+    def __init__(self, backend, model_name, model_version, linker_settings, max_bytes=None):
+        self.backend = backend
+        settings = json.dumps({'model_version': model_version, 'linker': linker_settings}, sort_keys=True)
+        self.namespace = 'ner/{}/{}'.format(model_name, hashlib.sha256(settings.encode('utf-8')).hexdigest()[:16])
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+    def _key(self, text):
+        return '{}/{}.json'.format(self.namespace, hashlib.sha256(text.encode('utf-8')).hexdigest())
+
+    def get(self, text):
+        """
+        Returns:
+            entity_spans: list - (start_char, end_char, entity, TUI code, CUI) tuples, None if not cached
+        """
+        entry = self.backend.get(self._key(text))
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return [tuple(entity_span) for entity_span in json.loads(entry)]
+
+    def put(self, text, entity_spans):
+        self.backend.put(self._key(text), json.dumps(entity_spans))
+
+    def evict(self):
+        """
+        Delete the least recently used entries, of all models, until the cache fits in max_bytes.
+        Returns:
+            n_evicted: int - number of entries deleted
+        """
+        if self.max_bytes is None:
+            return 0
+        entries = sorted(self.backend.entries('ner'), key=lambda entry: entry[2])
+        total_bytes = sum(size for _, size, _ in entries)
+        n_evicted = 0
+        for key, size, _ in entries:
+            if total_bytes <= self.max_bytes:
+                break
+            self.backend.delete(key)
+            total_bytes -= size
+            n_evicted += 1
+        logging.info('NER cache: {} entries evicted, {} MB used.'.format(n_evicted,
+                                                                        round(total_bytes / 1024 / 1024, 1)))
+        return n_evicted
+
+    def logStats(self):
+        logging.info('NER cache: {} hits, {} misses.'.format(self.hits, self.misses))
+
+
+def _hashPdfObject(obj, sha, visited):
+    """
+    Feed a pdf object and everything it references (fonts, images, content streams) to a hash, ignoring
+    object numbers so that identical pages hash the same whatever file they come from.
+    """
+    obj_id = (obj.idnum, obj.generation) if hasattr(obj, 'idnum') else None
+    if obj_id is not None:
+        if obj_id in visited:
+            sha.update(b'<ref>')
+            return
+        visited.add(obj_id)
+        obj = obj.getObject()
+
+    if isinstance(obj, dict):
+        sha.update(b'<<')
+        for key in sorted(obj.keys()):
+            # /Parent points back to the page tree, which differs between documents
+            if key == '/Parent':
+                continue
+            sha.update(str(key).encode('utf-8'))
+            _hashPdfObject(obj.raw_get(key) if hasattr(obj, 'raw_get') else obj[key], sha, visited)
+        sha.update(b'>>')
+        data = getattr(obj, '_data', None)
+        if data is not None:
+            sha.update(data)
+    elif isinstance(obj, list):
+        sha.update(b'[')
+        for item in obj:
+            _hashPdfObject(item, sha, visited)
+        sha.update(b']')
+    else:
+        sha.update(repr(obj).encode('utf-8'))
+
+
+def hashPdfPages(pdf_reader):
+    """
+    Compute one content hash per page.
+    Args:
+        pdf_reader: PdfFileReader -
+
+    Returns:
+        page_hashes: list - sha256 hex digest of each page
+    """
+    page_hashes = []
+    for page_idx in range(pdf_reader.getNumPages()):
+        sha = hashlib.sha256()
+        _hashPdfObject(pdf_reader.getPage(page_idx), sha, set())
+        page_hashes.append(sha.hexdigest())
+    return page_hashes
+
+
+def readJsonPages(storage_client, bucket_name, json_prefix):
+    """
+    Parse the json files written by Vision and return the text of each page.
+    Args:
+        storage_client:
+        bucket_name:
+        json_prefix: str - e.g 'json/case1-'
+
+    Returns:
+        page_texts: dict - key: page number (starting at 1) and value: text
+    """
+    storage_backend = asStorage(storage_client)
+    page_texts = {}
+    for blob_name in storage_backend.listNames(bucket_name, prefix=json_prefix):
+        # Outputs of a page range split by OCRPlanner are numbered from the start of the range
+        range_match = re.match(r'p(\d+)-', blob_name[len(json_prefix):])
+        page_offset = int(range_match.group(1)) - 1 if range_match else 0
+        with storage_backend.openStream(bucket_name, blob_name) as json_stream:
+            for page_number, text in iterJsonPageTexts(json_stream):
+                page_texts[page_number + page_offset] = text
+    return page_texts
+
+
+def _deletePrefix(storage_client, bucket_name, prefix):
+    for blob in storage_client.list_blobs(bucket_or_name=bucket_name, prefix=prefix):
+        blob.delete()
+
+
+def cachedDocumentOCR(vision_client, storage_client, ocr_cache, ocr_fcn, gcs_source_uri, bucket_name, doc_title):
+    """
+    OCR a pdf on GCS, reusing cached text for already seen documents and pages. Only the pages missing from
+    the cache are sent to Vision.
+    Args:
+        vision_client:
+        storage_client:
+        ocr_cache: OCRCache -
+        ocr_fcn: function - OCR helper with the signature of async_detect_document
+        gcs_source_uri: str - gs:// path of the pdf
+        bucket_name: str - bucket receiving the json output of Vision
+        doc_title: str -
+
+    Returns:
+        all_text: str - Containing all text of the document, same layout as readJsonResult
+    """
+    src_bucket, _, src_name = gcs_source_uri[len('gs://'):].partition('/')
+    pdf_bytes = storage_client.bucket(src_bucket).blob(src_name).download_as_string()
+    doc_hash = hashlib.sha256(pdf_bytes).hexdigest()
+
+    all_text = ocr_cache.getDocument(doc_hash)
+    if all_text is not None:
+        logging.info('{} is a duplicate of an already OCR\'d document, reusing cached text.'.format(doc_title))
+        return all_text
+
+    pdf_reader = PdfFileReader(io.BytesIO(pdf_bytes), strict=False)
+    page_hashes = hashPdfPages(pdf_reader)
+
+    page_texts = {}
+    missing_pages = []
+    for page_number, page_hash in enumerate(page_hashes, start=1):
+        text = ocr_cache.getPage(page_hash)
+        if text is None:
+            missing_pages.append(page_number)
+        else:
+            page_texts[page_number] = text
+    ocr_cache.page_hits += len(page_texts)
+    ocr_cache.page_misses += len(missing_pages)
+
+    if missing_pages:
+        start_time = time.time()
+        # Outputs are written under a prefix of their own, the shared json/{doc_title}- prefix may hold stale
+        # shards of previous runs
+        json_prefix = 'ocr_cache_tmp/json/{}-'.format(doc_hash)
+        partial_blob = None
+        # Leftovers of an interrupted run of the same pdf
+        _deletePrefix(storage_client, bucket_name, json_prefix)
+        try:
+            if len(missing_pages) == len(page_hashes):
+                ocr_fcn(vision_client, gcs_source_uri, 'gs://{}/{}'.format(bucket_name, json_prefix))
+                page_texts.update(readJsonPages(storage_client, bucket_name, json_prefix))
+            else:
+                # Build a pdf holding only the pages missing from the cache
+                pdf_writer = PdfFileWriter()
+                for page_number in missing_pages:
+                    pdf_writer.addPage(pdf_reader.getPage(page_number - 1))
+                partial_pdf = io.BytesIO()
+                pdf_writer.write(partial_pdf)
+
+                partial_name = 'ocr_cache_tmp/{}.pdf'.format(doc_hash)
+                upload_blob = storage_client.bucket(bucket_name).blob(partial_name)
+                upload_blob.upload_from_string(partial_pdf.getvalue(), content_type='application/pdf')
+                partial_blob = upload_blob
+
+                ocr_fcn(vision_client, 'gs://{}/{}'.format(bucket_name, partial_name),
+                        'gs://{}/{}'.format(bucket_name, json_prefix))
+                partial_texts = readJsonPages(storage_client, bucket_name, json_prefix)
+                for partial_page_number, text in partial_texts.items():
+                    page_texts[missing_pages[partial_page_number - 1]] = text
+        finally:
+            # The outputs are only meaningful for this request, their text now lives in the cache
+            if partial_blob is not None:
+                partial_blob.delete()
+            _deletePrefix(storage_client, bucket_name, json_prefix)
+        ocr_cache.ocr_seconds += time.time() - start_time
+
+        # Pages missing from the Vision output (failed or truncated shard) are not cached, they are OCR'd again by
+        # the next document sharing them
+        for page_number in missing_pages:
+            if page_number in page_texts:
+                ocr_cache.putPage(page_hashes[page_number - 1], page_texts[page_number])
+
+    all_text = ''
+    for page_number in range(1, len(page_hashes) + 1):
+        all_text += page_texts.get(page_number, '')
+        all_text += ' '
+
+    n_unread = len(page_hashes) - len(page_texts)
+    if n_unread:
+        logging.warning('OCR of {}: {} pages missing from the Vision output, the document is not cached.'.format(
+            doc_title, n_unread))
+    else:
+        ocr_cache.putDocument(doc_hash, all_text, len(page_hashes))
+    logging.info('OCR of {}: {} pages from cache, {} pages sent to Vision.'.format(doc_title,
+                                                                                 len(page_hashes) - len(missing_pages),
+                                                                                 len(missing_pages)))
+    return all_text
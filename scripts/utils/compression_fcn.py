@@ -0,0 +1,75 @@
+import gzip
+import os
+
+# Magic numbers, used when no Content-Encoding metadata is available (e.g local files)
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+
+def textCompression():
+    """
+    Compression selected for the text outputs of the pipeline.
+    Returns:
+        compression: str - 'gzip', 'zstd' or None, read from the TEXT_COMPRESSION environment variable
+    """
+    return os.getenv('TEXT_COMPRESSION') or None
+
+
+def compress(data, encoding):
+    """
+    Args:
+        data: bytes or str - str are encoded in utf-8 first
+        encoding: str - 'gzip', 'zstd' or None to leave the data as is
+
+    Returns:
+        compressed: bytes
+    """
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    if not encoding:
+        return data
+    if encoding == 'gzip':
+        # mtime=0 keeps the output deterministic
+        return gzip.compress(data, compresslevel=6, mtime=0)
+    if encoding == 'zstd':
+        import zstandard
+        return zstandard.ZstdCompressor(level=10).compress(data)
+    raise ValueError('Unsupported compression: {}'.format(encoding))
+
+
+def decompress(data, encoding=None):
+    """
+    Args:
+        data: bytes-like -
+        encoding: str - Content-Encoding of the data, guessed from its first bytes if None
+
+    Returns:
+        decompressed: bytes-like, the data itself if it is not compressed
+    """
+    if encoding is None:
+        if bytes(data[:2]) == GZIP_MAGIC:
+            encoding = 'gzip'
+        elif bytes(data[:4]) == ZSTD_MAGIC:
+            encoding = 'zstd'
+    if encoding == 'gzip':
+        return gzip.decompress(data)
+    if encoding == 'zstd':
+        import zstandard
+        # Frames written by ZstdCompressor.compress include their size
+        return zstandard.ZstdDecompressor().decompress(data)
+    return data
+
+
+def downloadText(blob):
+    """
+    Download a text blob, decompressing it according to its Content-Encoding. Uncompressed blobs are read as is.
+    Args:
+        blob: google.cloud.storage Blob -
+
+    Returns:
+        text: str
+    """
+    if blob.content_encoding in ('gzip', 'zstd'):
+        # Skip decompressive transcoding, the data is decompressed here
+        return decompress(blob.download_as_string(raw_download=True), blob.content_encoding).decode('utf-8')
+    return blob.download_as_string().decode('utf-8')
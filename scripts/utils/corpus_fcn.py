@@ -0,0 +1,179 @@
+from concurrent.futures import ThreadPoolExecutor
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+import hashlib
+import logging
+import os
+import time
+
+from .compression_fcn import downloadText
+
+# Column of the corpus: GCS prefix holding the output of the stage
+STAGE_PREFIXES = {'it_raw_txt': 'raw_txt',
+                  'eng_raw_txt': 'eng_txt',
+                  'eng_txt': 'curated_eng_txt',
+                  'redacted_raw_txt': 'redacted_raw_txt'}
+
+
+def _docTitle(stage, blob_name):
+    """
+    Document title of a stage output, None for files that are not documents (e.g index.csv).
+    """
+    parts = blob_name.split('/')
+    if not blob_name.endswith('.txt') or any(part.startswith('_') for part in parts):
+        return None
+    # Batch translation writes eng_txt/{doc_title}/{bucket}_raw_txt_{doc_title}_en_translations.txt
+    if stage == 'eng_raw_txt' and len(parts) == 3:
+        return parts[1]
+    if len(parts) != 2:
+        return None
+    return parts[-1][:-len('.txt')]
+
+
+def _readCorpusIndex(corpus_path):
+    """
+    Previous version of the corpus, memory mapped, and its change detection columns.
+    Returns:
+        table: pyarrow Table - None without previous corpus
+        index: dict - key: case and value: (row index, dict of the md5 of each stage)
+    """
+    if not os.path.exists(corpus_path):
+        return None, {}
+    table = readCorpus(corpus_path)
+    # Only the case and md5 columns become python objects, the text stays in the memory map
+    md5_columns = ['{}_md5'.format(stage) for stage in STAGE_PREFIXES]
+    md5_rows = table.select(['case'] + md5_columns).to_pylist()
+    index = {row['case']: (row_idx, row) for row_idx, row in enumerate(md5_rows)}
+    return table, index
+
+
+def buildCorpus(storage_client, bucket_name, corpus_path, max_workers=16):
+    """
+    Consolidate the outputs of all stages into a single Arrow file with one row per case and one column per
+    stage, plus the sha256, GCS md5 and update time of each output. Outputs unchanged since the previous build
+    are not downloaded again.
+    Args:
+        storage_client: Storage client instantiation -
+        bucket_name: str - bucket holding the stage outputs
+        corpus_path: str - local path of the Arrow file, e.g './content/corpus.arrow'
+        max_workers: int - number of concurrent downloads
+
+    Returns:
+        n_cases: int - number of cases in the corpus
+    """
+    start_time = time.time()
+    previous_table, previous_index = _readCorpusIndex(corpus_path)
+
+    blobs = {}
+    for stage, prefix in STAGE_PREFIXES.items():
+        for blob in storage_client.list_blobs(bucket_or_name=bucket_name, prefix=prefix + '/'):
+            doc_title = _docTitle(stage, blob.name)
+            if doc_title is not None:
+                blobs[(doc_title, stage)] = blob
+
+    # key: (doc_title, stage) and value: row index of the unchanged output in the previous corpus
+    reused = {}
+    to_download = []
+    for (doc_title, stage), blob in blobs.items():
+        row_idx, previous_md5s = previous_index.get(doc_title, (None, {}))
+        if row_idx is not None and previous_md5s.get('{}_md5'.format(stage)) == blob.md5_hash:
+            reused[(doc_title, stage)] = row_idx
+        else:
+            to_download.append((doc_title, stage, blob))
+
+    # key: (doc_title, stage) and value: dict of the columns of the output
+    downloaded = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        texts = executor.map(lambda item: downloadText(item[2]), to_download)
+        for (doc_title, stage, blob), text in zip(to_download, texts):
+            sha256 = hashlib.sha256(text.encode('utf-8')).hexdigest()
+            downloaded[(doc_title, stage)] = {stage: text,
+                                              '{}_sha256'.format(stage): sha256,
+                                              '{}_md5'.format(stage): blob.md5_hash,
+                                              '{}_updated'.format(stage): blob.updated}
+
+    fields = [pa.field('case', pa.string())]
+    for stage in STAGE_PREFIXES:
+        fields += [pa.field(stage, pa.large_string()),
+                   pa.field('{}_sha256'.format(stage), pa.string()),
+                   pa.field('{}_md5'.format(stage), pa.string()),
+                   pa.field('{}_updated'.format(stage), pa.timestamp('us', tz='UTC'))]
+    schema = pa.schema(fields)
+
+    cases = sorted({doc_title for doc_title, _ in blobs})
+    columns = {'case': pa.array(cases, pa.string())}
+    for stage in STAGE_PREFIXES:
+        # Unchanged outputs are copied from the previous corpus as Arrow slices, never as python strings
+        take_indices = pa.array([reused.get((doc_title, stage)) for doc_title in cases], pa.int64())
+        is_downloaded = pa.array([(doc_title, stage) in downloaded for doc_title in cases], pa.bool_())
+        for column in [stage, '{}_sha256'.format(stage), '{}_md5'.format(stage), '{}_updated'.format(stage)]:
+            new_values = pa.array([downloaded.get((doc_title, stage), {}).get(column) for doc_title in cases],
+                                  schema.field(column).type)
+            if previous_table is None:
+                columns[column] = new_values
+            else:
+                previous_values = previous_table.column(column).take(take_indices).combine_chunks()
+                columns[column] = pc.if_else(is_downloaded, new_values, previous_values)
+    table = pa.Table.from_pydict(columns, schema=schema)
+
+    # Write next to the destination then rename, readers never see a partial file
+    tmp_path = corpus_path + '.tmp'
+    with pa.OSFile(tmp_path, 'wb') as sink:
+        with pa.ipc.new_file(sink, schema) as writer:
+            writer.write_table(table)
+    os.replace(tmp_path, corpus_path)
+
+    total_time = time.time() - start_time
+    logging.info('Corpus of {} cases written to {}: {} outputs downloaded, {} reused, in {} seconds.'.format(
+        len(cases), corpus_path, len(to_download), len(reused), round(total_time, 1)))
+    return len(cases)
+
+
+def readCorpus(corpus_path, columns=None):
+    """
+    Memory map the corpus: columns are only paged in from disk when they are accessed.
+    Args:
+        corpus_path: str - Arrow file written by buildCorpus
+        columns: list - Optional, columns to select
+
+    Returns:
+        table: pyarrow Table
+    """
+    source = pa.memory_map(corpus_path, 'r')
+    table = pa.ipc.open_file(source).read_all()
+    if columns is not None:
+        table = table.select(columns)
+    return table
+
+
+def iterCorpus(corpus_path, columns, batch_size=64):
+    """
+    Sequential scan of the corpus.
+    Args:
+        corpus_path: str - Arrow file written by buildCorpus
+        columns: list - columns to return, e.g ['case', 'eng_txt']
+        batch_size: int - number of rows converted to python objects at once
+
+    Returns:
+        generator of row dicts, rows missing an output of the selected stages are skipped
+    """
+    table = readCorpus(corpus_path, columns)
+    for batch in table.to_batches(max_chunksize=batch_size):
+        for row in batch.to_pylist():
+            if all(row[column] is not None for column in columns):
+                yield row
+
+
+def exportCorpusParquet(corpus_path, parquet_path):
+    """
+    Export the corpus to Parquet, e.g for analysis with pandas or BigQuery.
+    Args:
+        corpus_path: str - Arrow file written by buildCorpus
+        parquet_path: str -
+
+    Returns:
+
+    """
+    pq.write_table(readCorpus(corpus_path), parquet_path, compression='zstd')
+    logging.info('Corpus exported to {}.'.format(parquet_path))
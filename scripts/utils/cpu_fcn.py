@@ -0,0 +1,148 @@
+from concurrent.futures import ProcessPoolExecutor, wait
+from multiprocessing import shared_memory
+import multiprocessing
+import logging
+import os
+import time
+
+# Function applied by the worker processes, set once per process by _initWorker
+_worker_fcn = None
+_worker_kwargs = {}
+
+
+def _initWorker(fcn, kwargs):
+    global _worker_fcn, _worker_kwargs
+    _worker_fcn = fcn
+    _worker_kwargs = kwargs
+
+
+def _packTexts(texts):
+    """
+    Copy texts into a new shared memory block.
+    Returns:
+        shm: SharedMemory - the caller closes it, the reader unlinks it
+        offsets: list - (start, end) byte offsets of each text
+    """
+    encoded_texts = [text.encode('utf-8') for text in texts]
+    shm = shared_memory.SharedMemory(create=True, size=max(1, sum(len(encoded) for encoded in encoded_texts)))
+    offsets = []
+    position = 0
+    for encoded in encoded_texts:
+        shm.buf[position:position + len(encoded)] = encoded
+        offsets.append((position, position + len(encoded)))
+        position += len(encoded)
+    return shm, offsets
+
+
+def _unpackTexts(shm_name, offsets, unlink=False):
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        # Decoded straight from the shared buffer, no intermediate bytes copy
+        return [str(shm.buf[start:end], 'utf-8') for start, end in offsets]
+    finally:
+        shm.close()
+        if unlink:
+            shm.unlink()
+
+
+def _runChunk(shm_name, offsets):
+    texts = _unpackTexts(shm_name, offsets)
+    shm, result_offsets = _packTexts([_worker_fcn(text, **_worker_kwargs) for text in texts])
+    shm.close()
+    return shm.name, result_offsets
+
+
+class CPUStageExecutor:
+    """
+    Run a pure-python text transformation (curation, boilerplate stripping) on a pool of processes, so that it
+    uses all cores instead of one. Texts are handed to the workers by chunks through shared memory blocks rather
+    than pickled through the pool pipes, and the function is sent once per worker.
+    """
+
+    def __init__(self, fcn, n_workers=None, chunk_size=16, **kwargs):
+        """
+        Args:
+            fcn: function - module-level function or method of a picklable object, takes a str and returns a str
+            n_workers: int - number of processes, default to the number of cores available
+            chunk_size: int - number of texts per task, larger chunks amortize the task overhead
+            **kwargs: other arguments of fcn, e.g customize_stop_words
+        """
+        self.fcn = fcn
+        self.kwargs = kwargs
+        self.n_workers = n_workers or (len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity')
+                                       else os.cpu_count())
+        self.chunk_size = chunk_size
+        self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+    def map(self, texts):
+        """
+        Args:
+            texts: list - str
+
+        Returns:
+            results: list - outputs of fcn, in the order of texts
+        """
+        texts = list(texts)
+        start_time = time.time()
+
+        # A single chunk is not worth the process start-up
+        if self.n_workers <= 1 or len(texts) <= self.chunk_size:
+            return [self.fcn(text, **self.kwargs) for text in texts]
+
+        if self._pool is None:
+            # The batch scripts run at module level, forked workers do not import them again
+            mp_context = multiprocessing.get_context('fork') if 'fork' in multiprocessing.get_all_start_methods() \
+                else None
+            self._pool = ProcessPoolExecutor(max_workers=self.n_workers, mp_context=mp_context,
+                                             initializer=_initWorker, initargs=(self.fcn, self.kwargs))
+
+        input_blocks = []
+        futures = []
+        try:
+            for idx in range(0, len(texts), self.chunk_size):
+                shm, offsets = _packTexts(texts[idx:idx + self.chunk_size])
+                input_blocks.append(shm)
+                futures.append(self._pool.submit(_runChunk, shm.name, offsets))
+
+            results = []
+            for future in futures:
+                results.extend(_unpackTexts(*future.result(), unlink=True))
+        except Exception:
+            # Release the outputs of the chunks that did succeed
+            wait(futures)
+            for future in futures:
+                if future.done() and not future.cancelled() and future.exception() is None:
+                    try:
+                        _unpackTexts(future.result()[0], [], unlink=True)
+                    except FileNotFoundError:
+                        pass
+            raise
+        finally:
+            for shm in input_blocks:
+                shm.close()
+                shm.unlink()
+
+        logging.info('{} texts processed by {} processes in {} seconds.'.format(len(texts), self.n_workers,
+                                                                                round(time.time() - start_time, 1)))
+        return results
+
+
+def mapTexts(fcn, texts, n_workers=None, chunk_size=16, **kwargs):
+    """
+    Apply fcn to all texts on a pool of processes, see CPUStageExecutor.
+    Returns:
+        results: list - outputs of fcn, in the order of texts
+    """
+    with CPUStageExecutor(fcn, n_workers=n_workers, chunk_size=chunk_size, **kwargs) as executor:
+        return executor.map(texts)
@@ -0,0 +1,175 @@
+import logging
+import re
+
+# Frequent function words, excluding the ones shared by both languages (e.g 'a', 'in', 'non')
+ENGLISH_STOP_WORDS = {
+    'the', 'and', 'of', 'to', 'is', 'was', 'were', 'with', 'for', 'on', 'at', 'by', 'from', 'that', 'this',
+    'are', 'an', 'be', 'as', 'which', 'has', 'have', 'had', 'not', 'or', 'after', 'patient', 'showed', 'left',
+    'right', 'lung', 'chest', 'years', 'old', 'there', 'no', 'it', 'its', 'also', 'both', 'into'
+}
+ITALIAN_STOP_WORDS = {
+    'il', 'lo', 'la', 'gli', 'le', 'di', 'del', 'della', 'dei', 'delle', 'degli', 'e', 'è', 'che', 'per', 'con',
+    'un', 'una', 'al', 'alla', 'ai', 'sono', 'nel', 'nella', 'si', 'da', 'dal', 'dalla', 'dopo', 'paziente',
+    'anni', 'stato', 'stata', 'polmonare', 'polmone', 'torace', 'sinistro', 'destro', 'ed', 'ha', 'anche',
+    'tra', 'su', 'sul', 'sulla', 'quadro', 'esame', 'dx', 'sx'
+}
+
+pattern_words = re.compile(r"[a-zàèéìòù]+")
+
+
+def detectLanguage(text, min_hits=2):
+    """
+    Guess if a text is in English or Italian by counting frequent function words.
+    Args:
+        text: str -
+        min_hits: int - minimum number of function words to make a decision
+
+    Returns:
+        lang: str - 'en', 'it' or None if the text is too short or ambiguous
+    """
+    tokens = pattern_words.findall(text.lower())
+    en_hits = sum(token in ENGLISH_STOP_WORDS for token in tokens)
+    it_hits = sum(token in ITALIAN_STOP_WORDS for token in tokens)
+
+    if max(en_hits, it_hits) < min_hits or en_hits == it_hits:
+        return None
+    return 'en' if en_hits > it_hits else 'it'
+
+
+def splitLanguageSpans(text, default_lang='it'):
+    """
+    Split a text into consecutive runs of lines in the same language. Lines too short to be identified
+    (titles, numbers, OCR fragments) join the span they are in.
+    Args:
+        text: str -
+        default_lang: str - language of the leading lines if none can be identified
+
+    Returns:
+        spans: list - (lang, span_text) tuples, joining all span_text gives back the input text
+    """
+    spans = []
+    pending_lines = ''
+    for line in text.splitlines(keepends=True):
+        lang = detectLanguage(line)
+        if lang is None:
+            pending_lines += line
+            continue
+
+        if spans and spans[-1][0] == lang:
+            spans[-1] = (lang, spans[-1][1] + pending_lines + line)
+        elif spans:
+            # Unidentified lines between two languages stay with the previous span
+            spans[-1] = (spans[-1][0], spans[-1][1] + pending_lines)
+            spans.append((lang, line))
+        else:
+            spans.append((lang, pending_lines + line))
+        pending_lines = ''
+
+    if spans:
+        spans[-1] = (spans[-1][0], spans[-1][1] + pending_lines)
+    elif pending_lines:
+        spans.append((default_lang, pending_lines))
+    return spans
+
+
+def documentLanguage(spans):
+    """
+    Summarise the languages of a document.
+    Args:
+        spans: list - output of splitLanguageSpans
+
+    Returns:
+        lang: str - 'en' or 'it' if the document uses a single language, 'mixed' otherwise
+    """
+    langs = {lang for lang, _ in spans}
+    if len(langs) == 1:
+        return langs.pop()
+    return 'mixed'
+
+
+def splitOnBoundaries(text, max_size, size_fcn=len, separators=('\n', '. ', ' ')):
+    """
+    Split a text into parts under a size limit, cutting on line, then sentence, then word boundaries, and on
+    characters for what has no boundary left.
+    Args:
+        text: str -
+        max_size: int - maximum size of a part
+        size_fcn: function - size of a str, e.g the number of utf-8 bytes, default to the number of characters
+        separators: tuple - boundaries from the preferred one, kept at the end of the parts
+
+    Returns:
+        parts: list - str, joining them gives back the input text
+    """
+    if size_fcn(text) <= max_size:
+        return [text]
+    if not separators:
+        parts = []
+        start = 0
+        while start < len(text):
+            end = start + max_size
+            while end - start > 1 and size_fcn(text[start:end]) > max_size:
+                end = start + (end - start) // 2
+            parts.append(text[start:end])
+            start = end
+        return parts
+
+    parts = []
+    part_pieces = []
+    part_size = 0
+    for piece in re.split('(?<={})'.format(re.escape(separators[0])), text):
+        piece_size = size_fcn(piece)
+        if part_pieces and part_size + piece_size > max_size:
+            parts.append(''.join(part_pieces))
+            part_pieces = []
+            part_size = 0
+        if piece_size > max_size:
+            parts.extend(splitOnBoundaries(piece, max_size, size_fcn, separators[1:]))
+            continue
+        part_pieces.append(piece)
+        part_size += piece_size
+    if part_pieces:
+        parts.append(''.join(part_pieces))
+    return parts
+
+
+def translateSpans(translate_client, project_id, spans, src_lang='it', target_lang='en-US', max_chars=25000):
+    """
+    Translate only the spans in the source language and merge them back in order with the untouched spans.
+    Args:
+        translate_client:
+        project_id: str -
+        spans: list - output of splitLanguageSpans
+        src_lang: str -
+        target_lang: str -
+        max_chars: int - maximum number of characters sent per request
+
+    Returns:
+        translated_txt: str - full text in the target language
+    """
+    parent = translate_client.location_path(project_id, location="global")
+    # Spans over the size limit are translated as several parts, joined back afterwards
+    spans = [(lang, part) for lang, span in spans
+             for part in (splitOnBoundaries(span, max_chars) if lang == src_lang else [span])]
+    src_idx = [idx for idx, (lang, _) in enumerate(spans) if lang == src_lang]
+
+    # Group the spans into requests under the size limit
+    requests = []
+    for idx in src_idx:
+        if not requests or sum(len(spans[i][1]) for i in requests[-1]) + len(spans[idx][1]) > max_chars:
+            requests.append([])
+        requests[-1].append(idx)
+
+    translated = {}
+    for request_idx in requests:
+        response = translate_client.translate_text(parent=parent,
+                                                   contents=[spans[idx][1] for idx in request_idx],
+                                                   mime_type="text/plain",
+                                                   source_language_code=src_lang,
+                                                   target_language_code=target_lang)
+        for idx, translation in zip(request_idx, response.translations):
+            translated[idx] = translation.translated_text
+
+    n_chars = sum(len(spans[idx][1]) for idx in src_idx)
+    logging.info('Translated {} out of {} characters, the rest was already in {}.'.format(
+        n_chars, sum(len(span) for _, span in spans), target_lang))
+    return ''.join(translated.get(idx, span) for idx, (_, span) in enumerate(spans))
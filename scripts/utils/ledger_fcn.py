@@ -0,0 +1,180 @@
+import json
+import logging
+import time
+import zlib
+
+from .cache_fcn import getCacheBackend
+
+# Cloud Functions time out after 9 minutes at most, a delivery still running after that has died
+LEASE_SECONDS = 540
+
+
+class DatastoreLedgerBackend:
+    """
+    Ledger backend storing entries as unindexed, zlib compressed Datastore entities.
+    """
+
+    # Datastore entities are limited to 1 MiB
+    MAX_VALUE_BYTES = 1000000
+
+    def __init__(self, datastore_client, kind='ledger'):
+        self.datastore_client = datastore_client
+        self.kind = kind
+
+    def get(self, key):
+        entity = self.datastore_client.get(self.datastore_client.key(self.kind, key))
+        if entity is None:
+            return None
+        return zlib.decompress(entity['value']).decode('utf-8')
+
+    def _entity(self, key, value):
+        from google.cloud import datastore
+
+        compressed_value = zlib.compress(value.encode('utf-8'))
+        if len(compressed_value) > self.MAX_VALUE_BYTES:
+            raise ValueError('Ledger entry {} is too large for Datastore: {} bytes.'.format(key,
+                                                                                          len(compressed_value)))
+        entity = datastore.Entity(key=self.datastore_client.key(self.kind, key), exclude_from_indexes=('value',))
+        entity.update({'value': compressed_value, 'updated': time.time()})
+        return entity
+
+    def put(self, key, value):
+        self.datastore_client.put(self._entity(key, value))
+
+    def atomicUpdate(self, key, update_fcn):
+        """
+        Read-modify-write of an entry in a transaction, see LocalCacheBackend.atomicUpdate.
+        """
+        from google.api_core.exceptions import Aborted, Conflict
+
+        try:
+            with self.datastore_client.transaction():
+                entity = self.datastore_client.get(self.datastore_client.key(self.kind, key))
+                new_value = update_fcn(zlib.decompress(entity['value']).decode('utf-8') if entity else None)
+                if new_value is None:
+                    return False
+                self.datastore_client.put(self._entity(key, new_value))
+        except (Aborted, Conflict):
+            # Another transaction wrote the entry since it was read
+            return False
+        return True
+
+
+def getLedgerBackend(storage_client, ledger_uri):
+    """
+    Build the ledger backend matching an URI.
+    Args:
+        storage_client: Storage client instantiation -
+        ledger_uri: str - 'datastore://kind', 'gs://bucket/prefix' or a local directory path
+
+    Returns:
+        backend: DatastoreLedgerBackend, LocalCacheBackend or GCSCacheBackend
+    """
+    if ledger_uri.startswith('datastore://'):
+        from google.cloud import datastore
+        return DatastoreLedgerBackend(datastore.Client(), ledger_uri[len('datastore://'):] or 'ledger')
+    return getCacheBackend(storage_client, ledger_uri)
+
+
+class EventLedger:
+    """
+    Idempotency ledger of a document processed by a Cloud Function. GCS and Pub/Sub deliver events at least once:
+    the record of the document, keyed by its object generation, short-circuits the deliveries of a document already
+    processed or being processed, and the output of each finished step is kept so that a retry resumes from the
+    last finished step instead of paying for OCR, translation and redaction again.
+    Without a backend every step is run, as without ledger.
+    """
+
+    def __init__(self, backend, namespace, event_id, lease_seconds=LEASE_SECONDS):
+        self.backend = backend
+        self.prefix = 'ledger/{}'.format(namespace)
+        self.event_id = event_id
+        self.lease_seconds = lease_seconds
+        self.steps_resumed = 0
+        self.record = self._newRecord()
+
+    @staticmethod
+    def _newRecord():
+        return {'status': 'new', 'owner': None, 'updated': 0, 'event_ids': [], 'steps': []}
+
+    def _save(self):
+        self.record['updated'] = time.time()
+        self.backend.put(self.prefix + '/record.json', json.dumps(self.record))
+
+    def claim(self):
+        """
+        Claim the document for this delivery. The record is read and written atomically, of concurrent duplicate
+        deliveries only one gets the claim.
+        Returns:
+            claimed: bool - False for a duplicate delivery, the document is done or another delivery is processing it
+        """
+        if self.backend is None:
+            return True
+
+        outcome = {'skip_reason': 'was claimed concurrently by another delivery'}
+
+        def claimRecord(value):
+            record = json.loads(value) if value else self._newRecord()
+            if record['status'] == 'done':
+                outcome['skip_reason'] = 'is already processed'
+                return None
+            if (record['status'] == 'running' and record['owner'] != self.event_id
+                    and time.time() - record['updated'] < self.lease_seconds):
+                outcome['skip_reason'] = 'is being processed by event {}'.format(record['owner'])
+                return None
+            record['status'] = 'running'
+            record['owner'] = self.event_id
+            record['updated'] = time.time()
+            if self.event_id not in record['event_ids']:
+                record['event_ids'].append(self.event_id)
+            outcome['record'] = record
+            return json.dumps(record)
+
+        if not self.backend.atomicUpdate(self.prefix + '/record.json', claimRecord):
+            logging.info('{} {}, duplicate event {} skipped.'.format(self.prefix, outcome['skip_reason'],
+                                                                     self.event_id))
+            return False
+
+        self.record = outcome['record']
+        if self.record['steps']:
+            logging.info('{} resumed by event {} after steps: {}.'.format(self.prefix, self.event_id,
+                                                                         ', '.join(self.record['steps'])))
+        return True
+
+    def step(self, name, fcn, *args, **kwargs):
+        """
+        Run a step of the document, or return its output if a previous delivery already finished it.
+        Args:
+            name: str - e.g 'ocr'
+            fcn: function - the step, its output must be json serializable
+            *args, **kwargs: arguments of fcn
+
+        Returns:
+            output: output of fcn
+        """
+        if self.backend is None:
+            return fcn(*args, **kwargs)
+
+        output_key = '{}/{}.json'.format(self.prefix, name)
+        if name in self.record['steps']:
+            output = self.backend.get(output_key)
+            if output is not None:
+                self.steps_resumed += 1
+                return json.loads(output)
+
+        output = fcn(*args, **kwargs)
+        try:
+            self.backend.put(output_key, json.dumps(output))
+        except ValueError as e:
+            logging.warning('{}, the step {} will run again on retry.'.format(e, name))
+            return output
+        self.record['steps'].append(name)
+        self._save()
+        return output
+
+    def complete(self):
+        if self.backend is None:
+            return
+        self.record['status'] = 'done'
+        self._save()
+        logging.info('{} done, {} steps resumed from previous deliveries.'.format(self.prefix, self.steps_resumed))
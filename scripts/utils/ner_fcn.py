@@ -1,8 +1,17 @@
 from google.cloud import datastore
 from scispacy.umls_linking import UmlsEntityLinker
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+import json
 import logging
 import pandas as pd
 import re
+import time
+
+from .cache_fcn import NERCache, getCacheBackend
+from .corpus_fcn import iterCorpus
+from .profiling_fcn import StageProfiler
+from .storage_fcn import asStorage
 
 def importModel(model_name):
     """
@@ -11,30 +20,54 @@ def importModel(model_name):
         model_name: str -
 
     Returns:
-
+        model: imported model package, None if the model is not supported
     """
     if model_name == 'en_core_sci_sm':
         import en_core_sci_sm
+        return en_core_sci_sm
     elif model_name == 'en_core_sci_lg':
         import en_core_sci_lg
+        return en_core_sci_lg
     elif model_name == 'en_ner_bc5cdr_md':
         import en_ner_bc5cdr_md
+        return en_ner_bc5cdr_md
+
+# Speed profiles of the NER stage: components of the model left out and settings of the UMLS linker.
+# Only doc.ents and the UMLS entities are used, the tagger and parser do not change them.
+NER_PROFILES = {
+    'full': {'disable': [],
+             'linker': {'resolve_abbreviations': True}},
+    'fast': {'disable': ['tagger', 'parser'],
+             'linker': {'resolve_abbreviations': False}},
+    'linker-lite': {'disable': ['tagger', 'parser'],
+                    'linker': {'resolve_abbreviations': False, 'k': 10, 'threshold': 0.85}},
+}
 
-def loadModel(model):
+
+def loadModel(model, linker=None, profile='full'):
     """
     Loading Named Entity Recognition model.
     Args:
         model: options: en_core_sci_sm, en_core_sci_lg, en_ner_bc5cdr_md
+        linker: Optional, already loaded add-on to share between models instead of loading the UMLS KB again
+        profile: str - speed profile, key of NER_PROFILES
 
     Returns:
         nlp: loaded model
         linker: loaded add-on
     """
+    settings = NER_PROFILES[profile]
+
     # Load the model
-    nlp = model.load()
+    nlp = model.load(disable=settings['disable'])
 
     # Add pipe features to pipeline
-    linker = UmlsEntityLinker(resolve_abbreviations=True)
+    if linker is None:
+        linker = UmlsEntityLinker(**settings['linker'])
+    else:
+        # The linker settings are read at each call, a loaded linker can switch profile
+        for name, value in settings['linker'].items():
+            setattr(linker, name, value)
     nlp.add_pipe(linker)
 
     logging.info("Model and add-ons successfully loaded.")
@@ -50,128 +83,688 @@ def extractMedEntities(vectorized_doc, linker):
     Returns:
         UMLS_tuis_entity: dict - key: entity and value: TUI code
     """
+    UMLS_tuis_entity = {}
+    for _, _, entity, tui, _ in extractEntitySpans(vectorized_doc, linker):
+        UMLS_tuis_entity[entity] = tui
+    return UMLS_tuis_entity
+
+
+def extractEntitySpans(vectorized_doc, linker, offset=0):
+    """
+    Returns UMLS entities contained in a text along with their position.
+    Args:
+        vectorized_doc:
+        linker:
+        offset: int - position of the vectorized text in the whole document
+    Returns:
+        entity_spans: list - (start_char, end_char, entity, TUI code, CUI) tuples, positions in the whole document
+    """
     # Pattern for TUI code
     pattern = 'T(\d{3})'
 
-    UMLS_tuis_entity = {}
-    entity_dict = {}
-
-    for idx in range(len(vectorized_doc.ents)):
-        entity = vectorized_doc.ents[idx]
-        entity_dict[entity] = ''
+    entity_spans = []
+    for entity in vectorized_doc.ents:
+        umls_entity = ''
+        cui = None
         for umls_ent in entity._.umls_ents:
-            entity_dict[entity] = linker.umls.cui_to_entity[umls_ent[0]]
+            cui = umls_ent[0]
+            umls_entity = linker.umls.cui_to_entity[cui]
 
         # RegEx expression if contains TUI code
-        tui = re.search(pattern, str(entity_dict[entity]))
-        if tui:
-            UMLS_tuis_entity[str(entity)] = tui.group()
-        else:
-            UMLS_tuis_entity[str(entity)] = None
+        tui = re.search(pattern, str(umls_entity))
+        entity_spans.append((entity.start_char + offset, entity.end_char + offset, str(entity),
+                             tui.group() if tui else None, cui))
+    return entity_spans
 
-    return UMLS_tuis_entity
+
+def shardText(text, max_chars=100000, overlap=200):
+    """
+    Split a long text into shards small enough for the NER model, cutting on paragraph, sentence or word
+    boundaries. Consecutive shards overlap so that entities cut at the edge of a shard are complete in the next.
+    Args:
+        text: str -
+        max_chars: int - maximum length of a shard, must stay below nlp.max_length
+        overlap: int - number of characters shared by consecutive shards
+
+    Returns:
+        shards: list - (offset, own_start, own_end, shard_text) tuples. Each shard owns the entities starting in
+        [own_start, own_end), so that entities in the overlaps are only counted once.
+    """
+    cuts = []
+    start = 0
+    while len(text) - start > max_chars:
+        window_start = start + max_chars // 2
+        window_end = start + max_chars - overlap
+        # Prefer the last paragraph, then sentence, then word boundary of the window
+        cut = -1
+        for boundary in ['\n\n', '. ', '\n', ' ']:
+            cut = text.rfind(boundary, window_start, window_end)
+            if cut != -1:
+                cut += len(boundary)
+                break
+        if cut == -1:
+            cut = window_end
+        cuts.append(cut)
+        start = cut
+
+    shards = []
+    bounds = [0] + cuts + [len(text)]
+    for idx in range(len(bounds) - 1):
+        own_start, own_end = bounds[idx], bounds[idx + 1]
+        offset = own_start - overlap // 2 if idx > 0 else own_start
+        shard_end = own_end + overlap // 2 if idx < len(bounds) - 2 else own_end
+        shards.append((offset, own_start, own_end, text[offset:shard_end]))
+    return shards
+
+
+def mergeEntitySpans(shard_entity_spans):
+    """
+    Merge the entities of all the shards of a document.
+    Args:
+        shard_entity_spans: list - (own_start, own_end, entity_spans) tuples, one per shard
+
+    Returns:
+        entity_spans: list - (start_char, end_char, entity, TUI code, CUI) tuples sorted by position, without
+        duplicates
+    """
+    merged = {}
+    for own_start, own_end, entity_spans in shard_entity_spans:
+        for entity_span in entity_spans:
+            # Entities straddling a shard edge are found in both shards, keep the shard they start in
+            if own_start <= entity_span[0] < own_end:
+                merged.setdefault(entity_span[:2], entity_span)
+    return [merged[span] for span in sorted(merged)]
 
 
-def addTask(datastore_client, doc_title, entities_dict):
+def pipelineSettings(nlp, linker):
+    """
+    Components of the model and settings of the UMLS linker changing its output, part of the NER cache key.
+    Args:
+        nlp: loaded model
+        linker: loaded add-on
+
+    Returns:
+        settings: dict
+    """
+    settings = {name: getattr(linker, name, None) for name in ['resolve_abbreviations', 'k', 'threshold',
+                                                               'no_definition_threshold', 'filter_for_definitions',
+                                                               'max_entities_per_mention']}
+    settings['pipes'] = nlp.pipe_names
+    return settings
+
+
+def annotateCorpus(nlp, linker, docs, max_chars=100000, overlap=200, batch_size=16, ner_cache=None):
+    """
+    Run NER over a stream of documents. Documents are sharded and the shards of the whole corpus are batched
+    through nlp.pipe, so the memory used only depends on the shard size and not on the document size.
+    Args:
+        nlp: loaded model
+        linker: loaded add-on
+        docs: iterable - (doc_title, text) tuples
+        max_chars: int - maximum length of a shard
+        overlap: int - number of characters shared by consecutive shards
+        batch_size: int - number of shards vectorized together
+        ner_cache: NERCache - Optional, documents found in the cache skip the model
+
+    Returns:
+        generator of (doc_title, entity_spans) tuples, in the order of docs except for cached documents which
+        are returned as soon as they are read
+    """
+    cached_results = deque()
+
+    def _shardStream():
+        for doc_title, text in docs:
+            if ner_cache is not None:
+                entity_spans = ner_cache.get(text)
+                if entity_spans is not None:
+                    cached_results.append((doc_title, entity_spans))
+                    continue
+            shards = shardText(text, max_chars=max_chars, overlap=overlap)
+            for shard_idx, (offset, own_start, own_end, shard_text) in enumerate(shards):
+                is_last_shard = shard_idx == len(shards) - 1
+                yield shard_text, (doc_title, text if is_last_shard else None, offset, own_start, own_end)
+
+    shard_entity_spans = []
+    for vectorized_doc, context in nlp.pipe(_shardStream(), as_tuples=True, batch_size=batch_size):
+        while cached_results:
+            yield cached_results.popleft()
+        doc_title, text, offset, own_start, own_end = context
+        shard_entity_spans.append((own_start, own_end, extractEntitySpans(vectorized_doc, linker, offset)))
+        # The text is only carried by the last shard of a document
+        if text is not None:
+            entity_spans = mergeEntitySpans(shard_entity_spans)
+            if ner_cache is not None:
+                ner_cache.put(text, entity_spans)
+            yield doc_title, entity_spans
+            shard_entity_spans = []
+    while cached_results:
+        yield cached_results.popleft()
+
+
+def _annotateBatch(models, linker, batch, max_chars, overlap, batch_size, ner_caches):
+    """
+    Run every model over the shards of a batch of documents, the documents being sharded once for all models.
+    """
+    results = [(doc_title, {}) for doc_title, _ in batch]
+    doc_shards = [shardText(text, max_chars=max_chars, overlap=overlap) for _, text in batch]
+
+    for model_name, nlp in models.items():
+        ner_cache = ner_caches.get(model_name)
+        shard_entity_spans = {}
+        for doc_idx, (_, text) in enumerate(batch):
+            entity_spans = ner_cache.get(text) if ner_cache is not None else None
+            if entity_spans is None:
+                shard_entity_spans[doc_idx] = []
+            else:
+                results[doc_idx][1][model_name] = entity_spans
+
+        shard_stream = ((shard_text, (doc_idx, offset, own_start, own_end))
+                        for doc_idx in shard_entity_spans
+                        for offset, own_start, own_end, shard_text in doc_shards[doc_idx])
+        for vectorized_doc, context in nlp.pipe(shard_stream, as_tuples=True, batch_size=batch_size):
+            doc_idx, offset, own_start, own_end = context
+            shard_entity_spans[doc_idx].append((own_start, own_end,
+                                                extractEntitySpans(vectorized_doc, linker, offset)))
+
+        for doc_idx, entity_spans in shard_entity_spans.items():
+            results[doc_idx][1][model_name] = mergeEntitySpans(entity_spans)
+            if ner_cache is not None:
+                ner_cache.put(batch[doc_idx][1], results[doc_idx][1][model_name])
+    return results
+
+
+def annotateCorpusMulti(models, linker, docs, max_chars=100000, overlap=200, batch_size=16, ner_caches=None):
+    """
+    Run several NER models over a stream of documents read once. The documents are sharded once per batch and
+    each model goes through the same shards, all models sharing the same UMLS linker.
+    Args:
+        models: dict - key: model name and value: loaded model, see loadModel(model, linker)
+        linker: loaded add-on shared by the models
+        docs: iterable - (doc_title, text) tuples
+        max_chars: int - maximum length of a shard
+        overlap: int - number of characters shared by consecutive shards
+        batch_size: int - number of documents annotated together
+        ner_caches: dict - Optional, key: model name and value: NERCache
+
+    Returns:
+        generator of (doc_title, model_entity_spans) tuples, model_entity_spans being a dict with key: model
+        name and value: entity_spans
+    """
+    batch = []
+    for doc in docs:
+        batch.append(doc)
+        if len(batch) == batch_size:
+            yield from _annotateBatch(models, linker, batch, max_chars, overlap, batch_size, ner_caches or {})
+            batch = []
+    if batch:
+        yield from _annotateBatch(models, linker, batch, max_chars, overlap, batch_size, ner_caches or {})
+
+
+def _entityAgreement(reference_spans, entity_spans):
+    """
+    Micro precision, recall and F1 of entity spans against reference spans, matching on the position and on the
+    position and CUI.
+    """
+    scores = {}
+    for name, key_fcn in [('span', lambda span: (span[0], span[1])), ('cui', lambda span: (span[0], span[1], span[4]))]:
+        reference = {(doc_idx, key_fcn(span)) for doc_idx, spans in enumerate(reference_spans) for span in spans}
+        predicted = {(doc_idx, key_fcn(span)) for doc_idx, spans in enumerate(entity_spans) for span in spans}
+        n_common = len(reference & predicted)
+        precision = n_common / len(predicted) if predicted else 1.0
+        recall = n_common / len(reference) if reference else 1.0
+        scores['{}_precision'.format(name)] = round(precision, 3)
+        scores['{}_recall'.format(name)] = round(recall, 3)
+        scores['{}_f1'.format(name)] = round(2 * precision * recall / (precision + recall), 3) \
+            if precision + recall else 0.0
+    return scores
+
+
+def benchmarkProfiles(model_name, docs, profiles=('full', 'fast', 'linker-lite'), batch_size=16):
+    """
+    Compare the throughput of the NER speed profiles and their agreement with the full profile on the same
+    documents. The UMLS linker is loaded once and switched from one profile to the next.
+    Args:
+        model_name: str -
+        docs: list - (doc_title, text) tuples, a fixed sample of the corpus
+        profiles: list - keys of NER_PROFILES
+        batch_size: int - number of document shards vectorized together
+
+    Returns:
+        results: dict - key: profile and value: docs per second, number of entities and agreement with 'full'
+    """
+    model = importModel(model_name)
+    linker = None
+    profile_spans = {}
+    results = {}
+    for profile in ['full'] + [profile for profile in profiles if profile != 'full']:
+        nlp, linker = loadModel(model=model, linker=linker, profile=profile)
+
+        start_time = time.time()
+        profile_spans[profile] = [entity_spans for _, entity_spans in annotateCorpus(nlp, linker, docs,
+                                                                                       batch_size=batch_size)]
+        total_time = time.time() - start_time
+
+        results[profile] = {'docs_per_second': round(len(docs) / total_time, 2),
+                            'chars_per_second': round(sum(len(text) for _, text in docs) / total_time),
+                            'n_entities': sum(len(entity_spans) for entity_spans in profile_spans[profile])}
+        results[profile].update(_entityAgreement(profile_spans['full'], profile_spans[profile]))
+        logging.info('NER profile {}: {}'.format(profile, results[profile]))
+    return results
+
+
+def normalizeEntity(entity):
+    """
+    Normalize an entity mention: case-folded, whitespace collapsed.
+    Args:
+        entity: str -
+
+    Returns:
+        normalized_entity: str
+    """
+    return ' '.join(entity.casefold().split())
+
+
+def countEntities(entity_spans, tui_categories):
+    """
+    Deduplicate the mentions of a document: mentions are grouped by CUI, or by their normalized text when they
+    are not linked, and counted.
+    Args:
+        entity_spans: list - (start_char, end_char, entity, TUI code, CUI) tuples, output of annotateCorpus
+        tui_categories: dict - key: TUI and value: category, read from UMLS_tuis.csv
+
+    Returns:
+        entity_rows: list - dicts with the category, entity (most frequent normalized mention), tui, cui and count
+        keys, entities without a known category are left out
+    """
+    mentions = {}
+    for _, _, entity, tui, cui in entity_spans:
+        if tui not in tui_categories:
+            continue
+        normalized_entity = normalizeEntity(entity)
+        key = (cui, None if cui else normalized_entity, tui)
+        mentions.setdefault(key, {}).setdefault(normalized_entity, 0)
+        mentions[key][normalized_entity] += 1
+
+    entity_rows = []
+    for (cui, _, tui), surface_counts in mentions.items():
+        # Most frequent mention first, then alphabetical, so that the name is stable between runs
+        entity = sorted(surface_counts.items(), key=lambda item: (-item[1], item[0]))[0][0]
+        entity_rows.append({'category': tui_categories[tui], 'entity': entity, 'tui': tui, 'cui': cui,
+                            'count': sum(surface_counts.values())})
+    return sorted(entity_rows, key=lambda row: (row['category'], row['entity']))
+
+
+def compactEntities(entity_spans, tui_categories, prefix=''):
+    """
+    Compact Datastore representation of the entities of a document. Only the properties used as filters are
+    indexed: the deduplicated, normalized mentions of each category and the CUIs. The mention counts per CUI are
+    stored in an unindexed json property.
+    Args:
+        entity_spans: list - output of annotateCorpus
+        tui_categories: dict - key: TUI and value: category, read from UMLS_tuis.csv
+        prefix: str - prefix of the property names, e.g 'en_core_sci_sm:'
+
+    Returns:
+        entities_dict: dict - key: property name and value: property value
+        unindexed: list - names of the properties to exclude from indexes
+    """
+    entity_rows = countEntities(entity_spans, tui_categories)
+
+    # Every normalized mention stays searchable, not only the canonical name of its CUI
+    entities_dict = {}
+    for _, _, entity, tui, _ in entity_spans:
+        if tui not in tui_categories:
+            continue
+        names = entities_dict.setdefault(prefix + tui_categories[tui], [])
+        if normalizeEntity(entity) not in names:
+            names.append(normalizeEntity(entity))
+    entities_dict[prefix + 'cuis'] = sorted({row['cui'] for row in entity_rows if row['cui']})
+    entities_dict[prefix + 'entity_counts'] = json.dumps(entity_rows)
+    return entities_dict, [prefix + 'entity_counts']
+
+
+def groupEntities(UMLS_tuis_entity, df_reference_TUIs):
+    """
+    Group UMLS entities by their category.
+    Args:
+        UMLS_tuis_entity: dict - key: entity and value: TUI code, output of extractMedEntities
+        df_reference_TUIs: pandas dataframe - mapping of TUIs to categories, read from UMLS_tuis.csv
+
+    Returns:
+        entities_dict: dict - key: category and value: list of entities
+    """
+    # Mapping of UMLS entities with reference csv
+    entities = list(UMLS_tuis_entity.keys())
+    TUIs = list(UMLS_tuis_entity.values())
+    df_entities = pd.DataFrame(data={'entity': entities, 'TUIs': TUIs})
+    df_annotated_text_entities = pd.merge(df_entities, df_reference_TUIs, how='inner', on=['TUIs'])
+
+    entities_dict = {}
+    for idx in range(df_annotated_text_entities.shape[0]):
+        category = df_annotated_text_entities.iloc[idx].values[2]
+        med_entity = df_annotated_text_entities.iloc[idx].values[0]
+
+        # Append to list of entities if the key,value pair already exist
+        try:
+            entities_dict[category].append(med_entity)
+        except:
+            entities_dict[category] = []
+            entities_dict[category].append(med_entity)
+    return entities_dict
+
+
+def addTask(datastore_client, doc_title, entities_dict, exclude_from_indexes=()):
     """
     Upload entities to Datastore.
     Args:
         datastore_client:
         doc_title:
         entities_dict:
+        exclude_from_indexes: list - properties not used in filters, e.g the mention counts
 
     Returns:
-        Datastore key object.
+        Datastore entity written.
     """
     key = datastore_client.key('case', doc_title)
-    task = datastore.Entity(key=key)
+    task = datastore.Entity(key=key, exclude_from_indexes=tuple(exclude_from_indexes))
     task.update(
         entities_dict
     )
     datastore_client.put(task)
-    # Then get by key for this entity
     logging.info("Uploaded {} to Datastore.".format(doc_title))
-    return datastore_client.get(key)
+    return task
+
+
+# Selectivity statistics of the filters: key: (property, value) and value: (number of matching cases, timestamp)
+filter_counts = {}
+FILTER_COUNTS_TTL = 3600
 
 
-def getCases(datastore_client, filter_dict, limit=10):
+def getCases(datastore_client, filter_dict, limit=10, max_workers=8, direct_fetch_threshold=50):
     """
     Get results of query with custom filters
     Args:
         datastore_client: Client object
         filter_dict: dict - e.g {parameter_A: [entity_name_A, entity_name_B],
-                                parameter_B: [entitiy_name_C]
-                                }
+                                parameter_B: [entitiy_name_C],
+                                'cuis': [CUI_A]
+                                }, entity names are matched case-insensitively
         limit: int - result limits per default 10
+        max_workers: int - number of keys-only queries run concurrently
+        direct_fetch_threshold: int - if the most selective filter is known to match fewer cases, its cases are
+        fetched and the other filters are applied client-side
     Returns:
         results: list - query results
     """
-    query = datastore_client.query(kind='case')
+    filters = [(key, _filterValues(key, value)) for key, values in filter_dict.items() for value in values]
 
-    for key, values in filter_dict.items():
-        for value in values:
-            query.add_filter(key, '=', value)
-    results = list(query.fetch(limit=limit))
-    return results
+    # A single equality filter needs no composite index
+    if not filters or (len(filters) == 1 and len(filters[0][1]) == 1):
+        query = datastore_client.query(kind='case')
+        for key, values in filters:
+            query.add_filter(key, '=', values[0])
+        return list(query.fetch(limit=limit))
+
+    return _intersectCases(datastore_client, filters, limit, max_workers, direct_fetch_threshold)
+
+
+def _filterValues(key, value):
+    """
+    Values accepted by a filter: entity names are stored normalized, CUIs as is. Cases written before the names were
+    normalized also match the name as given, until normalizeStoredEntities has rewritten them.
+    """
+    if key.split(':')[-1] == 'cuis':
+        return (value,)
+    return tuple(dict.fromkeys([normalizeEntity(value), value]))
+
+
+def _cachedFilterCount(key, values):
+    """
+    Upper bound of the number of cases matching any of the values, None if one of them is not known.
+    """
+    count = 0
+    for value in values:
+        value_count, timestamp = filter_counts.get((key, value), (None, 0))
+        if value_count is None or time.time() - timestamp > FILTER_COUNTS_TTL:
+            return None
+        count += value_count
+    return count
+
+
+def _fetchKeys(datastore_client, key, values):
+    case_keys = set()
+    for value in values:
+        query = datastore_client.query(kind='case')
+        query.add_filter(key, '=', value)
+        query.keys_only()
+        value_keys = {entity.key for entity in query.fetch()}
+        filter_counts[(key, value)] = (len(value_keys), time.time())
+        case_keys |= value_keys
+    return case_keys
+
+
+def _matchesFilters(entity, filters):
+    for key, values in filters:
+        entity_values = entity.get(key, [])
+        entity_values = entity_values if isinstance(entity_values, list) else [entity_values]
+        if not any(value in entity_values for value in values):
+            return False
+    return True
+
+
+def normalizeStoredEntities(datastore_client, categories, batch_size=500):
+    """
+    Rewrite the entity names of the cases stored before they were normalized, see normalizeEntity. Once done,
+    getCases only needs the normalized names.
+    Args:
+        datastore_client: Client object
+        categories: set - names of the entity properties, e.g the Categories of UMLS_tuis.csv. Properties prefixed
+        with a model name, e.g 'en_core_sci_sm:Disease or Syndrome', are rewritten too
+        batch_size: int - number of cases written per put_multi
+
+    Returns:
+        n_updated: int - number of cases rewritten
+    """
+    n_updated = 0
+    batch = []
+    for entity in datastore_client.query(kind='case').fetch():
+        updated = False
+        for key, values in entity.items():
+            if key.split(':')[-1] not in categories or not isinstance(values, list):
+                continue
+            names = list(dict.fromkeys(normalizeEntity(value) for value in values))
+            if names != values:
+                entity[key] = names
+                updated = True
+        if updated:
+            batch.append(entity)
+        if len(batch) == batch_size:
+            datastore_client.put_multi(batch)
+            n_updated += len(batch)
+            batch = []
+    if batch:
+        datastore_client.put_multi(batch)
+        n_updated += len(batch)
+    logging.info('{} cases had their entity names normalized.'.format(n_updated))
+    return n_updated
+
+
+def _intersectCases(datastore_client, filters, limit, max_workers, direct_fetch_threshold):
+    """
+    Plan a multi-filter query without composite indexes: one keys-only query per filter (and value accepted by the
+    filter), run concurrently, intersected client-side, then a single get_multi for the final page.
+    """
+    counts = [_cachedFilterCount(key, values) for key, values in filters]
+    known_counts = [count for count in counts if count is not None]
+
+    # Cached counts may be stale, they only pick the plan: the cases are always fetched fresh
+    if known_counts and min(known_counts) <= direct_fetch_threshold:
+        # The most selective filter is small enough: fetch its cases and check the others client-side
+        key, values = filters[counts.index(min(known_counts))]
+        case_keys = sorted(_fetchKeys(datastore_client, key, values), key=lambda case_key: case_key.flat_path)
+        entities = datastore_client.get_multi(case_keys)
+        results = [entity for entity in entities if _matchesFilters(entity, filters)]
+        return sorted(results, key=lambda entity: entity.key.flat_path)[:limit]
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        key_sets = list(executor.map(lambda key_values: _fetchKeys(datastore_client, *key_values), filters))
+
+    # Intersect from the smallest set, stopping as soon as it is empty
+    key_sets.sort(key=len)
+    case_keys = key_sets[0]
+    for key_set in key_sets[1:]:
+        if not case_keys:
+            break
+        case_keys = case_keys & key_set
+
+    page_keys = sorted(case_keys, key=lambda case_key: case_key.flat_path)[:limit]
+    if not page_keys:
+        return []
+    entities = datastore_client.get_multi(page_keys)
+    return sorted(entities, key=lambda entity: entity.key.flat_path)
+
+
+def _readDocs(storage_backend, src_bucket, corpus_path):
+    """
+    Stream the (doc_title, text) tuples to annotate, from the local corpus if any or from the bucket.
+    """
+    if corpus_path:
+        # Sequential scan of the memory mapped corpus, no object fetch
+        for row in iterCorpus(corpus_path, columns=['case', 'eng_txt']):
+            yield row['case'], row['eng_txt']
+        return
+
+    for blob_name in storage_backend.listNames(src_bucket):
+        doc_title = blob_name.split('/')[-1].split('.pdf')[0]
+        # download as string
+        yield doc_title, storage_backend.readText(src_bucket, blob_name)
 
 
-def populateDatastore(datastore_client, storage_client, model_name, src_bucket='aketari-covid19-data-update'):
+def populateDatastore(datastore_client, storage_client, model_name, src_bucket='aketari-covid19-data-update',
+                      batch_size=16, corpus_path=None, ner_cache_uri=None, ner_cache_max_bytes=None, profile='full',
+                      entity_exporter=None, profiler=None):
     """
     Extract UMLS entities and store them in a No-SQL db: Datastore.
     Args:
         datastore_client: Storage client instantiation -
-        storage_client: Storage client instantiation -
+        storage_client: Storage client instantiation or storage backend from getStorage -
         model_name: str -
         src_bucket: str - contains pdf of the newest files
+        batch_size: int - number of document shards vectorized together
+        corpus_path: str - Optional, local corpus written by buildCorpus to read instead of the GCS objects
+        ner_cache_uri: str - Optional, local directory or 'gs://bucket/prefix' caching the entities of each text
+        ner_cache_max_bytes: int - Optional, size of the NER cache after eviction
+        profile: str - speed profile of the NER, key of NER_PROFILES
+        entity_exporter: EntityExporter - Optional, also export the entities to BigQuery
+        profiler: StageProfiler - Optional, profiles the model loading and the annotation separately
     Returns:
         Queriable database
     """
 
-    lst_curated_blobs = storage_client.list_blobs(bucket_or_name=src_bucket)
+    storage_backend = asStorage(storage_client)
+    profiler = profiler or StageProfiler(None, 'storing')
 
-    importModel(model_name)
+    with profiler.stage('ner_model_load'):
+        model = importModel(model_name)
+        if model is None:
+            return False
+        nlp, linker = loadModel(model=model, profile=profile)
 
-    if model_name == 'en_core_sci_sm':
-        nlp, linker = loadModel(model=en_core_sci_sm)
-    elif model_name == 'en_core_sci_lg':
-        nlp, linker = loadModel(model=en_core_sci_lg)
-    elif model_name == 'en_ner_bc5cdr_md':
-        nlp, linker = loadModel(model=en_ner_bc5cdr_md)
-    else:
-        return False
+    df_reference_TUIs = pd.read_csv('./scripts/utils/UMLS_tuis.csv')
+    tui_categories = dict(zip(df_reference_TUIs['TUIs'], df_reference_TUIs['Categories']))
 
-    for blob in lst_curated_blobs:
-        doc_title = blob.name.split('/')[-1].split('.pdf')[0]
+    ner_cache = None
+    if ner_cache_uri:
+        ner_cache = NERCache(getCacheBackend(storage_backend, ner_cache_uri), model_name, nlp.meta.get('version'),
+                             pipelineSettings(nlp, linker), max_bytes=ner_cache_max_bytes)
 
-        # download as string
-        eng_string = blob.download_as_string().decode('utf-8')
-
-        # convert to vector
-        doc = nlp(eng_string)
-
-        # Extract medical entities
-        UMLS_tuis_entity = extractMedEntities(doc, linker)
-
-        # Mapping of UMLS entities with reference csv
-        entities = list(UMLS_tuis_entity.keys())
-        TUIs = list(UMLS_tuis_entity.values())
-        df_entities = pd.DataFrame(data={'entity': entities, 'TUIs': TUIs})
-        df_reference_TUIs = pd.read_csv('./scripts/utils/UMLS_tuis.csv')
-        df_annotated_text_entities = pd.merge(df_entities, df_reference_TUIs, how='inner', on=['TUIs'])
-
-        # Upload entities to datastore
-        entities_dict = {}
-        for idx in range(df_annotated_text_entities.shape[0]):
-            category = df_annotated_text_entities.iloc[idx].values[2]
-            med_entity = df_annotated_text_entities.iloc[idx].values[0]
-
-            # Append to list of entities if the key,value pair already exist
-            try:
-                entities_dict[category].append(med_entity)
-            except:
-                entities_dict[category] = []
-                entities_dict[category].append(med_entity)
+    # Long documents are sharded to stay under nlp.max_length
+    with profiler.stage('ner_annotation'):
+        for doc_title, entity_spans in annotateCorpus(nlp, linker, _readDocs(storage_backend, src_bucket, corpus_path),
+                                                      batch_size=batch_size, ner_cache=ner_cache):
+            entities_dict, unindexed = compactEntities(entity_spans, tui_categories)
 
             # API call
-        key = addTask(datastore_client, doc_title, entities_dict)
-        logging.info('The upload of {} entities is done.'.format(doc_title))
+            addTask(datastore_client, doc_title, entities_dict, exclude_from_indexes=unindexed)
+            logging.info('The upload of {} entities is done.'.format(doc_title))
+            if entity_exporter is not None:
+                entity_exporter.add(doc_title, model_name, countEntities(entity_spans, tui_categories))
+
+    if ner_cache is not None:
+        ner_cache.logStats()
+        ner_cache.evict()
+
+
+def populateDatastoreMulti(datastore_client, storage_client, model_names, src_bucket='aketari-covid19-data-update',
+                           batch_size=16, corpus_path=None, ner_cache_uri=None, ner_cache_max_bytes=None,
+                           profile='full', entity_exporter=None, profiler=None):
+    """
+    Extract UMLS entities with several models in a single pass and store them in Datastore. Each case gets the
+    union of the entities of all models under the category names, as populateDatastore does, and the entities
+    of each model under '{model_name}:{category}', in a single write.
+    Args:
+        datastore_client: Storage client instantiation -
+        storage_client: Storage client instantiation or storage backend from getStorage -
+        model_names: list - e.g ['en_core_sci_sm', 'en_ner_bc5cdr_md']
+        src_bucket: str - contains pdf of the newest files
+        batch_size: int - number of documents annotated together
+        corpus_path: str - Optional, local corpus written by buildCorpus to read instead of the GCS objects
+        ner_cache_uri: str - Optional, local directory or 'gs://bucket/prefix' caching the entities of each text
+        ner_cache_max_bytes: int - Optional, size of the NER cache after eviction
+        profile: str - speed profile of the NER, key of NER_PROFILES
+        entity_exporter: EntityExporter - Optional, also export the entities to BigQuery
+        profiler: StageProfiler - Optional, profiles the model loading and the annotation separately
+    Returns:
+        Queriable database
+    """
+    storage_backend = asStorage(storage_client)
+    profiler = profiler or StageProfiler(None, 'storing')
+
+    # The UMLS linker is the heaviest part, it is loaded once and shared
+    models = {}
+    linker = None
+    with profiler.stage('ner_model_load'):
+        for model_name in model_names:
+            model = importModel(model_name)
+            if model is None:
+                return False
+            models[model_name], linker = loadModel(model=model, linker=linker, profile=profile)
+
+    df_reference_TUIs = pd.read_csv('./scripts/utils/UMLS_tuis.csv')
+    tui_categories = dict(zip(df_reference_TUIs['TUIs'], df_reference_TUIs['Categories']))
+
+    ner_caches = {}
+    if ner_cache_uri:
+        cache_backend = getCacheBackend(storage_backend, ner_cache_uri)
+        ner_caches = {model_name: NERCache(cache_backend, model_name, nlp.meta.get('version'),
+                                           pipelineSettings(nlp, linker), max_bytes=ner_cache_max_bytes)
+                      for model_name, nlp in models.items()}
+
+    with profiler.stage('ner_annotation'):
+        for doc_title, model_entity_spans in annotateCorpusMulti(models, linker,
+                                                                  _readDocs(storage_backend, src_bucket, corpus_path),
+                                                                  batch_size=batch_size, ner_caches=ner_caches):
+            entities_dict = {}
+            unindexed = []
+            for model_name, entity_spans in model_entity_spans.items():
+                if entity_exporter is not None:
+                    entity_exporter.add(doc_title, model_name, countEntities(entity_spans, tui_categories))
+                model_entities_dict, model_unindexed = compactEntities(entity_spans, tui_categories,
+                                                                       prefix='{}:'.format(model_name))
+                entities_dict.update(model_entities_dict)
+                unindexed += model_unindexed
+                for name, values in model_entities_dict.items():
+                    if name in model_unindexed:
+                        continue
+                    union = entities_dict.setdefault(name[len(model_name) + 1:], [])
+                    union.extend(value for value in values if value not in union)
+
+            # One API call per case for all the models
+            addTask(datastore_client, doc_title, entities_dict, exclude_from_indexes=unindexed)
+            logging.info('The upload of {} entities of {} models is done.'.format(doc_title, len(models)))
+
+    for ner_cache in ner_caches.values():
+        ner_cache.logStats()
+    if ner_caches:
+        # All models share the cache backend, evicting once is enough
+        next(iter(ner_caches.values())).evict()
@@ -0,0 +1,111 @@
+from concurrent.futures import ThreadPoolExecutor
+from PyPDF2 import PdfFileReader, PdfFileWriter
+import io
+import logging
+import math
+import time
+
+from .preprocessing_fcn import async_detect_document
+
+# Vision writes at most 100 pages per json output file
+MAX_BATCH_SIZE = 100
+
+
+def planOCR(n_pages, max_range_pages=100, max_batch_size=50, min_timeout=180, seconds_per_page=2.0):
+    """
+    Split a document into page ranges OCR'd as separate Vision requests, and size the output shards and the
+    timeout of each request from its number of pages.
+    Args:
+        n_pages: int - number of pages of the pdf
+        max_range_pages: int - documents above it are split into balanced ranges of at most that many pages
+        max_batch_size: int - maximum number of pages per json output file
+        min_timeout: int - timeout in seconds of the shortest requests
+        seconds_per_page: float - timeout added per page
+
+    Returns:
+        plan: list - dict per request with the first_page and last_page (starting at 1), batch_size and timeout
+    """
+    n_ranges = max(1, math.ceil(n_pages / max_range_pages))
+    range_pages = max(1, math.ceil(n_pages / n_ranges))
+    plan = []
+    for first_page in range(1, max(n_pages, 1) + 1, range_pages):
+        last_page = min(max(n_pages, 1), first_page + range_pages - 1)
+        pages = last_page - first_page + 1
+        plan.append({'first_page': first_page,
+                     'last_page': last_page,
+                     # Short documents give a single json file instead of one small shard per 20 pages
+                     'batch_size': min(pages, max_batch_size, MAX_BATCH_SIZE),
+                     'timeout': max(min_timeout, int(math.ceil(seconds_per_page * pages)))})
+    return plan
+
+
+class OCRPlanner:
+    """
+    OCR helper with the signature of async_detect_document, sizing the Vision request from the page count of the
+    pdf: large pdfs are split into page ranges OCR'd in parallel, each written under its own json prefix
+    '{gcs_destination_uri}p{first_page:05d}-' so that the outputs list in page order.
+    """
+
+    def __init__(self, storage_client, ocr_fcn=async_detect_document, max_workers=8, **plan_kwargs):
+        """
+        Args:
+            storage_client: Storage client instantiation
+            ocr_fcn: function - OCR helper with the signature of async_detect_document, e.g documentOCR
+            max_workers: int - maximum number of page ranges OCR'd concurrently
+            **plan_kwargs: arguments of planOCR, e.g max_range_pages
+        """
+        self.storage_client = storage_client
+        self.ocr_fcn = ocr_fcn
+        self.max_workers = max_workers
+        self.plan_kwargs = plan_kwargs
+
+    def __call__(self, vision_client, gcs_source_uri, gcs_destination_uri):
+        src_bucket, _, src_name = gcs_source_uri[len('gs://'):].partition('/')
+        pdf_bytes = self.storage_client.bucket(src_bucket).blob(src_name).download_as_string()
+        try:
+            pdf_reader = PdfFileReader(io.BytesIO(pdf_bytes), strict=False)
+            n_pages = pdf_reader.getNumPages()
+        except Exception as e:
+            # Vision may still read what PyPDF2 cannot, the request keeps the default sizing
+            logging.warning('Cannot read the page count of {}, OCR as a single request: {}'.format(gcs_source_uri, e))
+            return self.ocr_fcn(vision_client, gcs_source_uri, gcs_destination_uri)
+
+        plan = planOCR(n_pages, **self.plan_kwargs)
+        if len(plan) == 1:
+            return self.ocr_fcn(vision_client, gcs_source_uri, gcs_destination_uri,
+                                batch_size=plan[0]['batch_size'], timeout=plan[0]['timeout'])
+
+        start_time = time.time()
+        dest_bucket, _, dest_prefix = gcs_destination_uri[len('gs://'):].partition('/')
+        bucket_client = self.storage_client.bucket(dest_bucket)
+
+        # PyPDF2 readers seek a shared stream, the range pdfs are written one after the other and only the Vision
+        # operations run concurrently
+        range_blobs = []
+        try:
+            for page_range in plan:
+                pdf_writer = PdfFileWriter()
+                for page_idx in range(page_range['first_page'] - 1, page_range['last_page']):
+                    pdf_writer.addPage(pdf_reader.getPage(page_idx))
+                range_pdf = io.BytesIO()
+                pdf_writer.write(range_pdf)
+
+                range_name = 'ocr_tmp/{}p{:05d}.pdf'.format(dest_prefix, page_range['first_page'])
+                range_blob = bucket_client.blob(range_name)
+                range_blob.upload_from_string(range_pdf.getvalue(), content_type='application/pdf')
+                range_blobs.append(range_blob)
+
+            def ocrRange(page_range):
+                self.ocr_fcn(vision_client,
+                             'gs://{}/ocr_tmp/{}p{:05d}.pdf'.format(dest_bucket, dest_prefix, page_range['first_page']),
+                             '{}p{:05d}-'.format(gcs_destination_uri, page_range['first_page']),
+                             batch_size=page_range['batch_size'], timeout=page_range['timeout'])
+
+            # Each range is its own Vision operation, they run side by side instead of one long operation
+            with ThreadPoolExecutor(max_workers=min(self.max_workers, len(plan))) as executor:
+                list(executor.map(ocrRange, plan))
+        finally:
+            for range_blob in range_blobs:
+                range_blob.delete()
+        logging.info('OCR of {} pages in {} ranges took {} seconds.'.format(n_pages, len(plan),
+                                                                            round(time.time() - start_time, 1)))
@@ -0,0 +1,124 @@
+import logging
+import queue
+import threading
+import time
+
+
+class Stage:
+    """
+    One step of the pipeline: a function applied to each document by a pool of worker threads.
+    """
+
+    def __init__(self, name, fcn, n_workers=1, queue_size=8, next_stages=()):
+        """
+        Args:
+            name: str - stage name, e.g 'ocr'
+            fcn: function - takes the document dict, returns it (possibly updated) or None to drop it
+            n_workers: int - number of threads running fcn
+            queue_size: int - bound on documents waiting for this stage, applies back-pressure upstream
+            next_stages: list - names of the stages fed by this one
+        """
+        self.name = name
+        self.fcn = fcn
+        self.n_workers = n_workers
+        self.next_stages = list(next_stages)
+        self.input_queue = queue.Queue(maxsize=queue_size)
+        self.upstream = []
+        self.done = threading.Event()
+        self.processed = 0
+        self.errors = 0
+        self.busy_seconds = 0.0
+        self._running_workers = n_workers
+        self._lock = threading.Lock()
+
+
+def _upstreamDone(stage):
+    return all(upstream.done.is_set() for upstream in stage.upstream)
+
+
+def _runWorker(stage, stages):
+    while True:
+        try:
+            doc = stage.input_queue.get(timeout=0.1)
+        except queue.Empty:
+            if not _upstreamDone(stage):
+                continue
+            # Upstream may have queued its last document and finished since the timeout, drain once more
+            try:
+                doc = stage.input_queue.get_nowait()
+            except queue.Empty:
+                break
+
+        start_time = time.time()
+        try:
+            result = stage.fcn(doc)
+        except Exception as e:
+            logging.error('Stage {} failed on {}: {}'.format(stage.name, doc.get('doc_title'), e))
+            result = None
+            with stage._lock:
+                stage.errors += 1
+        with stage._lock:
+            stage.processed += 1
+            stage.busy_seconds += time.time() - start_time
+
+        if result is not None:
+            for next_stage in stage.next_stages:
+                stages[next_stage].input_queue.put(result)
+
+    with stage._lock:
+        stage._running_workers -= 1
+        if stage._running_workers == 0:
+            stage.done.set()
+
+
+def runPipeline(stages, docs):
+    """
+    Run documents through a DAG of stages. Each document moves on as soon as its previous stage is done,
+    so the run takes about the time of the slowest stage instead of the sum of all stages.
+    Args:
+        stages: list - Stage objects, the ones not fed by any other stage receive the documents
+        docs: iterable - document dicts, e.g {'doc_title': 'case1'}
+
+    Returns:
+        stats: dict - key: stage name and value: processed, errors and busy seconds
+    """
+    stages = {stage.name: stage for stage in stages}
+    for stage in stages.values():
+        for next_stage in stage.next_stages:
+            stages[next_stage].upstream.append(stage)
+    root_stages = [stage for stage in stages.values() if not stage.upstream]
+
+    # The feeder acts as the upstream stage of the roots
+    feeder_done = threading.Event()
+    feeder = Stage('feeder', fcn=None, n_workers=0)
+    feeder.done = feeder_done
+    for stage in root_stages:
+        stage.upstream.append(feeder)
+
+    threads = []
+    for stage in stages.values():
+        for worker_idx in range(stage.n_workers):
+            thread = threading.Thread(target=_runWorker, args=(stage, stages),
+                                      name='{}-{}'.format(stage.name, worker_idx), daemon=True)
+            thread.start()
+            threads.append(thread)
+
+    start_time = time.time()
+    for doc in docs:
+        for stage in root_stages:
+            stage.input_queue.put(doc)
+    feeder_done.set()
+
+    for thread in threads:
+        thread.join()
+    total_time = time.time() - start_time
+
+    stats = {}
+    for stage in stages.values():
+        stats[stage.name] = {'processed': stage.processed,
+                             'errors': stage.errors,
+                             'busy_seconds': round(stage.busy_seconds, 1)}
+        logging.info('Stage {}: {} documents, {} errors, {} busy seconds over {} workers.'.format(
+            stage.name, stage.processed, stage.errors, round(stage.busy_seconds, 1), stage.n_workers))
+    logging.info('Pipeline completed in {} minutes.'.format(round(total_time / 60, 1)))
+    return stats
@@ -1,10 +1,30 @@
 from google.cloud import storage, translate, vision
+import ijson
 import logging
+import os
+import re
+import resource
+import time
+import tracemalloc
 
 from google.protobuf import json_format
 
+from .storage_fcn import asStorage
 
-def async_detect_document(vision_client, gcs_source_uri, gcs_destination_uri, batch_size=20):
+customize_stop_words = [
+    'uoc', 'diagnostic', 'interventional', 'radiology', 'madonna', 'delle', 'grazie', 'hospital',
+    'Borgheresi', 'Agostini', 'Ottaviani', 'Floridi', 'Giovagnoni', 'di', 'specialization',
+    'Polytechnic', 'University', 'marche', 'ANCONA', 'Italy', 'Azienda', 'Ospedali',
+    'Riuniti', 'Yorrette', 'Matera', 'Michele', 'Nardella', 'Gerardo', 'Costanzo',
+    'Claudia', 'Lopez', 'st', 'a.', 'a', 'of', 's', 'cien', 'ze', 'diolog', 'ic', 'he',
+    'â', '€', 's', 'b', 'case', 'Cuoladi', 'l', 'c', 'ra', 'bergamo', 'patelli', 'est', 'asst',
+    'dr', 'Dianluigi', 'Svizzero', 'i', 'riccardo', 'Alessandro', 'Spinazzola', 'angelo',
+    'maggiore', 'p', 'r', 't', 'm', 'en', 't', 'o', 'd', 'e', 'n', 'd', 'o', 'g', 'h', 'u',
+    'man', 'female', 'D'
+]
+
+
+def async_detect_document(vision_client, gcs_source_uri, gcs_destination_uri, batch_size=20, timeout=180):
     """
     OCR with PDF/TIFF as source files on GCS
     Args:
@@ -12,6 +32,7 @@ def async_detect_document(vision_client, gcs_source_uri, gcs_destination_uri, ba
         gcs_source_uri:
         gcs_destination_uri:
         batch_size: How many pages should be grouped into each json output file.
+        timeout: int - seconds to wait for the operation, see utils.ocr_fcn.planOCR to scale it with the page count
 
     Returns:
 
@@ -41,7 +62,7 @@ def async_detect_document(vision_client, gcs_source_uri, gcs_destination_uri, ba
         requests=[async_request])
 
     # print('Waiting for the operation to finish.')
-    operation.result(timeout=180)
+    operation.result(timeout=timeout)
     logging.info('Text extraction from document {} is completed.'.format(doc_title))
 
 
@@ -57,14 +78,14 @@ def readJsonResult(storage_client, bucket_name, doc_title):
         all_text: str - Containing all text of the document
     """
     gcs_src_prefix = 'json/' + '{}-'.format(doc_title)
+    storage_backend = asStorage(storage_client)
 
     # List objects with the given prefix.
-    blob_list = list(storage_client.list_blobs(bucket_or_name=bucket_name,
-                                               prefix=gcs_src_prefix))
+    blob_list = storage_backend.listNames(bucket_name, prefix=gcs_src_prefix)
     all_text = ''
-    for blob in blob_list:
+    for blob_name in blob_list:
 
-        json_string = blob.download_as_string()
+        json_string = storage_backend.readText(bucket_name, blob_name)
         response = json_format.Parse(
             json_string, vision.types.AnnotateFileResponse())
 
@@ -79,30 +100,116 @@ def readJsonResult(storage_client, bucket_name, doc_title):
     return all_text
 
 
-def uploadBlob(storage_client, bucket_name, txt_content, destination_blob_name):
+def iterJsonPageTexts(json_stream):
     """
-    Uploads a file to the bucket.
+    Stream the text of each page out of a json file written by Vision, without building the
+    AnnotateFileResponse: blocks, words and symbols are tokenized and skipped, so the memory used is
+    proportional to the text of one page.
+    Args:
+        json_stream: binary file-like object -
+
+    Returns:
+        generator of (page_number, text) tuples
+    """
+    page_number, text = None, ''
+    for prefix, event, value in ijson.parse(json_stream):
+        if prefix == 'responses.item.fullTextAnnotation.text':
+            text = value
+        elif prefix == 'responses.item.context.pageNumber':
+            page_number = int(value)
+        elif prefix == 'responses.item' and event == 'end_map':
+            yield page_number, text
+            page_number, text = None, ''
+
+
+def readJsonResultStreaming(storage_client, bucket_name, doc_title):
+    """
+    Streaming version of readJsonResult, each json file is read by chunks and only the text of the pages
+    is extracted.
+    Args:
+        storage_client: google.cloud.storage Client or storage backend from getStorage
+        bucket_name:
+        doc_title:
+
+    Returns:
+        all_text: str - Containing all text of the document
+    """
+    gcs_src_prefix = 'json/' + '{}-'.format(doc_title)
+    storage_backend = asStorage(storage_client)
+
+    all_text = ''
+    for blob_name in storage_backend.listNames(bucket_name, prefix=gcs_src_prefix):
+        with storage_backend.openStream(bucket_name, blob_name) as json_stream:
+            for _, text_response in iterJsonPageTexts(json_stream):
+                all_text += text_response
+                all_text += ' '
+
+    logging.info("Parsing of {} json doc was successful.".format(doc_title))
+    return all_text
+
+
+def compareJsonParsing(storage_client, bucket_name, doc_titles, parsers=('protobuf', 'streaming')):
+    """
+    Benchmark readJsonResultStreaming against readJsonResult.
+    tracemalloc only sees the python heap, not the C allocations of the protobuf parser, so the growth of the peak
+    resident memory of the process is reported too. The peak of a process never goes down: a parser staying under
+    the peak of the previous one shows no growth, run one parser per process for exact figures.
     Args:
         storage_client:
         bucket_name:
+        doc_titles: list -
+        parsers: tuple - names of the parsers to run, in order, among 'protobuf' and 'streaming'
+
+    Returns:
+        results: dict - key: parser name and value: seconds, python heap peak and peak rss growth in MB, documents
+        per second and number of characters parsed
+    """
+    parse_fcns = {'protobuf': readJsonResult, 'streaming': readJsonResultStreaming}
+    results = {}
+    for name in parsers:
+        parse_fcn = parse_fcns[name]
+        start_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        tracemalloc.start()
+        start_time = time.time()
+        texts = [parse_fcn(storage_client, bucket_name, doc_title) for doc_title in doc_titles]
+        total_time = time.time() - start_time
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        # ru_maxrss is in KB on Linux
+        rss_growth = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - start_rss
+        results[name] = {'seconds': round(total_time, 2),
+                         'python_peak_mb': round(peak / 1024 / 1024, 1),
+                         'rss_growth_mb': round(rss_growth / 1024, 1),
+                         'docs_per_second': round(len(doc_titles) / total_time, 2)}
+        results[name]['chars'] = sum(len(text) for text in texts)
+        logging.info('{} parsing: {}'.format(name, results[name]))
+    return results
+
+
+def uploadBlob(storage_client, bucket_name, txt_content, destination_blob_name, compression=None):
+    """
+    Uploads a file to the bucket.
+    Args:
+        storage_client: google.cloud.storage Client or storage backend from getStorage
+        bucket_name:
         txt_content:
         destination_blob_name:
+        compression: str - Optional, 'gzip' or 'zstd'. Do not compress files read by the Google APIs.
 
     Returns:
 
     """
     destination_blob_name = destination_blob_name.split('gs://{}/'.format(bucket_name))[-1]
-    bucket = storage_client.bucket(bucket_name)
-    blob = bucket.blob(destination_blob_name)
-
-    blob.upload_from_string(txt_content)
+    asStorage(storage_client).writeBytes(bucket_name, destination_blob_name, txt_content,
+                                         content_encoding=compression)
 
     logging.info("Text uploaded to {}".format(destination_blob_name))
 
 
 def batch_translate_text(translate_client, project_id,
                          input_uri="gs://YOUR_BUCKET_ID/path/to/your/file.txt",
-                         output_uri="gs://YOUR_BUCKET_ID/path/to/save/results/"):
+                         output_uri="gs://YOUR_BUCKET_ID/path/to/save/results/",
+                         src_lang="it"):
     """
     Translates a batch of texts on GCS and stores the result in a GCS location.
     Args:
@@ -110,6 +217,7 @@ def batch_translate_text(translate_client, project_id,
         project_id:
         input_uri:
         output_uri:
+        src_lang: str - default it
 
     Returns:
 
@@ -131,9 +239,131 @@ def batch_translate_text(translate_client, project_id,
     # Supported language codes: https://cloud.google.com/translate/docs/language
     operation = translate_client.batch_translate_text(
         parent=parent,
-        source_language_code="it",
+        source_language_code=src_lang,
         target_language_codes=["en"],  # Up to 10 language codes here.
         input_configs=[input_configs_element],
         output_config=output_config)
 
     response = operation.result(180)
+
+
+def translationOutputName(bucket_name, input_blob_name, target_lang='en'):
+    """
+    Name given by the Translate batch API to the output of an input file.
+    Args:
+        bucket_name: str - bucket of the input file
+        input_blob_name: str - e.g 'raw_txt/case1.txt'
+        target_lang: str -
+
+    Returns:
+        output_name: str - e.g '{bucket_name}_raw_txt_case1_en_translations.txt'
+    """
+    stem, ext = os.path.splitext(input_blob_name)
+    return '{}_{}_{}_translations{}'.format(bucket_name, stem.replace('/', '_'), target_lang, ext)
+
+
+def bulk_batch_translate_text(translate_client, storage_client, project_id, bucket_name, doc_titles,
+                              input_prefix='raw_txt', output_prefix='eng_txt', max_files_per_operation=100,
+                              timeout=900):
+    """
+    Translates many documents with as few batch operations as possible. The operations are all submitted
+    before polling, so the corpus takes about one operation's latency. Outputs are then moved to
+    '{output_prefix}/{doc_title}/{bucket_name}_raw_txt_{doc_title}_en_translations.txt', the layout
+    written by batch_translate_text and read by populateBQ.
+    Args:
+        translate_client:
+        storage_client:
+        project_id:
+        bucket_name: str - bucket holding the input files and receiving the translations
+        doc_titles: list - documents to translate, e.g ['case1', 'case2']
+        input_prefix: str -
+        output_prefix: str -
+        max_files_per_operation: int - Translate API limit on input files per operation
+        timeout: int - seconds to wait for each operation
+
+    Returns:
+        translated_docs: list - doc_titles whose translation is available
+    """
+    # Only us-central1 or global are supported location
+    parent = translate_client.location_path(project_id, location="us-central1")
+    bucket_client = storage_client.bucket(bucket_name)
+    batch_id = int(time.time())
+
+    operations = []
+    for op_idx, start in enumerate(range(0, len(doc_titles), max_files_per_operation)):
+        op_doc_titles = doc_titles[start:start + max_files_per_operation]
+        input_configs = [{"gcs_source": {"input_uri": 'gs://{}/{}/{}.txt'.format(bucket_name, input_prefix, doc_title)},
+                          "mime_type": "text/plain"}
+                         for doc_title in op_doc_titles]
+
+        # Each operation needs its own empty output folder
+        op_prefix = '{}/_bulk_{}_{}/'.format(output_prefix, batch_id, op_idx)
+        output_config = {"gcs_destination": {"output_uri_prefix": 'gs://{}/{}'.format(bucket_name, op_prefix)}}
+
+        operation = translate_client.batch_translate_text(
+            parent=parent,
+            source_language_code="it",
+            target_language_codes=["en"],
+            input_configs=input_configs,
+            output_config=output_config)
+        operations.append((operation, op_prefix, op_doc_titles))
+    logging.info("Submitted {} documents in {} translation operations.".format(len(doc_titles), len(operations)))
+
+    translated_docs = []
+    for operation, op_prefix, op_doc_titles in operations:
+        try:
+            response = operation.result(timeout)
+            logging.info("Translation operation translated {} characters.".format(response.translated_characters))
+        except Exception as e:
+            logging.error("Translation operation writing to {} failed: {}".format(op_prefix, e))
+            continue
+
+        for doc_title in op_doc_titles:
+            output_name = translationOutputName(bucket_name, '{}/{}.txt'.format(input_prefix, doc_title))
+            output_blob = bucket_client.get_blob(op_prefix + output_name)
+            if output_blob is None:
+                logging.error("No translation found for {}.".format(doc_title))
+                continue
+            bucket_client.rename_blob(output_blob, '{}/{}/{}'.format(output_prefix, doc_title, output_name))
+            translated_docs.append(doc_title)
+
+        # Drop index.csv and any error files left in the operation folder
+        for blob in storage_client.list_blobs(bucket_or_name=bucket_name, prefix=op_prefix):
+            blob.delete()
+
+    return translated_docs
+
+
+def cleanEngText(eng_raw_string, customize_stop_words=[]):
+    """
+
+    Args:
+        eng_raw_string: str -
+        customize_stop_words: list - all stopwords to remove
+
+    Returns:
+        refined_doc: str - curated string of eng text
+    """
+
+    # Remove dates
+    # 1 or 2 digit number followed by back slash followed by 1 or 2 digit number ...
+    pattern_dates = '(\d{1,2})/(\d{1,2})/(\d{4})'
+    pattern_fig = 'Figure (\d{1,2})'
+    pattern_image = '^Image .$'
+    replace = ''
+
+    eng_raw_string = re.sub(pattern_dates, replace, eng_raw_string)
+    eng_raw_string = re.sub(pattern_fig, replace, eng_raw_string)
+    eng_raw_string = re.sub(pattern_image, replace, eng_raw_string)
+
+    # remove punctuation and special characters
+    eng_raw_string = re.sub("[^A-Za-z0-9]+", ' ', eng_raw_string)
+
+    # Remove custom stop words
+    tokens = [token for token in eng_raw_string.split() if token not in customize_stop_words]
+
+    refined_doc = ''
+    for word in tokens:
+        refined_doc += ' {}'.format(word)
+
+    return refined_doc
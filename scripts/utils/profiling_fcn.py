@@ -0,0 +1,155 @@
+from contextlib import contextmanager
+import cProfile
+import io
+import logging
+import pstats
+import time
+import tracemalloc
+
+from .cache_fcn import getCacheBackend
+
+
+def _label(func):
+    file_name, line_number, function_name = func
+    if file_name == '~':
+        # Built-in functions, e.g <method 'read' of '_io.BufferedReader' objects>
+        return function_name
+    return '{}:{}:{}'.format(file_name.split('/')[-1], line_number, function_name)
+
+
+def collapsedStacks(stats):
+    """
+    Collapsed stacks of a cProfile run, one 'root;caller;callee microseconds' line per stack, the input format of
+    flamegraph.pl and speedscope. cProfile only records caller-callee pairs: the time of a function reached by
+    several paths is split between them in proportion of the time of each caller.
+    Args:
+        stats: pstats.Stats -
+
+    Returns:
+        collapsed: str
+    """
+    callees = {}
+    roots = []
+    for func, (_, _, _, cumulative_time, callers) in stats.stats.items():
+        if not callers:
+            roots.append((func, cumulative_time))
+        for caller, (_, _, own_time, edge_cumulative_time) in callers.items():
+            callees.setdefault(caller, []).append((func, own_time, edge_cumulative_time))
+
+    stacks = {}
+    # Paths holding less than this are not expanded, the number of paths grows quickly with the call graph
+    min_seconds = 1e-4 * sum(cumulative_time for _, cumulative_time in roots)
+
+    def walk(func, path, own_time, edge_cumulative_time, scale):
+        stack = path + (_label(func),)
+        key = ';'.join(stack)
+        stacks[key] = stacks.get(key, 0.0) + own_time * scale
+        cumulative_time = stats.stats[func][3]
+        if cumulative_time <= 0:
+            return
+        # The callee times are totals over all the callers of func, this path gets its share of them
+        callee_scale = scale * min(1.0, edge_cumulative_time / cumulative_time)
+        for callee, callee_own_time, callee_cumulative_time in callees.get(func, []):
+            # Recursive calls are folded into the first occurrence of the function
+            if _label(callee) in stack or callee_cumulative_time * callee_scale < min_seconds:
+                continue
+            walk(callee, stack, callee_own_time, callee_cumulative_time, callee_scale)
+
+    for func, cumulative_time in roots:
+        walk(func, (), stats.stats[func][2], cumulative_time, 1.0)
+
+    return ''.join('{} {}\n'.format(stack, int(seconds * 1e6))
+                   for stack, seconds in sorted(stacks.items()) if seconds * 1e6 >= 1)
+
+
+class StageProfiler:
+    """
+    Per-stage profiling of a run: for each stage, a cProfile of the CPU time written as collapsed stacks for
+    flamegraphs and as the top functions by cumulative time, and the top allocations by line from tracemalloc
+    snapshots taken at the start and end of the stage. Without output_uri every stage runs as is.
+    """
+
+    def __init__(self, output_uri, run_name, storage_client=None, top_n=25):
+        """
+        Args:
+            output_uri: str - local directory or 'gs://bucket/prefix' receiving the reports, None to disable
+            run_name: str - sub-directory of the reports, e.g 'storing'
+            storage_client: Storage client instantiation - needed for a gs:// output_uri
+            top_n: int - number of functions and allocations in the reports
+        """
+        self.enabled = bool(output_uri)
+        self.backend = getCacheBackend(storage_client, output_uri) if self.enabled else None
+        self.prefix = '{}-{}'.format(run_name, time.strftime('%Y%m%dT%H%M%S'))
+        self.top_n = top_n
+        self._depth = 0
+        self._state = None
+
+    def _write(self, name, content):
+        self.backend.put('{}/{}'.format(self.prefix, name), content)
+
+    def start(self, name):
+        """
+        Start profiling a stage. Prefer the stage context manager: a start without its stop, e.g on an exception,
+        leaves every later stage unprofiled.
+        Args:
+            name: str - e.g 'curation'
+        """
+        # cProfile cannot run nested, an inner stage is accounted in its outer stage
+        self._depth += 1
+        if not self.enabled or self._depth > 1:
+            return
+
+        started_tracing = not tracemalloc.is_tracing()
+        if started_tracing:
+            # 10 frames so that the allocations are attributed beyond the library internals
+            tracemalloc.start(10)
+        if hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+        # Before Python 3.9 the peak also covers what was traced before the stage when tracing was already on
+        start_snapshot = tracemalloc.take_snapshot()
+        profile = cProfile.Profile()
+        self._state = (name, profile, start_snapshot, started_tracing, time.time())
+        profile.enable()
+
+    def stop(self):
+        self._depth -= 1
+        if not self.enabled or self._depth > 0:
+            return
+
+        name, profile, start_snapshot, started_tracing, start_time = self._state
+        profile.disable()
+        total_time = time.time() - start_time
+        end_snapshot = tracemalloc.take_snapshot()
+        _, peak_bytes = tracemalloc.get_traced_memory()
+        if started_tracing:
+            tracemalloc.stop()
+        self._state = None
+        self._report(name, profile, start_snapshot, end_snapshot, total_time, peak_bytes)
+
+    @contextmanager
+    def stage(self, name):
+        self.start(name)
+        try:
+            yield
+        finally:
+            self.stop()
+
+    def _report(self, name, profile, start_snapshot, end_snapshot, total_time, peak_bytes):
+        stats_stream = io.StringIO()
+        stats = pstats.Stats(profile, stream=stats_stream)
+        self._write('{}.collapsed'.format(name), collapsedStacks(stats))
+        stats.sort_stats('cumulative').print_stats(self.top_n)
+        self._write('{}_cpu.txt'.format(name), stats_stream.getvalue())
+
+        # The profiler's own bookkeeping is not part of the stage
+        filters = [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, cProfile.__file__)]
+        differences = end_snapshot.filter_traces(filters).compare_to(start_snapshot.filter_traces(filters),
+                                                                     'lineno')
+        lines = ['Stage {}: {} seconds, peak traced memory {} MB'.format(name, round(total_time, 1),
+                                                                         round(peak_bytes / 1024 / 1024, 1)),
+                 'Top {} allocations by line, still allocated at the end of the stage:'.format(self.top_n)]
+        lines += [str(difference) for difference in differences[:self.top_n]]
+        self._write('{}_memory.txt'.format(name), '\n'.join(lines) + '\n')
+
+        logging.info('Profile of stage {}: {} seconds, {} MB peak, reports written to {}/{}.'.format(
+            name, round(total_time, 1), round(peak_bytes / 1024 / 1024, 1), self.prefix, name))
@@ -0,0 +1,291 @@
+import hashlib
+import logging
+import math
+import os
+import pickle
+import re
+import time
+
+from .compression_fcn import downloadText
+from .corpus_fcn import iterCorpus
+
+pattern_tokens = re.compile(r"[a-z0-9]+")
+pattern_phrases = re.compile(r'"([^"]+)"')
+
+
+def tokenize(text):
+    """
+    Args:
+        text: str -
+
+    Returns:
+        tokens: list - lowercased alphanumeric tokens, in order
+    """
+    return pattern_tokens.findall(text.lower())
+
+
+def _encodeVarint(value, buffer):
+    while value >= 0x80:
+        buffer.append((value & 0x7f) | 0x80)
+        value >>= 7
+    buffer.append(value)
+
+
+def _decodeVarints(buffer):
+    value = 0
+    shift = 0
+    for byte in buffer:
+        value |= (byte & 0x7f) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            yield value
+            value = 0
+            shift = 0
+
+
+def _encodePosting(doc_gap, positions, buffer):
+    _encodeVarint(doc_gap, buffer)
+    _encodeVarint(len(positions), buffer)
+    previous = 0
+    for position in positions:
+        _encodeVarint(position - previous, buffer)
+        previous = position
+
+
+def _decodePostings(buffer):
+    """
+    Returns:
+        generator of (document id, positions) tuples, deleted documents included
+    """
+    values = _decodeVarints(buffer)
+    doc_id = 0
+    for doc_gap in values:
+        doc_id += doc_gap
+        position = 0
+        positions = []
+        for _ in range(next(values)):
+            position += next(values)
+            positions.append(position)
+        yield doc_id, positions
+
+
+class SearchIndex:
+    """
+    Inverted index with BM25 ranking and phrase queries. The postings of each term are stored as varint encoded
+    gaps: document id gap, term frequency, then the position gaps of the term in the document. Documents are only
+    appended: a document whose text changed gets a new id and its previous version is hidden until the index is
+    compacted.
+    """
+
+    def __init__(self, k1=1.2, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self.cases = []
+        self.fingerprints = []
+        self.doc_lengths = []
+        self.deleted = set()
+        self.postings = {}
+        self._last_doc = {}
+        self._case_ids = {}
+
+    def __len__(self):
+        return len(self.cases) - len(self.deleted)
+
+    def fingerprint(self, case):
+        doc_id = self._case_ids.get(case)
+        return None if doc_id is None else self.fingerprints[doc_id]
+
+    def add(self, case, text, fingerprint=None):
+        """
+        Index a document, replacing its previous version if any.
+        Args:
+            case: str -
+            text: str -
+            fingerprint: str - Optional, identifies the version of the text, e.g its md5
+        """
+        if case in self._case_ids:
+            self.deleted.add(self._case_ids[case])
+
+        doc_id = len(self.cases)
+        self.cases.append(case)
+        self.fingerprints.append(fingerprint or hashlib.sha256(text.encode('utf-8')).hexdigest())
+        self._case_ids[case] = doc_id
+
+        tokens = tokenize(text)
+        self.doc_lengths.append(len(tokens))
+        positions = {}
+        for position, token in enumerate(tokens):
+            positions.setdefault(token, []).append(position)
+
+        for token, token_positions in positions.items():
+            _encodePosting(doc_id - self._last_doc.get(token, 0), token_positions,
+                           self.postings.setdefault(token, bytearray()))
+            self._last_doc[token] = doc_id
+
+    def remove(self, case):
+        """
+        Hide a document removed from the source, its postings are dropped by the next compaction.
+        """
+        doc_id = self._case_ids.pop(case, None)
+        if doc_id is not None:
+            self.deleted.add(doc_id)
+
+    def deletedFraction(self):
+        return len(self.deleted) / len(self.cases) if self.cases else 0.0
+
+    def compact(self):
+        """
+        Rewrite the postings without the replaced and removed documents, renumbering the remaining ones.
+        """
+        live_ids = [doc_id for doc_id in range(len(self.cases)) if doc_id not in self.deleted]
+        new_ids = {doc_id: new_id for new_id, doc_id in enumerate(live_ids)}
+
+        postings = {}
+        last_doc = {}
+        for token, buffer in self.postings.items():
+            new_buffer = bytearray()
+            previous_id = 0
+            for doc_id, positions in _decodePostings(buffer):
+                if doc_id in self.deleted:
+                    continue
+                _encodePosting(new_ids[doc_id] - previous_id, positions, new_buffer)
+                previous_id = new_ids[doc_id]
+            if new_buffer:
+                postings[token] = new_buffer
+                last_doc[token] = previous_id
+
+        n_deleted = len(self.deleted)
+        self.cases = [self.cases[doc_id] for doc_id in live_ids]
+        self.fingerprints = [self.fingerprints[doc_id] for doc_id in live_ids]
+        self.doc_lengths = [self.doc_lengths[doc_id] for doc_id in live_ids]
+        self._case_ids = {case: doc_id for doc_id, case in enumerate(self.cases)}
+        self.deleted = set()
+        self.postings = postings
+        self._last_doc = last_doc
+        logging.info('Search index compacted: {} deleted documents dropped.'.format(n_deleted))
+
+    def _postings(self, token):
+        """
+        Decode the postings of a term.
+        Returns:
+            postings: dict - key: document id and value: positions of the term
+        """
+        return {doc_id: positions for doc_id, positions in _decodePostings(self.postings.get(token, b''))
+                if doc_id not in self.deleted}
+
+    @staticmethod
+    def _containsPhrase(term_positions):
+        first_positions = set(term_positions[0])
+        for offset, positions in enumerate(term_positions[1:], start=1):
+            first_positions &= {position - offset for position in positions}
+            if not first_positions:
+                return False
+        return True
+
+    def search(self, query, k=10):
+        """
+        Rank the documents with BM25. Quoted parts of the query are phrases the documents must contain.
+        Args:
+            query: str - e.g 'ground glass "bilateral pneumonia"'
+            k: int - number of results
+
+        Returns:
+            results: list - (case, score) tuples by decreasing score
+        """
+        # Quoted parts without any token, e.g "--", do not filter anything
+        phrases = [phrase for phrase in map(tokenize, pattern_phrases.findall(query)) if phrase]
+        tokens = tokenize(query)
+        if not tokens or not len(self):
+            return []
+
+        n_docs = len(self)
+        avg_length = sum(length for doc_id, length in enumerate(self.doc_lengths)
+                         if doc_id not in self.deleted) / n_docs
+        postings = {token: self._postings(token) for token in set(tokens)}
+
+        candidates = None
+        for phrase in phrases:
+            phrase_docs = set.intersection(*[set(postings[token]) for token in phrase])
+            phrase_docs = {doc_id for doc_id in phrase_docs
+                           if self._containsPhrase([postings[token][doc_id] for token in phrase])}
+            candidates = phrase_docs if candidates is None else candidates & phrase_docs
+
+        scores = {}
+        for token in tokens:
+            token_postings = postings[token]
+            if not token_postings:
+                continue
+            idf = math.log(1 + (n_docs - len(token_postings) + 0.5) / (len(token_postings) + 0.5))
+            for doc_id, positions in token_postings.items():
+                if candidates is not None and doc_id not in candidates:
+                    continue
+                tf = len(positions)
+                norm = self.k1 * (1 - self.b + self.b * self.doc_lengths[doc_id] / avg_length)
+                scores[doc_id] = scores.get(doc_id, 0.0) + idf * tf * (self.k1 + 1) / (tf + norm)
+
+        ranked = sorted(scores.items(), key=lambda item: -item[1])[:k]
+        return [(self.cases[doc_id], round(score, 4)) for doc_id, score in ranked]
+
+    def save(self, index_path):
+        # Write next to the destination then rename, readers never see a partial file
+        tmp_path = index_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(self.__dict__, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, index_path)
+
+    @classmethod
+    def load(cls, index_path):
+        index = cls()
+        with open(index_path, 'rb') as f:
+            index.__dict__.update(pickle.load(f))
+        return index
+
+
+def buildSearchIndex(storage_client, bucket_name, index_path, prefix='curated_eng_txt', corpus_path=None,
+                     compact_fraction=0.2):
+    """
+    Create or update the search index of the curated english text. Documents unchanged since the previous
+    update are not downloaded nor indexed again, documents removed from the source are removed from the index.
+    Args:
+        storage_client: Storage client instantiation -
+        bucket_name: str -
+        index_path: str - local path of the index, e.g './content/search_index.pkl'
+        prefix: str - GCS prefix of the documents
+        corpus_path: str - Optional, local corpus written by buildCorpus to read instead of the GCS objects
+        compact_fraction: float - the index is compacted once this fraction of its documents are deleted versions
+
+    Returns:
+        index: SearchIndex
+    """
+    start_time = time.time()
+    index = SearchIndex.load(index_path) if os.path.exists(index_path) else SearchIndex()
+
+    n_indexed = 0
+    seen_cases = set()
+    if corpus_path:
+        for row in iterCorpus(corpus_path, columns=['case', 'eng_txt', 'eng_txt_sha256']):
+            seen_cases.add(row['case'])
+            if index.fingerprint(row['case']) != row['eng_txt_sha256']:
+                index.add(row['case'], row['eng_txt'], fingerprint=row['eng_txt_sha256'])
+                n_indexed += 1
+    else:
+        for blob in storage_client.list_blobs(bucket_or_name=bucket_name, prefix=prefix + '/'):
+            if not blob.name.endswith('.txt'):
+                continue
+            case = blob.name.split('/')[-1][:-len('.txt')]
+            seen_cases.add(case)
+            if index.fingerprint(case) != blob.md5_hash:
+                index.add(case, downloadText(blob), fingerprint=blob.md5_hash)
+                n_indexed += 1
+
+    removed_cases = set(index._case_ids) - seen_cases
+    for case in removed_cases:
+        index.remove(case)
+    if index.deletedFraction() > compact_fraction:
+        index.compact()
+
+    index.save(index_path)
+    logging.info('Search index of {} cases written to {}: {} cases indexed and {} removed in {} seconds.'.format(
+        len(index), index_path, n_indexed, len(removed_cases), round(time.time() - start_time, 1)))
+    return index
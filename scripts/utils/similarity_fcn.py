@@ -0,0 +1,231 @@
+from collections import Counter
+import numpy as np
+import hashlib
+import json
+import logging
+import math
+import os
+import pickle
+import time
+
+from .compression_fcn import downloadText
+from .corpus_fcn import iterCorpus
+from .search_fcn import tokenize
+
+
+class CaseSimilarityIndex:
+    """
+    Vectors of the cases for "cases like case23" lookups: TF-IDF of the curated english text and bag of the UMLS
+    entities, kept as a float32 matrix with L2-normalized rows so that the cosine similarity is a dot product.
+    New cases are appended with the current vocabulary and weights, which are refitted on the whole index once it
+    has grown by refit_fraction.
+    """
+
+    def __init__(self, max_features=20000, min_df=2, max_df=0.5, entity_weight=1.0, refit_fraction=0.2):
+        self.max_features = max_features
+        self.min_df = min_df
+        self.max_df = max_df
+        self.entity_weight = entity_weight
+        self.refit_fraction = refit_fraction
+
+        self.fingerprints = {}
+        self.text_counts = {}
+        self.entity_counts = {}
+
+        self.cases = []
+        self.matrix = None
+        self._features = {}
+        self._n_text_features = 0
+        self._idf = None
+        self._case_rows = {}
+        self._n_fitted = 0
+
+    def __len__(self):
+        return len(self.text_counts)
+
+    def add(self, case, text, entity_counts=None, fingerprint=None):
+        """
+        Add a case, or replace it if its text or entities changed.
+        Args:
+            case: str -
+            text: str - curated english text
+            entity_counts: dict - key: CUI, or entity name when it is not linked, and value: number of mentions
+            fingerprint: str - Optional, identifies the version of the text and entities
+        """
+        self.fingerprints[case] = fingerprint or hashlib.sha256(text.encode('utf-8')).hexdigest()
+        self.text_counts[case] = Counter(tokenize(text))
+        self.entity_counts[case] = Counter(entity_counts or {})
+
+        if self.matrix is None or len(self) > (1 + self.refit_fraction) * self._n_fitted:
+            self.matrix = None
+            return
+        row = self._vectorize(case)
+        if case in self._case_rows:
+            self.matrix[self._case_rows[case]] = row
+        else:
+            self._case_rows[case] = len(self.cases)
+            self.cases.append(case)
+            self.matrix = np.vstack([self.matrix, row[None, :]])
+
+    def fit(self):
+        """
+        Select the vocabulary, compute the IDF weights and vectorize all cases.
+        """
+        n_cases = len(self)
+        doc_freqs = Counter()
+        for case in self.text_counts:
+            doc_freqs.update(self.text_counts[case].keys())
+            doc_freqs.update('entity:' + entity for entity in self.entity_counts[case])
+
+        max_docs = max(self.min_df, self.max_df * n_cases)
+        text_features = sorted((term for term, n_docs in doc_freqs.items()
+                                if not term.startswith('entity:') and self.min_df <= n_docs <= max_docs),
+                               key=lambda term: (-doc_freqs[term], term))[:self.max_features]
+        entity_features = sorted(term for term, n_docs in doc_freqs.items()
+                                 if term.startswith('entity:') and n_docs >= self.min_df)
+
+        self._features = {term: idx for idx, term in enumerate(text_features + entity_features)}
+        self._n_text_features = len(text_features)
+        self._idf = np.array([math.log((1 + n_cases) / (1 + doc_freqs[term])) + 1 for term in self._features],
+                             dtype=np.float32)
+
+        self.cases = sorted(self.text_counts)
+        self._case_rows = {case: row for row, case in enumerate(self.cases)}
+        self.matrix = np.zeros((n_cases, len(self._features)), dtype=np.float32)
+        for row, case in enumerate(self.cases):
+            self.matrix[row] = self._vectorize(case)
+        self._n_fitted = n_cases
+        logging.info('Similarity index: {} cases, {} text and {} entity features.'.format(
+            n_cases, len(text_features), len(entity_features)))
+        return self
+
+    def _vectorize(self, case):
+        vector = np.zeros(len(self._features), dtype=np.float32)
+        for term, count in self.text_counts[case].items():
+            if term in self._features:
+                vector[self._features[term]] = 1 + math.log(count)
+        for entity, count in self.entity_counts[case].items():
+            if 'entity:' + entity in self._features:
+                vector[self._features['entity:' + entity]] = 1 + math.log(count)
+        vector *= self._idf
+
+        # Text and entities blocks are normalized separately so that the entity_weight is their relative weight
+        for block, weight in [(slice(None, self._n_text_features), 1.0),
+                              (slice(self._n_text_features, None), self.entity_weight)]:
+            norm = np.linalg.norm(vector[block])
+            if norm > 0:
+                vector[block] *= weight / norm
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else vector
+
+    def similarBatch(self, cases, k=10):
+        """
+        Args:
+            cases: list - names of indexed cases, e.g ['case23', 'case7']
+            k: int - number of similar cases per case
+
+        Returns:
+            results: dict - key: case and value: list of (case, cosine similarity) tuples by decreasing similarity
+        """
+        if self.matrix is None:
+            self.fit()
+        rows = np.array([self._case_rows[case] for case in cases], dtype=np.int64)
+        scores = self.matrix[rows] @ self.matrix.T
+        scores[np.arange(len(rows)), rows] = -np.inf
+
+        k = min(k, len(self.cases) - 1)
+        if k <= 0:
+            return {case: [] for case in cases}
+        top_rows = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        results = {}
+        for idx, case in enumerate(cases):
+            ranked = sorted(top_rows[idx], key=lambda row: -scores[idx, row])
+            results[case] = [(self.cases[row], round(float(scores[idx, row]), 4)) for row in ranked]
+        return results
+
+    def similar(self, case, k=10):
+        return self.similarBatch([case], k=k)[case]
+
+    def save(self, index_path):
+        if self.matrix is None and len(self):
+            self.fit()
+        tmp_path = index_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(self.__dict__, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, index_path)
+
+    @classmethod
+    def load(cls, index_path):
+        index = cls()
+        with open(index_path, 'rb') as f:
+            index.__dict__.update(pickle.load(f))
+        return index
+
+
+def readEntityCounts(datastore_client, cases, prefix='', batch_size=500):
+    """
+    Read the mention counts written by compactEntities.
+    Args:
+        datastore_client: Client object
+        cases: list - case names
+        prefix: str - prefix of the property names, e.g 'en_core_sci_sm:'
+        batch_size: int - number of keys per lookup
+
+    Returns:
+        entity_counts: dict - key: case and value: json string of the entity rows
+    """
+    entity_counts = {}
+    for idx in range(0, len(cases), batch_size):
+        keys = [datastore_client.key('case', case) for case in cases[idx:idx + batch_size]]
+        for entity in datastore_client.get_multi(keys):
+            if prefix + 'entity_counts' in entity:
+                entity_counts[entity.key.name] = entity[prefix + 'entity_counts']
+    return entity_counts
+
+
+def buildSimilarityIndex(storage_client, datastore_client, bucket_name, index_path, prefix='curated_eng_txt',
+                         corpus_path=None, entity_prefix='', refit=False):
+    """
+    Create or update the similarity index of the cases. Cases whose text and entities are unchanged since the
+    previous update are not downloaded nor vectorized again.
+    Args:
+        storage_client: Storage client instantiation -
+        datastore_client: Client object - Optional, the index is built from the text only if None
+        bucket_name: str -
+        index_path: str - local path of the index, e.g './content/similarity_index.pkl'
+        prefix: str - GCS prefix of the documents
+        corpus_path: str - Optional, local corpus written by buildCorpus to read instead of the GCS objects
+        entity_prefix: str - prefix of the Datastore properties, e.g 'en_core_sci_sm:'
+        refit: bool - recompute the vocabulary and weights even if the index has not grown much
+
+    Returns:
+        index: CaseSimilarityIndex
+    """
+    start_time = time.time()
+    index = CaseSimilarityIndex.load(index_path) if os.path.exists(index_path) else CaseSimilarityIndex()
+
+    if corpus_path:
+        docs = {row['case']: (row['eng_txt_sha256'], row['eng_txt'])
+                for row in iterCorpus(corpus_path, columns=['case', 'eng_txt', 'eng_txt_sha256'])}
+    else:
+        docs = {blob.name.split('/')[-1][:-len('.txt')]: (blob.md5_hash, blob)
+                for blob in storage_client.list_blobs(bucket_or_name=bucket_name, prefix=prefix + '/')
+                if blob.name.endswith('.txt')}
+
+    entity_rows = readEntityCounts(datastore_client, sorted(docs), entity_prefix) if datastore_client else {}
+
+    n_added = 0
+    for case, (text_fingerprint, text) in docs.items():
+        fingerprint = text_fingerprint + ':' + hashlib.sha256(entity_rows.get(case, '').encode('utf-8')).hexdigest()
+        if index.fingerprints.get(case) == fingerprint:
+            continue
+        entity_counts = {row['cui'] or row['entity']: row['count'] for row in json.loads(entity_rows.get(case, '[]'))}
+        index.add(case, text if isinstance(text, str) else downloadText(text), entity_counts, fingerprint=fingerprint)
+        n_added += 1
+
+    if refit:
+        index.matrix = None
+    index.save(index_path)
+    logging.info('Similarity index of {} cases written to {}: {} cases added in {} seconds.'.format(
+        len(index), index_path, n_added, round(time.time() - start_time, 1)))
+    return index
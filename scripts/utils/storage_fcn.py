@@ -0,0 +1,217 @@
+from google.cloud import storage
+import google.auth
+from google.auth.transport.requests import AuthorizedSession
+import requests
+import contextlib
+import io
+import logging
+import mmap
+import os
+import tempfile
+import threading
+import weakref
+
+from .compression_fcn import compress, decompress
+
+# Backends wrapping the google.cloud.storage Clients already seen, so that their bucket handles are reused
+_wrapped_clients = weakref.WeakKeyDictionary()
+
+
+class BlobStream(io.RawIOBase):
+    """
+    Read-only file-like view of a blob, downloaded by ranges so that only one chunk is held in memory.
+    """
+
+    def __init__(self, blob, chunk_size=1024 * 1024):
+        self.blob = blob
+        self.chunk_size = chunk_size
+        self.size = blob.size
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if self.position >= self.size:
+            return 0
+        end = min(self.position + min(len(buffer), self.chunk_size), self.size) - 1
+        data = self.blob.download_as_string(start=self.position, end=end)
+        buffer[:len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+
+class GCSStorage:
+    """
+    Storage backend on Google Cloud Storage. Bucket handles are reused and the HTTP connection pool is sized to
+    the number of workers, so concurrent downloads do not open a new connection per object.
+    """
+
+    def __init__(self, storage_client=None, credentials=None, max_workers=16):
+        if storage_client is None:
+            if credentials is None:
+                credentials, _ = google.auth.default()
+            session = AuthorizedSession(credentials)
+            adapter = requests.adapters.HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+            session.mount('https://', adapter)
+            storage_client = storage.Client(project=getattr(credentials, 'project_id', None),
+                                            credentials=credentials, _http=session)
+        self.client = storage_client
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def bucket(self, bucket_name):
+        with self._lock:
+            if bucket_name not in self._buckets:
+                self._buckets[bucket_name] = self.client.bucket(bucket_name)
+            return self._buckets[bucket_name]
+
+    def readBytes(self, bucket_name, blob_name):
+        blob = self.bucket(bucket_name).get_blob(blob_name)
+        if blob is None:
+            return None
+        if blob.content_encoding in ('gzip', 'zstd'):
+            # Skip decompressive transcoding, the data is decompressed here
+            return decompress(blob.download_as_string(raw_download=True), blob.content_encoding)
+        return blob.download_as_string()
+
+    def readText(self, bucket_name, blob_name):
+        data = self.readBytes(bucket_name, blob_name)
+        return None if data is None else data.decode('utf-8')
+
+    def writeBytes(self, bucket_name, blob_name, data, content_type=None, content_encoding=None):
+        blob = self.bucket(bucket_name).blob(blob_name)
+        if content_encoding:
+            data = compress(data, content_encoding)
+            blob.content_encoding = content_encoding
+            content_type = content_type or 'text/plain; charset=utf-8'
+        blob.upload_from_string(data, content_type=content_type)
+
+    def openStream(self, bucket_name, blob_name, chunk_size=1024 * 1024):
+        """
+        Returns:
+            stream: buffered binary file-like object reading the blob by chunks
+        """
+        blob = self.bucket(bucket_name).get_blob(blob_name)
+        return io.BufferedReader(BlobStream(blob, chunk_size), buffer_size=chunk_size)
+
+    def listNames(self, bucket_name, prefix=None):
+        return [blob.name for blob in self.client.list_blobs(bucket_or_name=bucket_name, prefix=prefix)]
+
+    def exists(self, bucket_name, blob_name):
+        return self.bucket(bucket_name).get_blob(blob_name) is not None
+
+    def delete(self, bucket_name, blob_name):
+        self.bucket(bucket_name).delete_blob(blob_name)
+
+
+class LocalStorage:
+    """
+    Storage backend on a local directory, each bucket being a sub-directory. Reads are memory mapped and
+    writes are atomic, so the pipeline can be re-run on local disks without any per-object network latency.
+    """
+
+    def __init__(self, root_dir):
+        self.root_dir = root_dir
+
+    def _path(self, bucket_name, blob_name):
+        return os.path.join(self.root_dir, bucket_name, blob_name)
+
+    @contextlib.contextmanager
+    def mapBytes(self, bucket_name, blob_name):
+        """
+        Context manager giving the content of an object without copying it, the mapping is closed on exit.
+        Returns:
+            data: memory mapped content (bytes-like) or decompressed content for compressed files,
+            None if the object does not exist
+        """
+        path = self._path(bucket_name, blob_name)
+        if not os.path.exists(path):
+            yield None
+            return
+        if os.path.getsize(path) == 0:
+            yield b''
+            return
+        with open(path, 'rb') as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            yield decompress(data)
+        finally:
+            data.close()
+
+    def readBytes(self, bucket_name, blob_name):
+        """
+        Returns:
+            data: bytes - copy of the content, None if the object does not exist
+        """
+        with self.mapBytes(bucket_name, blob_name) as data:
+            return data if data is None or isinstance(data, bytes) else bytes(data)
+
+    def readText(self, bucket_name, blob_name):
+        with self.mapBytes(bucket_name, blob_name) as data:
+            # Decoded straight from the mapped pages
+            return None if data is None else str(data, 'utf-8')
+
+    def writeBytes(self, bucket_name, blob_name, data, content_type=None, content_encoding=None):
+        # Compressed files are recognised from their first bytes when read
+        data = compress(data, content_encoding)
+        path = self._path(bucket_name, blob_name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # Write to a temporary file first so that readers never see a partial object
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def openStream(self, bucket_name, blob_name, chunk_size=1024 * 1024):
+        return open(self._path(bucket_name, blob_name), 'rb', buffering=chunk_size)
+
+    def listNames(self, bucket_name, prefix=None):
+        bucket_dir = os.path.join(self.root_dir, bucket_name)
+        names = []
+        for dir_path, _, file_names in os.walk(bucket_dir):
+            for file_name in file_names:
+                name = os.path.relpath(os.path.join(dir_path, file_name), bucket_dir).replace(os.sep, '/')
+                if prefix is None or name.startswith(prefix):
+                    names.append(name)
+        return sorted(names)
+
+    def exists(self, bucket_name, blob_name):
+        return os.path.exists(self._path(bucket_name, blob_name))
+
+    def delete(self, bucket_name, blob_name):
+        os.remove(self._path(bucket_name, blob_name))
+
+
+def getStorage(storage_uri=None, credentials=None, max_workers=16):
+    """
+    Build the storage backend matching an URI.
+    Args:
+        storage_uri: str - 'file:///path/to/root' for a local directory, None or 'gs://' for GCS
+        credentials: service account credentials, only used by GCS
+        max_workers: int - size of the GCS connection pool
+
+    Returns:
+        storage backend: GCSStorage or LocalStorage
+    """
+    if storage_uri and storage_uri.startswith('file://'):
+        logging.info('Using local storage in {}.'.format(storage_uri))
+        return LocalStorage(storage_uri[len('file://'):])
+    return GCSStorage(credentials=credentials, max_workers=max_workers)
+
+
+def asStorage(storage_client):
+    """
+    Wrap a google.cloud.storage Client into a storage backend, backends are returned as is.
+    Args:
+        storage_client: google.cloud.storage Client, GCSStorage or LocalStorage
+
+    Returns:
+        storage backend
+    """
+    if isinstance(storage_client, (GCSStorage, LocalStorage)):
+        return storage_client
+    if storage_client not in _wrapped_clients:
+        _wrapped_clients[storage_client] = GCSStorage(storage_client)
+    return _wrapped_clients[storage_client]
@@ -0,0 +1,212 @@
+"""
+In-memory stand-ins of the Google Cloud clients used by the helpers.
+"""
+from types import SimpleNamespace
+import datetime
+import hashlib
+
+
+class PreconditionFailed(Exception):
+    pass
+
+
+class FakeBlob:
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        self.metadata = None
+        self.content_encoding = None
+        self.content_type = None
+
+    @property
+    def _data(self):
+        return self.bucket.objects[self.name]['data']
+
+    @property
+    def size(self):
+        return len(self._data)
+
+    @property
+    def generation(self):
+        return self.bucket.objects[self.name]['generation']
+
+    @property
+    def md5_hash(self):
+        return hashlib.md5(self._data).hexdigest()
+
+    @property
+    def updated(self):
+        return self.bucket.objects[self.name]['updated']
+
+    def upload_from_string(self, data, content_type=None, if_generation_match=None):
+        current = self.bucket.objects.get(self.name)
+        if if_generation_match is not None and (current['generation'] if current else 0) != if_generation_match:
+            raise PreconditionFailed(self.name)
+        self.bucket.client.generation += 1
+        self.bucket.objects[self.name] = {'data': data.encode('utf-8') if isinstance(data, str) else bytes(data),
+                                          'generation': self.bucket.client.generation,
+                                          'updated': datetime.datetime.now(datetime.timezone.utc),
+                                          'metadata': self.metadata,
+                                          'content_encoding': self.content_encoding}
+
+    def download_as_string(self, start=None, end=None, raw_download=False):
+        self.bucket.client.downloads.append(self.name)
+        data = self._data
+        if start is not None:
+            data = data[start:end + 1 if end is not None else None]
+        return data
+
+    def patch(self):
+        self.bucket.objects[self.name]['metadata'] = self.metadata
+
+    def delete(self):
+        del self.bucket.objects[self.name]
+
+
+class FakeBucket:
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+        self.objects = {}
+
+    def blob(self, name):
+        return FakeBlob(self, name)
+
+    def get_blob(self, name):
+        if name not in self.objects:
+            return None
+        blob = FakeBlob(self, name)
+        blob.metadata = self.objects[name]['metadata']
+        blob.content_encoding = self.objects[name]['content_encoding']
+        return blob
+
+    def list_blobs(self, prefix=''):
+        return [self.get_blob(name) for name in sorted(self.objects) if name.startswith(prefix or '')]
+
+    def delete_blob(self, name):
+        del self.objects[name]
+
+
+class FakeStorageClient:
+    def __init__(self):
+        self.buckets = {}
+        self.generation = 0
+        self.downloads = []
+
+    def bucket(self, bucket_name):
+        return self.buckets.setdefault(bucket_name, FakeBucket(self, bucket_name))
+
+    get_bucket = bucket
+
+    def list_blobs(self, bucket_or_name, prefix=None):
+        return self.bucket(bucket_or_name).list_blobs(prefix)
+
+    def names(self, bucket_name, prefix=''):
+        return [name for name in sorted(self.bucket(bucket_name).objects) if name.startswith(prefix)]
+
+
+class FakeQueryJob:
+    def __init__(self, rows):
+        self.rows = rows
+
+    def result(self, page_size=None):
+        page_size = page_size or max(1, len(self.rows))
+        return SimpleNamespace(pages=[self.rows[idx:idx + page_size] for idx in range(0, len(self.rows), page_size)])
+
+
+class FakeBigQueryClient:
+    """
+    Records the BigQuery calls, queries return the rows given by query_fcn.
+    """
+
+    def __init__(self, query_fcn=lambda query, job_config: [], project='project'):
+        self.project = project
+        self.query_fcn = query_fcn
+        self.queries = []
+        self.loaded_rows = []
+        self.tables = {}
+        self.modified = datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc)
+        self.fail_load = False
+
+    def dataset(self, dataset_id):
+        from google.cloud import bigquery
+        return bigquery.DatasetReference(self.project, dataset_id)
+
+    def create_table(self, table):
+        self.tables[table.table_id] = table
+        return table
+
+    def delete_table(self, table_ref, not_found_ok=False):
+        if not_found_ok:
+            self.tables.pop(table_ref.table_id, None)
+        else:
+            del self.tables[table_ref.table_id]
+
+    def get_table(self, table):
+        if isinstance(table, str):
+            return SimpleNamespace(table_id=table.split('.')[-1], modified=self.modified)
+        if table.table_id not in self.tables:
+            raise LookupError(table.table_id)
+        return self.tables[table.table_id]
+
+    def load_table_from_json(self, rows, table_ref, job_config=None):
+        if self.fail_load:
+            raise RuntimeError('load failed')
+        self.loaded_rows.append(list(rows))
+        return FakeQueryJob([])
+
+    def query(self, query, job_config=None):
+        self.queries.append(query)
+        return FakeQueryJob(self.query_fcn(query, job_config))
+
+
+class FakeDatastoreQuery:
+    def __init__(self, client, kind):
+        self.client = client
+        self.kind = kind
+        self.filters = []
+        self.only_keys = False
+
+    def add_filter(self, property_name, operator, value):
+        self.filters.append((property_name, value))
+
+    def keys_only(self):
+        self.only_keys = True
+
+    def fetch(self, limit=None):
+        self.client.queries.append(self.filters)
+        results = []
+        for key, entity in sorted(self.client.entities.items()):
+            values = [entity.get(name) for name, _ in self.filters]
+            if all(value in (entity_value if isinstance(entity_value, list) else [entity_value])
+                   for (_, value), entity_value in zip(self.filters, values)):
+                results.append(entity)
+        return iter(results[:limit])
+
+
+class FakeDatastoreClient:
+    """
+    Datastore of case entities keyed by name, equality filters match any element of list properties.
+    """
+
+    def __init__(self, project='project'):
+        self.project = project
+        self.entities = {}
+        self.queries = []
+
+    def key(self, kind, name):
+        from google.cloud import datastore
+        return datastore.Key(kind, name, project=self.project)
+
+    def query(self, kind):
+        return FakeDatastoreQuery(self, kind)
+
+    def put(self, entity):
+        self.entities[entity.key.name] = entity
+
+    def put_multi(self, entities):
+        for entity in entities:
+            self.put(entity)
+
+    def get_multi(self, keys):
+        return [self.entities[key.name] for key in keys if key.name in self.entities]
@@ -0,0 +1,46 @@
+from types import SimpleNamespace
+
+from utils import DLP_fcn
+from utils.DLP_fcn import batchDeidentifyWithFpe, packTableItems
+
+
+def test_batches_respect_the_byte_and_row_limits():
+    texts = ['è' * 30, 'a' * 50, 'b' * 10, 'c' * 10, '']
+    batches = packTableItems(texts, max_bytes=64, max_rows=2)
+
+    assert all(sum(len(part.encode('utf-8')) for _, part in batch) <= 64 for batch in batches)
+    assert all(len(batch) <= 2 for batch in batches)
+    assert [idx for batch in batches for idx, _ in batch] == [0, 1, 2, 3, 4]
+
+
+def test_large_texts_are_split_into_parts_in_order():
+    text = 'Mario Rossi, nato a Milano.\n' * 10
+    batches = packTableItems(['short', text], max_bytes=60)
+
+    parts = [part for batch in batches for idx, part in batch if idx == 1]
+    assert len(parts) > 1
+    assert ''.join(parts) == text
+
+
+class StubDLPClient:
+    def __init__(self):
+        self.n_rows = []
+
+    def deidentify_content(self, parent, inspect_config, deidentify_config, item):
+        rows = item['table']['rows']
+        self.n_rows.append(len(rows))
+        redacted_rows = [SimpleNamespace(values=[SimpleNamespace(string_value=row['values'][0]['string_value']
+                                                                 .replace('Rossi', 'SURROGATE'))])
+                         for row in rows]
+        return SimpleNamespace(item=SimpleNamespace(table=SimpleNamespace(rows=redacted_rows)))
+
+
+def test_batch_deidentify_keeps_the_order_and_joins_the_parts(monkeypatch):
+    monkeypatch.setattr(DLP_fcn, 'fpeConfigs', lambda *args: ({}, {}))
+    client = StubDLPClient()
+    texts = ['Mario Rossi', '', 'Il sig. Rossi ha tosse.\n' * 20]
+
+    redacted = batchDeidentifyWithFpe(client, 'projects/p', texts, ['PERSON_NAME'], 'SURROGATE', max_bytes=100)
+
+    assert redacted == [text.replace('Rossi', 'SURROGATE') for text in texts]
+    assert len(client.n_rows) > 1
@@ -0,0 +1,72 @@
+import pytest
+
+pytest.importorskip('numpy')
+pytest.importorskip('PyPDF2')
+pytest.importorskip('ijson')
+pytest.importorskip('google.cloud.vision')
+
+from utils.boilerplate_fcn import BoilerplateDetector, loadBoilerplate, normalizeLine, saveBoilerplate  # noqa: E402
+
+HEADER = 'Società Italiana di Radiologia Medica e Interventistica\n'
+
+
+def ocrText(pages):
+    # Layout of readJsonResult: the Vision text of each page ends with a line break, pages are followed by a space
+    return ''.join(''.join(page) + ' ' for page in pages)
+
+
+def corpus(n_docs=5):
+    return [ocrText([[HEADER, 'Caso {}: uomo di {} anni con tosse e febbre.\n'.format(idx, 40 + idx),
+                      'Referto della TC del torace numero {}.\n'.format(idx)]]) for idx in range(n_docs)]
+
+
+def test_lines_are_normalized():
+    assert normalizeLine('  Pagina 12 di 30 -- SIRM, 2020\n') == 'pagina 0 di 0 sirm 0'
+
+
+def test_lines_repeated_across_documents_are_stripped():
+    detector = BoilerplateDetector(min_docs=3).fit(corpus())
+    text = ocrText([[HEADER, 'Caso nuovo: donna di 70 anni con dispnea.\n']])
+
+    assert detector.strip(text) == 'Caso nuovo: donna di 70 anni con dispnea.\n '
+
+
+def test_lines_damaged_by_ocr_are_recognised():
+    detector = BoilerplateDetector(min_docs=3).fit(corpus())
+    text = ocrText([['Societa ltaliana di Radiologia Medica e lnterventistica\n', 'Caso nuovo.\n']])
+
+    assert detector.strip(text) == 'Caso nuovo.\n '
+
+
+def test_repeated_headers_are_only_stripped_at_page_edges():
+    detector = BoilerplateDetector(page_repeats=3, edge_lines=1)
+    repeated = 'Ospedale Papa Giovanni XXIII di Bergamo\n'
+    # Numbers are normalized away, the lines of the body differ by their words
+    bodies = [['Pagina {}, riga {} del referto con opacità.\n'.format(page, line)
+               for line in ['alfa', 'beta', 'gamma', 'delta', 'epsilon', 'zeta']]
+              for page in ['prima', 'seconda', 'terza', 'quarta']]
+    # The repeated line is a header on the first pages, and content in the middle of the last one
+    last_page = bodies[3][:3] + [repeated] + bodies[3][3:]
+    pages = [[repeated] + body for body in bodies[:3]] + [last_page]
+
+    stripped = detector.strip(ocrText(pages))
+
+    # The space following a page goes with the header starting the next one
+    assert stripped == ''.join(bodies[0] + bodies[1] + bodies[2]) + ' ' + ocrText([last_page])
+
+
+def test_ngrams_repeated_across_documents_are_removed_from_long_lines():
+    footer = 'pubblicato sul sito della società italiana di radiologia medica'
+    texts = ['Il caso {} mostra consolidazioni, {}.\n'.format(idx, footer) for idx in range(5)]
+    detector = BoilerplateDetector(min_docs=3, max_chars=20).fit(texts)
+
+    assert detector.strip('Il caso nuovo mostra noduli, {}.\n'.format(footer)) == 'Il caso nuovo mostra noduli,\n'
+
+
+def test_learned_boilerplate_is_saved_and_loaded(tmp_path):
+    detector = BoilerplateDetector(min_docs=3).fit(corpus())
+    saveBoilerplate(None, str(tmp_path), detector)
+
+    loaded = loadBoilerplate(None, str(tmp_path))
+    text = ocrText([[HEADER, 'Caso nuovo.\n']])
+    assert loaded.strip(text) == detector.strip(text) == 'Caso nuovo.\n '
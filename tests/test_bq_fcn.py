@@ -0,0 +1,122 @@
+import datetime
+
+import pytest
+
+pytest.importorskip('google.cloud.bigquery')
+pytest.importorskip('pyarrow')
+
+from stubs import FakeBigQueryClient  # noqa: E402
+from utils.bq_fcn import EntityExporter, QueryResultCache, constructCasesQuery, mergeRows2BQ, queryCases  # noqa: E402
+
+
+def caseRows(query, job_config):
+    return [{'case': case, 'eng_txt': 'text of {}'.format(case)} for case in job_config.query_parameters[0].values]
+
+
+def test_cases_query_is_parameterized():
+    query = constructCasesQuery(['case', 'eng_txt'], 'project.dataset.table')
+
+    assert query == 'SELECT case, eng_txt FROM `project.dataset.table` WHERE `case` IN UNNEST(@cases) '
+
+
+def test_query_cases_sends_one_job_with_unique_cases():
+    bq_client = FakeBigQueryClient(caseRows)
+
+    rows = list(queryCases(bq_client, ['case2', 'case1', 'case2'], page_size=1))
+
+    assert [row['case'] for row in rows] == ['case1', 'case2']
+    assert len(bq_client.queries) == 1
+    assert bq_client.queries[0].startswith('SELECT * FROM')
+
+
+def test_cached_results_are_reused_until_the_table_changes():
+    bq_client = FakeBigQueryClient(caseRows)
+    cache = QueryResultCache()
+
+    first = list(queryCases(bq_client, ['case1'], column_lst=['case', 'eng_txt'], cache=cache))
+    assert list(queryCases(bq_client, ['case1'], column_lst=['case', 'eng_txt'], cache=cache)) == first
+    assert len(bq_client.queries) == 1
+
+    bq_client.modified += datetime.timedelta(minutes=1)
+    list(queryCases(bq_client, ['case1'], column_lst=['case', 'eng_txt'], cache=cache))
+    assert len(bq_client.queries) == 2
+
+
+def test_cache_evicts_the_least_recently_used_results_by_size():
+    cache = QueryResultCache(max_bytes=20)
+    cache.put('a', [{'eng_txt': 'x' * 8}])
+    cache.put('b', [{'eng_txt': 'è' * 4}])
+    cache.get('a')
+    cache.put('c', [{'eng_txt': 'z' * 8}])
+
+    assert cache.get('b') is None
+    assert cache.get('a') is not None and cache.get('c') is not None
+    assert cache.current_bytes == 16
+
+
+def test_results_larger_than_the_cache_are_not_cached():
+    cache = QueryResultCache(max_bytes=10)
+    cache.put('a', [{'eng_txt': 'x' * 11}])
+
+    assert cache.get('a') is None
+    assert cache.current_bytes == 0
+
+
+def textRow(case, eng_txt):
+    return {'case': case, 'it_raw_txt': 'it', 'eng_raw_txt': 'en', 'eng_txt': eng_txt}
+
+
+def test_merge_keeps_the_last_row_of_each_case_and_drops_the_staging_table():
+    bq_client = FakeBigQueryClient()
+
+    mergeRows2BQ(bq_client, 'dataset', 'ISMIR', [textRow('case1', 'old'), textRow('case2', 'b'),
+                                                 textRow('case1', 'new')])
+
+    assert bq_client.loaded_rows == [[textRow('case1', 'new'), textRow('case2', 'b')]]
+    assert bq_client.queries[0].startswith('MERGE `project.dataset.ISMIR` T USING `project.dataset.ISMIR_staging_')
+    assert bq_client.tables == {}
+
+
+def test_staging_tables_expire_and_are_dropped_when_the_load_fails():
+    bq_client = FakeBigQueryClient()
+    bq_client.fail_load = True
+    created = []
+    create_table = bq_client.create_table
+    bq_client.create_table = lambda table: created.append(table) or create_table(table)
+
+    with pytest.raises(RuntimeError):
+        mergeRows2BQ(bq_client, 'dataset', 'ISMIR', [textRow('case1', 'text')])
+
+    assert created[0].expires > datetime.datetime.now(datetime.timezone.utc)
+    assert bq_client.tables == {}
+    assert bq_client.queries == []
+
+
+def entityRows(name):
+    return [{'category': 'Disease or Syndrome', 'entity': name, 'tui': 'T047', 'cui': None, 'count': 1}]
+
+
+def test_entities_are_merged_by_batches_and_aggregated_on_close():
+    bq_client = FakeBigQueryClient()
+    exporter = EntityExporter(bq_client, 'dataset', 'ISMIR_entities', merge_batch_size=2)
+    assert bq_client.tables['ISMIR_entities'].clustering_fields == ['case', 'model']
+
+    exporter.add('case1', 'en_core_sci_sm', entityRows('pneumonia'))
+    exporter.add('case1', 'en_core_sci_lg', entityRows('pneumonia'))
+    exporter.add('case2', 'en_core_sci_sm', entityRows('cough'))
+    exporter.close()
+
+    assert [[(row['case'], row['model']) for row in rows] for rows in bq_client.loaded_rows] == \
+        [[('case1', 'en_core_sci_sm'), ('case1', 'en_core_sci_lg')], [('case2', 'en_core_sci_sm')]]
+    assert all(query.startswith('MERGE `project.dataset.ISMIR_entities`') for query in bq_client.queries[:2])
+    assert [query.split('`')[1] for query in bq_client.queries[2:]] == \
+        ['project.dataset.ISMIR_entities_category_counts', 'project.dataset.ISMIR_entities_entity_counts']
+
+
+def test_existing_entity_tables_are_reused():
+    bq_client = FakeBigQueryClient()
+    EntityExporter(bq_client, 'dataset', 'ISMIR_entities')
+    table = bq_client.tables['ISMIR_entities']
+
+    EntityExporter(bq_client, 'dataset', 'ISMIR_entities')
+    assert bq_client.tables['ISMIR_entities'] is table
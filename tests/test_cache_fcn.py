@@ -0,0 +1,157 @@
+import datetime
+import io
+import json
+import os
+
+import pytest
+
+PyPDF2 = pytest.importorskip('PyPDF2')
+pytest.importorskip('ijson')
+pytest.importorskip('google.cloud.storage')
+
+from stubs import FakeStorageClient  # noqa: E402
+from utils.cache_fcn import GCSCacheBackend, LocalCacheBackend, NERCache, OCRCache, cachedDocumentOCR, \
+    getCacheBackend  # noqa: E402
+from utils.storage_fcn import LocalStorage  # noqa: E402
+
+
+def makePdf(widths):
+    # Pages of different sizes have different contents, hence different hashes
+    pdf_writer = PyPDF2.PdfFileWriter()
+    for width in widths:
+        pdf_writer.addBlankPage(width=width, height=100)
+    pdf = io.BytesIO()
+    pdf_writer.write(pdf)
+    return pdf.getvalue()
+
+
+class StubOCR:
+    """
+    OCR helper writing the json output of Vision, the text of a page being its width.
+    """
+
+    def __init__(self, storage_client, skip_pages=()):
+        self.storage_client = storage_client
+        self.skip_pages = set(skip_pages)
+        self.ocr_pages = []
+
+    def __call__(self, vision_client, gcs_source_uri, gcs_destination_uri):
+        src_bucket, _, src_name = gcs_source_uri[len('gs://'):].partition('/')
+        pdf_bytes = self.storage_client.bucket(src_bucket).blob(src_name).download_as_string()
+        pdf_reader = PyPDF2.PdfFileReader(io.BytesIO(pdf_bytes))
+        responses = []
+        for page_idx in range(pdf_reader.getNumPages()):
+            width = int(pdf_reader.getPage(page_idx).mediaBox.getWidth())
+            self.ocr_pages.append(width)
+            if width not in self.skip_pages:
+                responses.append({'fullTextAnnotation': {'text': 'page {}\n'.format(width)},
+                                  'context': {'pageNumber': page_idx + 1}})
+        dest_bucket, _, dest_prefix = gcs_destination_uri[len('gs://'):].partition('/')
+        self.storage_client.bucket(dest_bucket).blob(dest_prefix + 'output-1-to-1.json').upload_from_string(
+            json.dumps({'responses': responses}))
+
+
+@pytest.fixture
+def storage_client():
+    return FakeStorageClient()
+
+
+@pytest.fixture
+def ocr_cache(tmp_path):
+    return OCRCache(LocalCacheBackend(str(tmp_path)))
+
+
+def ocrPdf(storage_client, ocr_cache, ocr_fcn, doc_title, widths):
+    storage_client.bucket('bucket').blob('pdf/{}.pdf'.format(doc_title)).upload_from_string(makePdf(widths))
+    return cachedDocumentOCR(None, storage_client, ocr_cache, ocr_fcn, 'gs://bucket/pdf/{}.pdf'.format(doc_title),
+                             'bucket', doc_title)
+
+
+def test_duplicate_documents_are_not_ocrd_again(storage_client, ocr_cache):
+    ocr_fcn = StubOCR(storage_client)
+
+    text = ocrPdf(storage_client, ocr_cache, ocr_fcn, 'case1', [100, 200])
+    assert text == 'page 100\n page 200\n '
+
+    assert ocrPdf(storage_client, ocr_cache, ocr_fcn, 'case1_copy', [100, 200]) == text
+    assert ocr_fcn.ocr_pages == [100, 200]
+    assert ocr_cache.stats()['document_hits'] == 1
+
+
+def test_only_the_pages_missing_from_the_cache_are_ocrd(storage_client, ocr_cache):
+    ocr_fcn = StubOCR(storage_client)
+    ocrPdf(storage_client, ocr_cache, ocr_fcn, 'case1', [100, 200])
+
+    text = ocrPdf(storage_client, ocr_cache, ocr_fcn, 'case2', [300, 100, 200])
+
+    assert text == 'page 300\n page 100\n page 200\n '
+    assert ocr_fcn.ocr_pages == [100, 200, 300]
+
+
+def test_temporary_outputs_are_deleted_and_stale_outputs_ignored(storage_client, ocr_cache):
+    # Output of an older run of the same document title
+    storage_client.bucket('bucket').blob('json/case1-output-1-to-1.json').upload_from_string(json.dumps(
+        {'responses': [{'fullTextAnnotation': {'text': 'stale\n'}, 'context': {'pageNumber': 1}}]}))
+
+    text = ocrPdf(storage_client, ocr_cache, StubOCR(storage_client), 'case1', [100])
+
+    assert text == 'page 100\n '
+    assert storage_client.names('bucket', 'ocr_cache_tmp') == []
+
+
+def test_pages_missing_from_the_output_are_not_cached(storage_client, ocr_cache):
+    failing_ocr = StubOCR(storage_client, skip_pages=[200])
+    assert ocrPdf(storage_client, ocr_cache, failing_ocr, 'case1', [100, 200]) == 'page 100\n  '
+
+    ocr_fcn = StubOCR(storage_client)
+    assert ocrPdf(storage_client, ocr_cache, ocr_fcn, 'case2', [100, 200]) == 'page 100\n page 200\n '
+    assert ocr_fcn.ocr_pages == [200]
+
+
+ENTITY_SPANS = [(0, 9, 'pneumonia', 'T047', 'C0032285'), (14, 19, 'cough', 'T184', None)]
+
+
+def test_ner_results_are_namespaced_by_model_and_settings(tmp_path):
+    backend = LocalCacheBackend(str(tmp_path))
+    ner_cache = NERCache(backend, 'en_core_sci_sm', '0.2.4', {'threshold': 0.85})
+    ner_cache.put('pneumonia and cough', ENTITY_SPANS)
+
+    assert ner_cache.get('pneumonia and cough') == ENTITY_SPANS
+    assert NERCache(backend, 'en_core_sci_sm', '0.2.5', {'threshold': 0.85}).get('pneumonia and cough') is None
+    assert NERCache(backend, 'en_core_sci_sm', '0.2.4', {'threshold': 0.7}).get('pneumonia and cough') is None
+    assert (ner_cache.hits, ner_cache.misses) == (1, 0)
+
+
+def test_least_recently_used_entries_are_evicted_first(tmp_path):
+    backend = LocalCacheBackend(str(tmp_path))
+    ner_cache = NERCache(backend, 'en_core_sci_sm', '0.2.4', {}, max_bytes=200)
+    for idx, text in enumerate(['first', 'second', 'third']):
+        ner_cache.put(text, ENTITY_SPANS)
+        os.utime(os.path.join(str(tmp_path), ner_cache._key(text)), (1000 + idx, 1000 + idx))
+    # A hit makes the oldest entry the most recently used
+    ner_cache.get('first')
+
+    assert ner_cache.evict() == 1
+    assert ner_cache.get('second') is None
+    assert ner_cache.get('first') == ner_cache.get('third') == ENTITY_SPANS
+
+
+def test_gcs_hits_record_their_access_time(storage_client):
+    backend = GCSCacheBackend(storage_client, 'bucket', 'cache')
+    ner_cache = NERCache(backend, 'en_core_sci_sm', '0.2.4', {}, max_bytes=200)
+    last_week = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=7)
+    for idx, text in enumerate(['first', 'second', 'third']):
+        ner_cache.put(text, ENTITY_SPANS)
+        storage_client.bucket('bucket').objects['cache/' + ner_cache._key(text)]['updated'] = \
+            last_week + datetime.timedelta(minutes=idx)
+    ner_cache.get('first')
+
+    assert ner_cache.evict() == 1
+    assert ner_cache.get('second') is None
+    assert ner_cache.get('first') == ENTITY_SPANS
+
+
+def test_gcs_caches_need_gcs_storage(tmp_path):
+    assert isinstance(getCacheBackend(LocalStorage(str(tmp_path)), str(tmp_path / 'cache')), LocalCacheBackend)
+    with pytest.raises(ValueError):
+        getCacheBackend(LocalStorage(str(tmp_path)), 'gs://bucket/cache')
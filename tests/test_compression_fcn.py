@@ -0,0 +1,79 @@
+import pytest
+
+from utils.compression_fcn import compress, decompress, downloadText, textCompression
+
+TEXT = 'Il paziente è stato ricoverato. ' * 100
+
+
+@pytest.fixture(params=['gzip', 'zstd'])
+def encoding(request):
+    if request.param == 'zstd':
+        pytest.importorskip('zstandard')
+    return request.param
+
+
+def test_round_trip(encoding):
+    compressed = compress(TEXT, encoding)
+
+    assert len(compressed) < len(TEXT.encode('utf-8'))
+    assert decompress(compressed, encoding) == TEXT.encode('utf-8')
+
+
+def test_encoding_is_sniffed_from_the_first_bytes(encoding):
+    assert decompress(compress(TEXT, encoding)) == TEXT.encode('utf-8')
+
+
+def test_uncompressed_data_is_returned_as_is():
+    data = TEXT.encode('utf-8')
+
+    assert compress(data, None) is data
+    assert decompress(data) is data
+
+
+def test_gzip_output_is_deterministic():
+    assert compress(TEXT, 'gzip') == compress(TEXT, 'gzip')
+
+
+def test_unknown_encodings_are_rejected():
+    with pytest.raises(ValueError):
+        compress(TEXT, 'brotli')
+
+
+def test_compression_is_read_from_the_environment(monkeypatch):
+    monkeypatch.setenv('TEXT_COMPRESSION', 'gzip')
+    assert textCompression() == 'gzip'
+
+    monkeypatch.setenv('TEXT_COMPRESSION', '')
+    assert textCompression() is None
+
+
+class StubBlob:
+    def __init__(self, data, content_encoding=None):
+        self.data = data
+        self.content_encoding = content_encoding
+        self.raw_download = None
+
+    def download_as_string(self, raw_download=False):
+        self.raw_download = raw_download
+        return self.data
+
+
+def test_download_decompresses_according_to_the_content_encoding(encoding):
+    blob = StubBlob(compress(TEXT, encoding), content_encoding=encoding)
+
+    assert downloadText(blob) == TEXT
+    # Decompressive transcoding is skipped
+    assert blob.raw_download
+
+    assert downloadText(StubBlob(TEXT.encode('utf-8'))) == TEXT
+
+
+def test_local_storage_compresses_transparently(encoding, tmp_path):
+    pytest.importorskip('google.cloud.storage')
+    from utils.storage_fcn import LocalStorage
+
+    storage_backend = LocalStorage(str(tmp_path))
+    storage_backend.writeBytes('bucket', 'eng_txt/case1.txt', TEXT, content_encoding=encoding)
+
+    assert (tmp_path / 'bucket' / 'eng_txt' / 'case1.txt').stat().st_size < len(TEXT.encode('utf-8'))
+    assert storage_backend.readText('bucket', 'eng_txt/case1.txt') == TEXT
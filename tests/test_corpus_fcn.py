@@ -0,0 +1,57 @@
+import pytest
+
+pytest.importorskip('pyarrow')
+
+from stubs import FakeStorageClient  # noqa: E402
+from utils.corpus_fcn import buildCorpus, iterCorpus, readCorpus  # noqa: E402
+
+
+@pytest.fixture
+def storage_client():
+    storage_client = FakeStorageClient()
+    bucket = storage_client.bucket('bucket')
+    for case in ['case1', 'case2']:
+        bucket.blob('raw_txt/{}.txt'.format(case)).upload_from_string('testo di {}'.format(case))
+        bucket.blob('eng_txt/{0}/bucket_raw_txt_{0}_en_translations.txt'.format(case)).upload_from_string(
+            'text of {}'.format(case))
+    bucket.blob('curated_eng_txt/case1.txt').upload_from_string('curated case1')
+    # Not documents
+    bucket.blob('raw_txt/index.csv').upload_from_string('case1')
+    bucket.blob('eng_txt/_logs/log.txt').upload_from_string('log')
+    return storage_client
+
+
+def test_one_row_per_case_with_every_stage(storage_client, tmp_path):
+    corpus_path = str(tmp_path / 'corpus.arrow')
+
+    assert buildCorpus(storage_client, 'bucket', corpus_path) == 2
+
+    table = readCorpus(corpus_path, columns=['case', 'it_raw_txt', 'eng_raw_txt', 'eng_txt'])
+    assert table.to_pylist() == [
+        {'case': 'case1', 'it_raw_txt': 'testo di case1', 'eng_raw_txt': 'text of case1', 'eng_txt': 'curated case1'},
+        {'case': 'case2', 'it_raw_txt': 'testo di case2', 'eng_raw_txt': 'text of case2', 'eng_txt': None}]
+
+
+def test_iteration_skips_rows_missing_a_selected_stage(storage_client, tmp_path):
+    corpus_path = str(tmp_path / 'corpus.arrow')
+    buildCorpus(storage_client, 'bucket', corpus_path)
+
+    assert [row['case'] for row in iterCorpus(corpus_path, ['case', 'eng_txt'], batch_size=1)] == ['case1']
+    assert [row['case'] for row in iterCorpus(corpus_path, ['case', 'it_raw_txt'])] == ['case1', 'case2']
+
+
+def test_rebuilds_only_download_the_changed_outputs(storage_client, tmp_path):
+    corpus_path = str(tmp_path / 'corpus.arrow')
+    buildCorpus(storage_client, 'bucket', corpus_path)
+    storage_client.downloads = []
+
+    bucket = storage_client.bucket('bucket')
+    bucket.blob('curated_eng_txt/case2.txt').upload_from_string('curated case2')
+    bucket.blob('raw_txt/case1.txt').upload_from_string('testo nuovo')
+    buildCorpus(storage_client, 'bucket', corpus_path)
+
+    assert sorted(storage_client.downloads) == ['curated_eng_txt/case2.txt', 'raw_txt/case1.txt']
+    rows = readCorpus(corpus_path, columns=['case', 'it_raw_txt', 'eng_raw_txt', 'eng_txt']).to_pylist()
+    assert rows[0] == {'case': 'case1', 'it_raw_txt': 'testo nuovo', 'eng_raw_txt': 'text of case1',
+                       'eng_txt': 'curated case1'}
+    assert rows[1]['eng_txt'] == 'curated case2'
@@ -0,0 +1,28 @@
+import pytest
+
+from utils.cpu_fcn import mapTexts
+
+
+def shout(text, suffix=''):
+    return text.upper() + suffix
+
+
+def failOnBoom(text):
+    if text == 'boom':
+        raise ValueError(text)
+    return text
+
+
+def test_results_keep_the_order_of_the_texts():
+    texts = ['caso {} è positivo'.format(idx) for idx in range(50)]
+
+    assert mapTexts(shout, texts, n_workers=2, chunk_size=4, suffix='!') == [text.upper() + '!' for text in texts]
+
+
+def test_small_inputs_run_in_process():
+    assert mapTexts(shout, ['a', 'b'], n_workers=4, chunk_size=16) == ['A', 'B']
+
+
+def test_worker_errors_are_raised():
+    with pytest.raises(ValueError):
+        mapTexts(failOnBoom, ['ok'] * 10 + ['boom'], n_workers=2, chunk_size=2)
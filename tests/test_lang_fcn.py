@@ -0,0 +1,53 @@
+from types import SimpleNamespace
+
+from utils.lang_fcn import splitOnBoundaries, translateSpans
+
+
+def test_short_text_is_one_part():
+    assert splitOnBoundaries('short text', 100) == ['short text']
+
+
+def test_parts_are_under_the_limit_and_join_back():
+    text = 'Prima riga del referto.\n' * 50 + 'Una frase molto lunga. ' * 40 + 'x' * 300
+    parts = splitOnBoundaries(text, 120)
+
+    assert ''.join(parts) == text
+    assert all(0 < len(part) <= 120 for part in parts)
+
+
+def test_cuts_prefer_line_boundaries():
+    parts = splitOnBoundaries('aaaa\nbbbb\ncccc\n', 10)
+
+    assert parts == ['aaaa\nbbbb\n', 'cccc\n']
+
+
+def test_size_function_counts_bytes():
+    text = 'è' * 100
+    parts = splitOnBoundaries(text, 31, size_fcn=lambda part: len(part.encode('utf-8')))
+
+    assert ''.join(parts) == text
+    assert all(len(part.encode('utf-8')) <= 31 for part in parts)
+
+
+class StubTranslateClient:
+    def __init__(self):
+        self.requests = []
+
+    def location_path(self, project_id, location):
+        return 'projects/{}/locations/{}'.format(project_id, location)
+
+    def translate_text(self, parent, contents, **kwargs):
+        self.requests.append(contents)
+        return SimpleNamespace(translations=[SimpleNamespace(translated_text=content.upper())
+                                             for content in contents])
+
+
+def test_translate_spans_sends_only_the_source_language_under_the_size_limit():
+    client = StubTranslateClient()
+    spans = [('it', 'polmonite bilaterale. ' * 20), ('en', 'already english '), ('it', 'tosse secca')]
+
+    translated = translateSpans(client, 'project', spans, max_chars=100)
+
+    assert translated == spans[0][1].upper() + 'already english ' + 'TOSSE SECCA'
+    assert all(sum(len(content) for content in request) <= 100 for request in client.requests)
+    assert all('already english' not in content for request in client.requests for content in request)
@@ -0,0 +1,76 @@
+from concurrent.futures import ThreadPoolExecutor
+import threading
+
+import pytest
+
+pytest.importorskip('PyPDF2')
+pytest.importorskip('ijson')
+pytest.importorskip('google.cloud.vision')
+
+from utils.cache_fcn import LocalCacheBackend  # noqa: E402
+from utils.ledger_fcn import EventLedger  # noqa: E402
+
+
+@pytest.fixture
+def backend(tmp_path):
+    return LocalCacheBackend(str(tmp_path))
+
+
+def test_finished_steps_are_resumed_by_a_retry(backend):
+    calls = []
+
+    def ocr(doc_title):
+        calls.append(doc_title)
+        return {'text': doc_title.upper()}
+
+    ledger = EventLedger(backend, 'case1/1', event_id='event1')
+    assert ledger.claim()
+    assert ledger.step('ocr', ocr, 'case1') == {'text': 'CASE1'}
+
+    # The delivery died before completing, the retry reuses the OCR output
+    retry = EventLedger(backend, 'case1/1', event_id='event2', lease_seconds=0)
+    assert retry.claim()
+    assert retry.step('ocr', ocr, 'case1') == {'text': 'CASE1'}
+    assert calls == ['case1']
+    assert retry.steps_resumed == 1
+
+
+def test_duplicate_deliveries_are_skipped(backend):
+    ledger = EventLedger(backend, 'case1/1', event_id='event1')
+    assert ledger.claim()
+
+    # Still running within its lease
+    assert not EventLedger(backend, 'case1/1', event_id='event2').claim()
+
+    ledger.complete()
+    assert not EventLedger(backend, 'case1/1', event_id='event3', lease_seconds=0).claim()
+
+
+def test_new_generations_are_processed_again(backend):
+    ledger = EventLedger(backend, 'case1/1', event_id='event1')
+    ledger.claim()
+    ledger.complete()
+
+    assert EventLedger(backend, 'case1/2', event_id='event2').claim()
+
+
+def test_only_one_concurrent_delivery_gets_the_claim(backend):
+    barrier = threading.Barrier(8)
+
+    def claim(event_id):
+        ledger = EventLedger(backend, 'case1/1', event_id=event_id)
+        barrier.wait()
+        return ledger.claim()
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        claims = list(executor.map(claim, ['event{}'.format(idx) for idx in range(8)]))
+
+    assert claims.count(True) == 1
+
+
+def test_without_backend_every_step_runs():
+    ledger = EventLedger(None, 'case1/1', event_id='event1')
+
+    assert ledger.claim()
+    assert ledger.step('ocr', lambda: 'text') == 'text'
+    ledger.complete()
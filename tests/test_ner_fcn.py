@@ -0,0 +1,101 @@
+import json
+
+import pytest
+
+pytest.importorskip('google.cloud.datastore')
+pytest.importorskip('scispacy')
+pytest.importorskip('pandas')
+
+from google.cloud import datastore  # noqa: E402
+from stubs import FakeDatastoreClient  # noqa: E402
+from utils import ner_fcn  # noqa: E402
+from utils.ner_fcn import compactEntities, countEntities, getCases, mergeEntitySpans, normalizeStoredEntities, \
+    shardText  # noqa: E402
+
+TUI_CATEGORIES = {'T047': 'Disease or Syndrome', 'T184': 'Sign or Symptom'}
+
+
+def test_shards_cover_the_text_without_gaps():
+    text = ('Il paziente presenta tosse. ' * 40 + '\n\n') * 20
+    shards = shardText(text, max_chars=1000, overlap=100)
+
+    assert all(len(shard_text) <= 1000 for _, _, _, shard_text in shards)
+    assert shards[0][1] == 0 and shards[-1][2] == len(text)
+    assert all(previous[2] == shard[1] for previous, shard in zip(shards, shards[1:]))
+    assert all(text[offset:offset + len(shard_text)] == shard_text for offset, _, _, shard_text in shards)
+
+
+def test_short_texts_are_one_shard():
+    assert shardText('tosse secca', max_chars=100) == [(0, 0, 11, 'tosse secca')]
+
+
+def test_entities_in_overlaps_are_kept_once():
+    first = (0, 100, [(10, 15, 'cough', 'T184', 'C0010200'), (98, 105, 'fever', 'T184', 'C0015967')])
+    second = (100, 200, [(98, 105, 'fever', 'T184', 'C0015967'), (150, 159, 'pneumonia', 'T047', 'C0032285')])
+
+    assert mergeEntitySpans([second, first]) == [(10, 15, 'cough', 'T184', 'C0010200'),
+                                                 (98, 105, 'fever', 'T184', 'C0015967'),
+                                                 (150, 159, 'pneumonia', 'T047', 'C0032285')]
+
+
+ENTITY_SPANS = [(0, 5, 'Cough', 'T184', 'C0010200'),
+                (10, 15, 'cough', 'T184', 'C0010200'),
+                (20, 26, 'coughs', 'T184', 'C0010200'),
+                (30, 39, 'Pneumonia', 'T047', 'C0032285'),
+                (40, 50, 'odd  thing', 'T047', None),
+                (60, 70, 'Odd Thing', 'T047', None),
+                (80, 85, 'femur', 'T023', 'C0015811')]
+
+
+def test_mentions_are_counted_per_cui_or_normalized_text():
+    rows = countEntities(ENTITY_SPANS, TUI_CATEGORIES)
+
+    assert rows == [
+        {'category': 'Disease or Syndrome', 'entity': 'odd thing', 'tui': 'T047', 'cui': None, 'count': 2},
+        {'category': 'Disease or Syndrome', 'entity': 'pneumonia', 'tui': 'T047', 'cui': 'C0032285', 'count': 1},
+        {'category': 'Sign or Symptom', 'entity': 'cough', 'tui': 'T184', 'cui': 'C0010200', 'count': 3}]
+
+
+def test_compact_entities_index_names_and_cuis_only():
+    entities_dict, unindexed = compactEntities(ENTITY_SPANS, TUI_CATEGORIES, prefix='sm:')
+
+    assert entities_dict['sm:Sign or Symptom'] == ['cough', 'coughs']
+    assert entities_dict['sm:Disease or Syndrome'] == ['pneumonia', 'odd thing']
+    assert entities_dict['sm:cuis'] == ['C0010200', 'C0032285']
+    assert json.loads(entities_dict['sm:entity_counts']) == countEntities(ENTITY_SPANS, TUI_CATEGORIES)
+    assert unindexed == ['sm:entity_counts']
+
+
+@pytest.fixture
+def datastore_client():
+    ner_fcn.filter_counts.clear()
+    client = FakeDatastoreClient()
+    # case1 was stored before the names were normalized
+    for name, entities in [('case1', {'Sign or Symptom': ['Cough', 'Fever'], 'cuis': ['C0010200']}),
+                           ('case2', {'Sign or Symptom': ['cough'], 'Disease or Syndrome': ['pneumonia']}),
+                           ('case3', {'Sign or Symptom': ['fever']})]:
+        entity = datastore.Entity(key=client.key('case', name))
+        entity.update(entities)
+        client.put(entity)
+    return client
+
+
+def caseNames(cases):
+    return [case.key.name for case in cases]
+
+
+def test_cases_stored_before_normalization_still_match(datastore_client):
+    assert caseNames(getCases(datastore_client, {'Sign or Symptom': ['Cough']})) == ['case1', 'case2']
+    assert caseNames(getCases(datastore_client, {'Sign or Symptom': ['Cough', 'Fever']})) == ['case1']
+    assert caseNames(getCases(datastore_client, {'Sign or Symptom': ['cough'],
+                                                 'Disease or Syndrome': ['Pneumonia']})) == ['case2']
+    assert caseNames(getCases(datastore_client, {'cuis': ['C0010200']})) == ['case1']
+
+
+def test_stored_names_are_normalized_once(datastore_client):
+    assert normalizeStoredEntities(datastore_client, set(TUI_CATEGORIES.values()), batch_size=1) == 1
+    assert datastore_client.entities['case1']['Sign or Symptom'] == ['cough', 'fever']
+    assert datastore_client.entities['case1']['cuis'] == ['C0010200']
+    assert normalizeStoredEntities(datastore_client, set(TUI_CATEGORIES.values())) == 0
+
+    assert caseNames(getCases(datastore_client, {'Sign or Symptom': ['cough']})) == ['case1', 'case2']
@@ -0,0 +1,29 @@
+import pytest
+
+pytest.importorskip('PyPDF2')
+pytest.importorskip('google.cloud.vision')
+
+from utils.ocr_fcn import planOCR  # noqa: E402
+
+
+def test_short_documents_are_a_single_request():
+    plan = planOCR(12)
+
+    assert plan == [{'first_page': 1, 'last_page': 12, 'batch_size': 12, 'timeout': 180}]
+
+
+def test_large_documents_are_split_into_balanced_ranges():
+    plan = planOCR(250, max_range_pages=100, max_batch_size=50, seconds_per_page=2.0)
+
+    assert [(page_range['first_page'], page_range['last_page']) for page_range in plan] == \
+        [(1, 84), (85, 168), (169, 250)]
+    assert all(page_range['batch_size'] == 50 for page_range in plan)
+
+
+def test_timeouts_grow_with_the_number_of_pages():
+    assert planOCR(100, seconds_per_page=3.0)[0]['timeout'] == 300
+    assert planOCR(10, min_timeout=60, seconds_per_page=3.0)[0]['timeout'] == 60
+
+
+def test_empty_documents_still_get_a_request():
+    assert len(planOCR(0)) == 1
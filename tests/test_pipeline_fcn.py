@@ -0,0 +1,79 @@
+import threading
+import time
+
+from utils.pipeline_fcn import Stage, runPipeline
+
+
+def test_all_documents_reach_every_stage():
+    seen = []
+    lock = threading.Lock()
+
+    def collect(doc):
+        with lock:
+            seen.append(doc['doc_title'])
+        return doc
+
+    stages = [Stage('ocr', lambda doc: dict(doc, text=doc['doc_title'].upper()), n_workers=3, queue_size=2,
+                    next_stages=['translate']),
+              Stage('translate', lambda doc: doc, n_workers=2, queue_size=2, next_stages=['store']),
+              Stage('store', collect, n_workers=2)]
+    docs = [{'doc_title': 'case{}'.format(idx)} for idx in range(200)]
+
+    stats = runPipeline(stages, docs)
+
+    assert sorted(seen) == sorted(doc['doc_title'] for doc in docs)
+    assert stats['store']['processed'] == 200
+
+
+def test_last_document_of_a_slow_upstream_is_not_dropped():
+    # The downstream workers time out on an empty queue while the upstream stage is still busy
+    def slow(doc):
+        time.sleep(0.25)
+        return doc
+
+    seen = []
+    stages = [Stage('slow', slow, next_stages=['store']), Stage('store', lambda doc: seen.append(doc), n_workers=4)]
+
+    runPipeline(stages, [{'doc_title': 'case1'}, {'doc_title': 'case2'}])
+
+    assert [doc['doc_title'] for doc in seen] == ['case1', 'case2']
+
+
+def test_failures_and_dropped_documents_do_not_go_downstream():
+    def fail_on_odd(doc):
+        if doc['idx'] % 2:
+            raise RuntimeError('ocr failed')
+        return doc
+
+    seen = []
+    stages = [Stage('ocr', fail_on_odd, next_stages=['filter']),
+              Stage('filter', lambda doc: doc if doc['idx'] % 4 == 0 else None, next_stages=['store']),
+              Stage('store', lambda doc: seen.append(doc['idx']))]
+
+    stats = runPipeline(stages, [{'doc_title': str(idx), 'idx': idx} for idx in range(10)])
+
+    assert (stats['ocr']['processed'], stats['ocr']['errors']) == (10, 5)
+    assert stats['filter']['processed'] == 5
+    assert sorted(seen) == [0, 4, 8]
+
+
+def test_stages_fed_by_several_upstream_stages_wait_for_all_of_them():
+    seen = []
+    lock = threading.Lock()
+
+    def collect(doc):
+        with lock:
+            seen.append(doc)
+
+    def slow(doc):
+        time.sleep(0.05)
+        return dict(doc, branch='slow')
+
+    stages = [Stage('split', lambda doc: doc, next_stages=['fast', 'slow']),
+              Stage('fast', lambda doc: dict(doc, branch='fast'), next_stages=['store']),
+              Stage('slow', slow, next_stages=['store']),
+              Stage('store', collect, n_workers=2)]
+
+    runPipeline(stages, [{'doc_title': 'case{}'.format(idx)} for idx in range(5)])
+
+    assert sorted(doc['branch'] for doc in seen) == ['fast'] * 5 + ['slow'] * 5
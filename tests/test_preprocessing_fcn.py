@@ -0,0 +1,41 @@
+import io
+import json
+
+import pytest
+
+pytest.importorskip('ijson')
+pytest.importorskip('google.cloud.vision')
+
+from stubs import FakeStorageClient  # noqa: E402
+from utils.preprocessing_fcn import iterJsonPageTexts, readJsonResultStreaming  # noqa: E402
+
+
+def visionOutput(first_page, texts):
+    # Layout of the files written by async_detect_document, the blocks are skipped by the parser
+    return json.dumps({'inputConfig': {'gcsSource': {'uri': 'gs://bucket/pdf/case1.pdf'}},
+                       'responses': [{'fullTextAnnotation': {
+                           'pages': [{'blocks': [{'paragraphs': [{'words': [{'symbols': [{'text': 'x'}]}]}]}]}],
+                           'text': text}, 'context': {'pageNumber': first_page + idx}}
+                           for idx, text in enumerate(texts)]})
+
+
+def test_pages_are_streamed_with_their_number():
+    json_stream = io.BytesIO(visionOutput(21, ['Pagina uno\n', 'Pagina due\n']).encode('utf-8'))
+
+    assert list(iterJsonPageTexts(json_stream)) == [(21, 'Pagina uno\n'), (22, 'Pagina due\n')]
+
+
+def test_pages_without_text_are_empty():
+    json_stream = io.BytesIO(json.dumps({'responses': [{'context': {'pageNumber': 1}}]}).encode('utf-8'))
+
+    assert list(iterJsonPageTexts(json_stream)) == [(1, '')]
+
+
+def test_documents_are_read_from_all_their_shards():
+    storage_client = FakeStorageClient()
+    bucket = storage_client.bucket('bucket')
+    bucket.blob('json/case1-output-1-to-2.json').upload_from_string(visionOutput(1, ['uno\n', 'due\n']))
+    bucket.blob('json/case1-output-3-to-3.json').upload_from_string(visionOutput(3, ['tre\n']))
+    bucket.blob('json/case10-output-1-to-1.json').upload_from_string(visionOutput(1, ['altro\n']))
+
+    assert readJsonResultStreaming(storage_client, 'bucket', 'case1') == 'uno\n due\n tre\n '
@@ -0,0 +1,63 @@
+import pytest
+
+pytest.importorskip('pyarrow')
+
+from utils.search_fcn import SearchIndex  # noqa: E402
+
+
+@pytest.fixture
+def index():
+    index = SearchIndex()
+    index.add('case1', 'Bilateral pneumonia with ground glass opacities.')
+    index.add('case2', 'Unilateral pneumonia, no ground glass.')
+    index.add('case3', 'Ground glass opacity in the bilateral lower lobes.')
+    return index
+
+
+def test_ranked_search(index):
+    results = index.search('bilateral ground glass')
+
+    # Documents matching all the terms rank above the partial matches
+    assert {case for case, _ in results[:2]} == {'case1', 'case3'}
+    assert [case for case, _ in results[2:]] == ['case2']
+    assert index.search('pneumonia', k=1)[0][0] in {'case1', 'case2'}
+
+
+def test_phrase_queries(index):
+    assert [case for case, _ in index.search('"bilateral pneumonia"')] == ['case1']
+    assert index.search('"pneumonia bilateral"') == []
+
+
+def test_phrases_without_tokens_are_ignored(index):
+    assert {case for case, _ in index.search('"--" pneumonia')} == {'case1', 'case2'}
+
+
+def test_replaced_and_removed_documents_are_hidden(index):
+    index.add('case1', 'No findings.')
+    index.remove('case2')
+
+    assert index.search('pneumonia') == []
+    assert [case for case, _ in index.search('findings')] == ['case1']
+
+
+def test_compaction_drops_deleted_documents(index):
+    index.add('case1', 'No findings.')
+    index.remove('case2')
+    before = [index.search(query) for query in ['ground glass', 'findings', '"lower lobes"']]
+
+    index.compact()
+
+    assert index.deleted == set()
+    assert sorted(index.cases) == ['case1', 'case3']
+    assert [index.search(query) for query in ['ground glass', 'findings', '"lower lobes"']] == before
+
+    # Documents added after a compaction are numbered after the remaining ones
+    index.add('case4', 'Bilateral lower lobes consolidation.')
+    assert {case for case, _ in index.search('"lower lobes"')} == {'case3', 'case4'}
+
+
+def test_save_and_load(index, tmp_path):
+    index.save(str(tmp_path / 'index.pkl'))
+    loaded = SearchIndex.load(str(tmp_path / 'index.pkl'))
+
+    assert loaded.search('bilateral ground glass') == index.search('bilateral ground glass')
@@ -0,0 +1,49 @@
+import pytest
+
+pytest.importorskip('numpy')
+pytest.importorskip('pyarrow')
+
+from utils.similarity_fcn import CaseSimilarityIndex  # noqa: E402
+
+TEXTS = {
+    'case1': 'bilateral pneumonia ground glass opacities fever cough',
+    'case2': 'bilateral pneumonia ground glass opacities dyspnea',
+    'case3': 'fractured femur after a fall orthopedic surgery',
+    'case4': 'femur fracture orthopedic surgery fall',
+    'case5': 'pneumonia cough fever',
+}
+
+
+@pytest.fixture
+def index():
+    index = CaseSimilarityIndex(min_df=1, max_df=1.0)
+    for case, text in TEXTS.items():
+        index.add(case, text, entity_counts={'C0032285': 1} if 'pneumonia' in text else {'C0015811': 2})
+    return index.fit()
+
+
+def test_similar_cases_rank_first(index):
+    assert index.similar('case1', k=1)[0][0] == 'case2'
+    assert index.similar('case3', k=1)[0][0] == 'case4'
+
+
+def test_the_case_itself_is_not_returned(index):
+    results = index.similarBatch(['case1', 'case3'], k=10)
+
+    assert all(case not in [similar for similar, _ in results[case]] for case in results)
+    assert all(len(results[case]) == len(TEXTS) - 1 for case in results)
+
+
+def test_cases_added_after_the_fit_are_vectorized(index):
+    index.refit_fraction = 1.0
+    index.add('case6', 'fall with femur fracture', entity_counts={'C0015811': 1})
+
+    assert index.matrix.shape[0] == len(TEXTS) + 1
+    assert index.similar('case6', k=1)[0][0] in {'case3', 'case4'}
+
+
+def test_save_and_load(index, tmp_path):
+    index.save(str(tmp_path / 'similarity.pkl'))
+    loaded = CaseSimilarityIndex.load(str(tmp_path / 'similarity.pkl'))
+
+    assert loaded.similar('case1') == index.similar('case1')
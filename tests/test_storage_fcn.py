@@ -0,0 +1,68 @@
+import mmap
+
+import pytest
+
+pytest.importorskip('google.cloud.storage')
+
+from stubs import FakeStorageClient  # noqa: E402
+from utils.storage_fcn import GCSStorage, LocalStorage, asStorage, getStorage  # noqa: E402
+
+
+@pytest.fixture(params=['local', 'gcs'])
+def storage_backend(request, tmp_path):
+    if request.param == 'local':
+        return getStorage('file://{}'.format(tmp_path))
+    return GCSStorage(FakeStorageClient())
+
+
+def test_round_trip(storage_backend):
+    storage_backend.writeBytes('bucket', 'raw_txt/case1.txt', 'è un caso')
+
+    assert storage_backend.readBytes('bucket', 'raw_txt/case1.txt') == 'è un caso'.encode('utf-8')
+    assert storage_backend.readText('bucket', 'raw_txt/case1.txt') == 'è un caso'
+    assert storage_backend.exists('bucket', 'raw_txt/case1.txt')
+
+
+def test_missing_objects_read_as_none(storage_backend):
+    assert storage_backend.readBytes('bucket', 'raw_txt/none.txt') is None
+    assert storage_backend.readText('bucket', 'raw_txt/none.txt') is None
+    assert not storage_backend.exists('bucket', 'raw_txt/none.txt')
+
+
+def test_list_and_delete(storage_backend):
+    for name in ['raw_txt/case2.txt', 'raw_txt/case1.txt', 'eng_txt/case1.txt']:
+        storage_backend.writeBytes('bucket', name, 'text')
+
+    assert storage_backend.listNames('bucket', prefix='raw_txt/') == ['raw_txt/case1.txt', 'raw_txt/case2.txt']
+
+    storage_backend.delete('bucket', 'raw_txt/case1.txt')
+    assert storage_backend.listNames('bucket', prefix='raw_txt/') == ['raw_txt/case2.txt']
+
+
+def test_streams_read_by_chunks(storage_backend):
+    data = bytes(range(256)) * 40
+    storage_backend.writeBytes('bucket', 'json/case1-output.json', data)
+
+    with storage_backend.openStream('bucket', 'json/case1-output.json', chunk_size=1000) as stream:
+        assert stream.read() == data
+
+
+def test_local_reads_close_the_memory_map(tmp_path):
+    storage_backend = LocalStorage(str(tmp_path))
+    storage_backend.writeBytes('bucket', 'raw_txt/case1.txt', 'text')
+    storage_backend.writeBytes('bucket', 'raw_txt/empty.txt', '')
+
+    with storage_backend.mapBytes('bucket', 'raw_txt/case1.txt') as data:
+        assert isinstance(data, mmap.mmap) and data[:] == b'text'
+    assert data.closed
+    assert isinstance(storage_backend.readBytes('bucket', 'raw_txt/case1.txt'), bytes)
+    assert storage_backend.readText('bucket', 'raw_txt/empty.txt') == ''
+
+
+def test_clients_are_wrapped_once():
+    storage_client = FakeStorageClient()
+    storage_backend = asStorage(storage_client)
+
+    assert isinstance(storage_backend, GCSStorage)
+    assert asStorage(storage_client) is storage_backend
+    assert asStorage(storage_backend) is storage_backend